@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+bench_converter.py
+------------------
+Benchmarks de gerar_notebooks_alunos.py sobre um corpus sintetico
+(synth_notebook.py) ou sobre uma pasta com cap*/cap*.ipynb + references.bib.
+
+Cada cenario roda num processo Python novo, para que o pico de RSS medido
+seja so dele. Relata o melhor tempo entre --repeat execucoes, celulas/s,
+MB/s (bytes de entrada do cenario) e pico de RSS.
+
+    python benchmarks/bench_converter.py                       # corpus padrao
+    python benchmarks/bench_converter.py --cells 1000 --blob-kb 512
+    python benchmarks/bench_converter.py --corpus . --scenarios process_cell run_batch
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import gerar_notebooks_alunos as conv  # noqa: E402
+import synth_notebook                  # noqa: E402
+
+try:
+    import resource
+except ImportError:                    # Windows: sem pico de RSS
+    resource = None
+
+
+SCENARIOS = {}
+
+
+def scenario(name: str):
+    """Registra f(corpus, args) -> {"seconds", "cells", "bytes"}."""
+    def register(func):
+        SCENARIOS[name] = func
+        return func
+    return register
+
+
+def timed(repeat: int, func, setup=None) -> float:
+    """Melhor tempo de func(setup()) em 'repeat' execucoes, com stdout calado."""
+    best = float("inf")
+    for _ in range(repeat):
+        state = setup() if setup else None
+        with contextlib.redirect_stdout(io.StringIO()):
+            t0 = time.perf_counter()
+            func(state)
+            best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def chapter_paths(corpus: Path) -> list:
+    return sorted(p for p in corpus.glob("cap*/cap*.ipynb")
+                  if not any(s in p.stem for s in ("_dist", "_executado", "_fixed", "_aluno", "_epub")))
+
+
+def load_chapters(corpus: Path) -> list:
+    return [json.loads(p.read_text(encoding="utf-8")) for p in chapter_paths(corpus)]
+
+
+def markdown_sources(notebooks: list) -> list:
+    return [conv.source_to_str(c.get("source", []))
+            for nb in notebooks for c in nb.get("cells", [])
+            if c.get("cell_type") == "markdown"]
+
+
+def utf8_len(texts) -> int:
+    return sum(len(t.encode("utf-8")) for t in texts)
+
+
+@scenario("parse_bib")
+def bench_parse_bib(corpus: Path, args) -> dict:
+    text = (corpus / "references.bib").read_text(encoding="utf-8")
+    seconds = timed(args.repeat, lambda _: conv.parse_bibtex(text))
+    return {"seconds": seconds, "cells": 0, "bytes": len(text.encode("utf-8"))}
+
+
+@scenario("build_element_map")
+def bench_build_element_map(corpus: Path, args) -> dict:
+    notebooks = load_chapters(corpus)
+    seconds = timed(args.repeat, lambda _: [conv.build_element_map(nb) for nb in notebooks])
+    return {"seconds": seconds,
+            "cells": sum(len(nb["cells"]) for nb in notebooks),
+            "bytes": utf8_len(markdown_sources(notebooks))}
+
+
+@scenario("process_cell")
+def bench_process_cell(corpus: Path, args) -> dict:
+    bib = conv.parse_bibtex((corpus / "references.bib").read_text(encoding="utf-8"))
+    chapters = []
+    for nb in load_chapters(corpus):
+        elem_map = conv.build_element_map(nb)
+        cells = [c.get("source", []) for c in nb["cells"] if c.get("cell_type") == "markdown"]
+        chapters.append((elem_map, cells))
+
+    def run(_):
+        for elem_map, cells in chapters:
+            for source in cells:
+                conv.process_cell(source, {}, elem_map, bib)
+
+    seconds = timed(args.repeat, run)
+    sources = [conv.source_to_str(s) for _, cells in chapters for s in cells]
+    return {"seconds": seconds, "cells": len(sources), "bytes": utf8_len(sources)}
+
+
+@scenario("convert_callouts")
+def bench_convert_callouts(corpus: Path, args) -> dict:
+    notebooks = load_chapters(corpus)
+    elem_maps = [conv.build_element_map(nb) for nb in notebooks]
+    cells = [(em, conv.source_to_str(c.get("source", [])))
+             for nb, em in zip(notebooks, elem_maps)
+             for c in nb["cells"] if c.get("cell_type") == "markdown"]
+    seconds = timed(args.repeat, lambda _: [conv.convert_callouts(t, em) for em, t in cells])
+    return {"seconds": seconds, "cells": len(cells), "bytes": utf8_len(t for _, t in cells)}
+
+
+@scenario("clean_notebook")
+def bench_clean_notebook(corpus: Path, args) -> dict:
+    raws = [p.read_text(encoding="utf-8") for p in chapter_paths(corpus)]
+    # clean_notebook altera o notebook: cada repeticao recebe copias novas
+    seconds = timed(args.repeat,
+                    lambda notebooks: [conv.clean_notebook(nb) for nb in notebooks],
+                    setup=lambda: [json.loads(r) for r in raws])
+    return {"seconds": seconds,
+            "cells": sum(len(json.loads(r)["cells"]) for r in raws),
+            "bytes": utf8_len(raws)}
+
+
+@scenario("run_batch")
+def bench_run_batch(corpus: Path, args) -> dict:
+    paths = chapter_paths(corpus)
+    bib_path = str((corpus / "references.bib").resolve())
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as out_dir:
+        os.chdir(corpus)
+        try:
+            seconds = timed(args.repeat, lambda _: conv.run_batch(
+                bib_path, out_dir, jobs=args.jobs, force=True))
+        finally:
+            os.chdir(cwd)
+    return {"seconds": seconds,
+            "cells": sum(len(json.loads(p.read_text(encoding="utf-8"))["cells"]) for p in paths),
+            "bytes": sum(p.stat().st_size for p in paths)}
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    own  = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss   # pool --jobs
+    scale = 1 / 1e6 if sys.platform == "darwin" else 1 / 1024       # bytes x KB
+    return max(own, kids) * scale
+
+
+def run_worker(args):
+    """Processo filho: executa um cenario e imprime o resultado em JSON."""
+    result = SCENARIOS[args.worker](args.corpus.resolve(), args)
+    result["peak_rss_mb"] = peak_rss_mb()
+    print(json.dumps(result))
+
+
+def run_scenario(name: str, args) -> dict:
+    cmd = [sys.executable, __file__, "--worker", name, "--corpus", str(args.corpus),
+           "--repeat", str(args.repeat), "--jobs", str(args.jobs)]
+    out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def report(results: dict):
+    print(f"{'cenario':<18} {'tempo (ms)':>11} {'celulas/s':>11} {'MB/s':>8} {'pico RSS (MB)':>14}")
+    for name, r in results.items():
+        cells_s = f"{r['cells'] / r['seconds']:,.0f}" if r["cells"] else "-"
+        mb_s    = r["bytes"] / 1e6 / r["seconds"]
+        rss     = f"{r['peak_rss_mb']:.1f}" if r["peak_rss_mb"] is not None else "-"
+        print(f"{name:<18} {r['seconds'] * 1e3:>11.2f} {cells_s:>11} {mb_s:>8.2f} {rss:>14}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", type=Path,
+                        help="Pasta com cap*/cap*.ipynb e references.bib "
+                             "(padrao: gera um corpus sintetico temporario)")
+    parser.add_argument("--scenarios", nargs="+", choices=sorted(SCENARIOS),
+                        default=list(SCENARIOS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--jobs", type=int, default=1, help="--jobs repassado a run_batch")
+    parser.add_argument("--json", type=Path, help="Grava os resultados neste arquivo")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    synth_notebook.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.worker:
+        return run_worker(args)
+
+    with contextlib.ExitStack() as stack:
+        if args.corpus is None:
+            args.corpus = Path(stack.enter_context(tempfile.TemporaryDirectory()))
+            paths = synth_notebook.generate(args.corpus, args)
+            size = sum(p.stat().st_size for p in paths) / 1e6
+            print(f"Corpus sintetico: {len(paths)} capitulos x {args.cells} celulas, "
+                  f"{size:.1f} MB\n")
+        results = {name: run_scenario(name, args) for name in args.scenarios}
+
+    report(results)
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=1), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
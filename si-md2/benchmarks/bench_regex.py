@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+bench_regex.py
+--------------
+Microbenchmark do registro de regex de gerar_notebooks_alunos.py.
+
+Para cada padrao pre-compilado do modulo (constantes *_RE) mede, sobre as
+linhas Markdown dos capitulos, o custo de chamar o metodo do padrao
+compilado contra a forma antiga re.search(r'...', linha), que consulta o
+cache interno do modulo 're' a cada chamada. Mostra tambem o tempo de
+convert_callouts nas celulas dos capitulos.
+
+    python benchmarks/bench_regex.py [--repeat 5] [cap*/cap*.ipynb ...]
+"""
+
+import argparse
+import glob
+import json
+import re
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import gerar_notebooks_alunos as conv  # noqa: E402
+
+
+def registry() -> dict:
+    """Nome -> padrao compilado (de texto) das constantes *_RE do conversor."""
+    return {name: value for name, value in vars(conv).items()
+            if name.endswith("_RE") and isinstance(value, re.Pattern)
+            and isinstance(value.pattern, str)}
+
+
+def markdown_cells(paths: list) -> list:
+    cells = []
+    for path in paths:
+        notebook = json.loads(Path(path).read_text(encoding="utf-8"))
+        cells += [conv.source_to_str(c.get("source", []))
+                  for c in notebook.get("cells", [])
+                  if c.get("cell_type") == "markdown"]
+    return cells
+
+
+def best_of(repeat: int, func) -> float:
+    """Menor tempo (s) entre 'repeat' execucoes de func()."""
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("notebooks", nargs="*",
+                        help="Notebooks de entrada (padrao: cap*/cap*.ipynb)")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    paths = args.notebooks or sorted(glob.glob("cap*/cap*.ipynb"))
+    if not paths:
+        sys.exit("Nenhum notebook encontrado (rode a partir de si-md2/).")
+    cells = markdown_cells(paths)
+    lines = [l for c in cells for l in c.split("\n")]
+    patterns = registry()
+    print(f"{len(paths)} notebooks, {len(cells)} celulas, {len(lines)} linhas, "
+          f"{len(patterns)} padroes no registro\n")
+
+    print(f"{'padrao':<24} {'inline (us)':>12} {'compilado (us)':>15} {'ganho':>7}")
+    total_inline = total_compiled = 0.0
+    for name, pat in sorted(patterns.items()):
+        source, flags = pat.pattern, pat.flags
+
+        def inline():
+            for l in lines:
+                re.search(source, l, flags)
+
+        def compiled():
+            search = pat.search
+            for l in lines:
+                search(l)
+
+        t_inline, t_compiled = best_of(args.repeat, inline), best_of(args.repeat, compiled)
+        total_inline += t_inline
+        total_compiled += t_compiled
+        print(f"{name:<24} {t_inline * 1e6 / len(lines):>12.3f} "
+              f"{t_compiled * 1e6 / len(lines):>15.3f} {t_inline / t_compiled:>6.2f}x")
+
+    print(f"\n{'total por linha':<24} {total_inline * 1e6 / len(lines):>12.3f} "
+          f"{total_compiled * 1e6 / len(lines):>15.3f} {total_inline / total_compiled:>6.2f}x")
+
+    t = best_of(args.repeat, lambda: [conv.convert_callouts(c, {}) for c in cells])
+    print(f"\nconvert_callouts: {t * 1e3:.2f} ms para {len(cells)} celulas "
+          f"({len(cells) / t:,.0f} celulas/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+bench_scaling.py
+----------------
+Curvas de crescimento de funcoes de gerar_notebooks_alunos.py: cada carga
+gera uma entrada de tamanho n (trechos LaTeX numa celula, linhas de uma
+tabela, ...) e mede o melhor tempo entre --repeat execucoes. A coluna
+'fator' e o aumento do custo por unidade quando n cresce 10x: ~1 e
+linear; ~10 denuncia um termo quadratico.
+
+    python benchmarks/bench_scaling.py
+    python benchmarks/bench_scaling.py --loads md_inline_to_html --sizes 100 1000 10000
+"""
+
+import argparse
+import math
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import gerar_notebooks_alunos as conv  # noqa: E402
+
+
+LOADS = {}
+
+
+def load(name: str, unit: str):
+    """Registra f(n) -> funcao sem argumentos que processa uma entrada de tamanho n."""
+    def register(func):
+        LOADS[name] = (unit, func)
+        return func
+    return register
+
+
+def math_paragraph(n: int) -> str:
+    """Paragrafo de callout com n trechos LaTeX (1 display a cada 10 inline)."""
+    parts = []
+    for i in range(n):
+        if i % 10 == 9:
+            parts.append(f"\n$$\n\\sum_{{j=1}}^{{{i}}} w_j x_j + b\n$$\n")
+        else:
+            parts.append(f"o **peso** $w_{{{i}}}$ multiplica *a entrada* $x_{{{i}}}^2$,")
+    return "> " + " ".join(parts)
+
+
+@load("md_inline_to_html", "trecho LaTeX")
+def bench_md_inline_to_html(n: int):
+    text = math_paragraph(n)
+    return lambda: conv.md_inline_to_html(text)
+
+
+@load("replace_por_marcador", "trecho LaTeX")
+def bench_replace_per_placeholder(n: int):
+    """Referencia: a restauracao antiga, um str.replace por marcador."""
+    placeholders = {f"\x00LATEX{i}\x00": f"\\({i}\\)" for i in range(n)}
+    text = " texto ".join(placeholders)
+
+    def restore():
+        out = text
+        for key, original in placeholders.items():
+            out = out.replace(key, original)
+        return out
+    return restore
+
+
+def markdown_table(n: int) -> str:
+    """Tabela no formato do pandas to_markdown com n linhas de dados."""
+    rows = ["|    | atributo   |   suporte |   confianca |",
+            "|---:|:-----------|----------:|------------:|"]
+    rows += [f"| {i} | item{i % 97}  | {i % 13 / 13:.4f} | {i % 7 / 7:.4f} |" for i in range(n)]
+    return "\n".join(rows)
+
+
+@load("md_table_to_html", "linha")
+def bench_md_table_to_html(n: int):
+    table = markdown_table(n)
+    return lambda: conv.md_table_to_html(table)
+
+
+@load("process_cell_tabela", "linha")
+def bench_process_cell_table(n: int):
+    """Celula com tabela {#tbl-*} dentro de um callout (vira HTML) e legenda."""
+    source = (f"::: {{.callout-note}}\n## Resultado\n\n{markdown_table(n)}\n:::\n\n"
+              f"{markdown_table(n)}\n\n: Regras mineradas {{#tbl-2-1}}")
+    elem_map = {"tbl-2-1": {"kind": "tbl", "num_str": "2.1", "label_prefix": "Tabela 2.1:",
+                            "caption": "Regras mineradas", "content": None}}
+    return lambda: conv.process_cell(source, {}, elem_map, {})
+
+
+@load("layout_tabelas", "tabela")
+def bench_layout_tables(n: int):
+    """::: {layout-ncol=4} com n tabelas pequenas lado a lado."""
+    tables = "\n\n".join(f"| a | b |\n|---|---|\n| {i} | {i + 1} |\n\n: T{i} {{#tbl-9-{i}}}"
+                          for i in range(n))
+    text = f"::: {{layout-ncol=4}}\n{tables}\n:::"
+    return lambda: conv.convert_callouts(text, {})
+
+
+@load("notas_de_rodape", "nota")
+def bench_footnotes(n: int):
+    refs = " ".join(f"texto[^{i}]" for i in range(n))
+    defs = "\n\n".join(f"[^{i}]: Nota {i} com **destaque**." for i in range(n))
+    source = f"{refs}\n\n{defs}"
+    return lambda: conv.process_cell(source, {}, {}, {})
+
+
+def best_of(repeat: int, func) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--loads", nargs="+", choices=sorted(LOADS), default=list(LOADS))
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10, 100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'carga':<22} {'n':>7} {'tempo (ms)':>11} {'us/unidade':>11} {'fator':>6}")
+    for name in args.loads:
+        unit, make = LOADS[name]
+        previous = None
+        for n in sorted(args.sizes):
+            per_unit = best_of(args.repeat, make(n)) / n
+            growth = "-"
+            if previous:
+                # custo por unidade extrapolado para n 10x maior
+                exponent = math.log(10) / math.log(n / previous[0])
+                growth = f"{(per_unit / previous[1]) ** exponent:.1f}"
+            print(f"{name:<22} {n:>7} {per_unit * n * 1e3:>11.2f} "
+                  f"{per_unit * 1e6:>11.3f} {growth:>6}")
+            previous = (n, per_unit)
+        print(f"{'':<22} (unidade: {unit})\n")
+
+
+if __name__ == "__main__":
+    main()
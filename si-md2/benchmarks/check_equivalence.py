@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+check_equivalence.py
+--------------------
+Teste diferencial das reescritas de desempenho de gerar_notebooks_alunos.py:
+cada verificacao gera entradas aleatorias (e, quando faz sentido, usa as
+celulas dos capitulos) e compara a saida do conversor atual com a do mesmo
+arquivo numa versao anterior do git. Por padrao a referencia e o pai do
+primeiro commit do pedido que reescreveu a funcao (ex: [user-001]); --ref
+aceita qualquer commit.
+
+    python benchmarks/check_equivalence.py
+    python benchmarks/check_equivalence.py --checks process_cell --cases 20000 --seed 7
+    python benchmarks/check_equivalence.py --checks convert_callouts --cases 80000
+    python benchmarks/check_equivalence.py --checks md_inline_to_html --cases 3000
+    python benchmarks/check_equivalence.py --ref HEAD~3 cap*/cap*.ipynb
+"""
+
+import argparse
+import contextlib
+import copy
+import glob
+import importlib.util
+import io
+import json
+import random
+import re
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+import gerar_notebooks_alunos as conv  # noqa: E402
+
+
+CHECKS = {}
+
+
+def check(name: str, request: str):
+    """
+    Registra f(rng, args) -> lista de casos (rotulo, funcao, conhecida):
+    funcao(modulo) produz a saida comparada; 'conhecida' marca a entrada que
+    cai num defeito da versao antiga corrigido de proposito (a divergencia e
+    contada a parte). 'request' e o pedido que reescreveu a funcao: a
+    referencia padrao e o commit anterior a ele.
+    """
+    def register(func):
+        CHECKS[name] = (request, func)
+        return func
+    return register
+
+
+def git(*argv) -> str:
+    return subprocess.run(["git", *argv], cwd=ROOT, check=True,
+                          capture_output=True, text=True).stdout
+
+
+def reference_of(request: str) -> str:
+    """Pai do primeiro commit cujo assunto comeca com [request]."""
+    commits = git("log", "--reverse", "--format=%H", "--fixed-strings",
+                  f"--grep=[{request}]").split()
+    if not commits:
+        sys.exit(f"[!] Nenhum commit de [{request}]; use --ref.")
+    return commits[0] + "~1"
+
+
+def load_revision(ref: str, tmp: Path):
+    """Importa gerar_notebooks_alunos.py como estava em 'ref'."""
+    prefix = git("rev-parse", "--show-prefix").strip()
+    path = tmp / f"ref_{len(list(tmp.iterdir()))}.py"
+    path.write_text(git("show", f"{ref}:{prefix}gerar_notebooks_alunos.py"), encoding="utf-8")
+    spec = importlib.util.spec_from_file_location(path.stem, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def outcome(module, func):
+    """Saida de func(module), ou o tipo da excecao (que tambem deve coincidir)."""
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return func(module)
+    except Exception as exc:
+        return ("excecao", type(exc).__name__)
+
+
+def fuzz_text(rng: random.Random, pieces: list, max_pieces: int, seps=(" ", " ", "\n", "\n\n")) -> str:
+    return "".join(rng.choice(pieces) + rng.choice(seps)
+                   for _ in range(rng.randint(1, max_pieces)))
+
+
+# ---------------------------------------------------------------------------
+# process_cell  ([user-001] tokenizador de uma passada)
+# ---------------------------------------------------------------------------
+
+CELL_PIECES = [
+    "texto simples", "@russell2004", "[@han2008]", "[@han2008; @tan2009]", "@fig-1-1",
+    "[-@fig-1-1]", "[Fig. @fig-1-2]", "@tbl-1-1", "@eq-1-1", "\\@relation", "\\@fig-1-1",
+    "@sec-intro", "@lst-x", "@naoexiste", "$x^2$", "$\\textcolor{red}{x}$", "$$\na+b\n$$",
+    "$$\n\\textcolor{blue}{y}=1\n$$ {#eq-1-1}", "$$ z $$\n{#eq-1-2}",
+    "\\textcolor{red}{importante}", "\\textbf{negrito}", "\\textbf{a $x_{1}$ b}",
+    "\\textcolor{red}{$x$ e \\textbf{y}}", "[vermelho]{style=\"color: red;\"}",
+    "[![](images/colab-badge.png){width=\"16%\"}] (https://colab.x/a)",
+    "![](images/b.png){width=\"10%\"}", "![Alt](images/fig.png){#fig-1-1 width=50%}",
+    "![](images/t.png){#tbl-1-2}",
+    "\n| a | b |\n|---|---|\n| $x$ | @han2008 |\n\n: Legenda @fig-1-1 {#tbl-1-1}\n",
+    "\n| c | d |\n|---|---|\n| \\textbf{1} | 2 |\n", "\n## Titulo {.unnumbered}\n",
+    "\n### Sub {#sec-x .cls}\n", "nota[^1] aqui", "\n\n[^1]: Nota com [link](http://a.b) e @tan2009.\n\n",
+    "\n\n[^2]: outra *enfase*\n", "{{< pagebreak >}}\n", "\n\n", "\n", " R$ 10 e R$ 20 ",
+    "`codigo @x`", "**negrito**",
+    "\n::: {.callout-tip}\n## Dica legal\nTexto com $y$ e @russell2004\n:::\n",
+    "\n::: {#fig-1-3}\n![](images/a.png){width=60%}\n\nLegenda @tan2009\n:::\n",
+    "email@exemplo.com", "[texto](http://x.com/@user)", "[ver @fig-1-1 e @tan2009]",
+    "\\textbf{see [@han2008]}",
+]
+
+CELL_ELEMENTS = {
+    "fig-1-1": {"kind": "fig", "num_str": "1.1", "label": "Figura 1.1", "alt": "", "path": "", "content": None},
+    "fig-1-2": {"kind": "fig", "num_str": "1.2", "label": "Figura 1.2", "alt": "", "path": "", "content": None},
+    "fig-1-3": {"kind": "fig", "num_str": "1.3", "label": "Figura 1.3",
+                "label_prefix": "Figura 1.3:", "caption": "", "from_group": True},
+    "tbl-1-1": {"kind": "tbl", "num_str": "1.1", "label": "Tabela 1.1", "label_prefix": "Tabela 1.1:",
+                "caption": "Legenda @fig-1-1 \\textbf{x}", "content": ""},
+    "tbl-1-2": {"kind": "tbl", "num_str": "1.2", "label": "Tabela 1.2", "alt": "", "path": "", "content": None},
+    "eq-1-1":  {"kind": "eq", "num_str": "1.1", "label": "Equação 1.1"},
+}
+
+# Defeitos da versao antiga que o tokenizador corrigiu de proposito: o
+# cabecalho logo apos '{' (o regex antigo o reconhecia no meio da linha,
+# inclusive depois de remover um {{< pagebreak >}}) e a equacao {#eq-*}
+# cujo $$...$$ engolia outro bloco $$ anterior.
+HEADER_AFTER_BRACE_RE = re.compile(r'\{#{1,6}[^\n]+?\s*\{[.#][^}]*\}')
+EQ_SPAN_RE = re.compile(r'\$\$(.+?)\$\$\s*\{#eq-', re.DOTALL)
+
+
+def known_cell_difference(source) -> bool:
+    text = conv.PAGEBREAK_RE.sub("", conv.source_to_str(source))
+    return bool(HEADER_AFTER_BRACE_RE.search(text)) or \
+        any("$$" in m.group(1) for m in EQ_SPAN_RE.finditer(text))
+
+
+# Regressoes: '[' aberto antes de uma figura numerada
+CELL_CASES = [
+    "[@fig-1-1 ![L](images/a.png){#fig-1-1}\n",
+    "Lista [1, 2 e @fig-1-1 ![L](images/a.png){#fig-1-1}",
+    "[ver @fig-1-1] e ![L](images/a.png){#fig-1-1} [@han2008]",
+]
+
+
+def chapter_cells(paths: list) -> list:
+    """(rotulo, source, elem_map) das celulas Markdown dos capitulos, ja limpas."""
+    cells = []
+    for path in paths:
+        notebook = json.loads(Path(path).read_text(encoding="utf-8"))
+        elem_map = conv.build_element_map(notebook)
+        with contextlib.redirect_stdout(io.StringIO()):
+            notebook = conv.clean_notebook(notebook)
+        cells += [(f"{path}#{i}", cell.get("source", []), elem_map)
+                  for i, cell in enumerate(notebook.get("cells", []))
+                  if cell.get("cell_type") == "markdown"]
+    return cells
+
+
+def cell_cases(rng: random.Random, args, regressions_known: bool) -> list:
+    bib = args.bib
+    inputs = chapter_cells(args.chapters)
+    inputs += [(f"regressao {i}", text, CELL_ELEMENTS) for i, text in enumerate(CELL_CASES)]
+    inputs += [(f"aleatorio {i}", fuzz_text(rng, CELL_PIECES, 12), CELL_ELEMENTS)
+               for i in range(args.cases)]
+    return [(label, lambda m, s=source, e=elem_map:
+             m.process_cell(s, {}, copy.deepcopy(e), bib),
+             known_cell_difference(source) or (regressions_known and label.startswith("regressao")))
+            for label, source, elem_map in inputs]
+
+
+@check("process_cell", "user-001")
+def check_process_cell(rng: random.Random, args) -> list:
+    return cell_cases(rng, args, regressions_known=False)
+
+
+@check("process_cell_emissores", "user-025")
+def check_process_cell_emitters(rng: random.Random, args) -> list:
+    """As regressoes caem no '[' do tokenizador de [user-001], corrigido depois do [user-025]."""
+    return cell_cases(rng, args, regressions_known=True)
+
+
+# ---------------------------------------------------------------------------
+# convert_callouts  ([user-011] parser linear de fenced divs)
+# ---------------------------------------------------------------------------
+
+FENCE_PIECES = [
+    "::: {.callout-note}", "::: {.callout-tip}", ":::: {.callout-warning}", ":::", "::::",
+    "  :::", "::: ", "::: {#fig-1-2 layout-ncol=2}", "::: {#fig-1-2a}", "::: {#fig-1-2b}",
+    "::: {#fig-1-3}", "::: {#tbl-1-1}", "::: {layout-ncol=2}", "::: {layout=\"[[1,1]]\"}",
+    "::: {.text-center}", "::: {.foo}", "::: {#fig-1-4} x", "  ::: {.callout-note}", "::: {}",
+    "::::: {.bar}", "## Titulo", "### Outro", "  ## indent", "", "  ", "texto **bold** $x$",
+    "![alt](img.png){width=50%}", "![b](b.png)", "| a | b |", "|---|---|", "| 1 | 2 |",
+    ": Legenda @tbl-1-1 {#tbl-1-1}", "Legenda da figura", "a | ", "{#tbl-1-2}",
+    "  :::: {.callout-tip}", "::: {#tbl-1-5 layout-ncol=2}",
+]
+
+FENCE_ELEMENTS = {
+    "fig-1-2":  {"kind": "fig", "label_prefix": "Figura 1.2:", "label": "Figura 1.2", "num_str": "1.2"},
+    "fig-1-2a": {"kind": "fig", "is_subfig": True, "label_prefix": "(a)", "label": "(a)", "num_str": "1.2a"},
+    "fig-1-2b": {"kind": "fig", "is_subfig": True, "label_prefix": "(b)", "label": "(b)", "num_str": "1.2b"},
+    "fig-1-3":  {"kind": "fig", "label_prefix": "Figura 1.3:", "label": "Figura 1.3", "num_str": "1.3"},
+    "tbl-1-1":  {"kind": "tbl", "label_prefix": "Tabela 1.1:", "label": "Tabela 1.1", "num_str": "1.1"},
+}
+
+
+@check("convert_callouts", "user-011")
+def check_convert_callouts(rng: random.Random, args) -> list:
+    """Linhas de abertura/fecho misturadas; compara tambem o elem_map alterado."""
+    def run(module, text):
+        elem_map = copy.deepcopy(FENCE_ELEMENTS)
+        return module.convert_callouts(text, elem_map), elem_map
+
+    cases = []
+    for i in range(args.cases):
+        text = "\n".join(rng.choice(FENCE_PIECES) for _ in range(rng.randint(1, 30)))
+        if rng.random() < 0.3:
+            text = "\n" + text + "\n  "
+        cases.append((f"aleatorio {i}", lambda m, t=text: run(m, t), False))
+    return cases
+
+
+# ---------------------------------------------------------------------------
+# md_inline_to_html  ([user-024] restauracao do LaTeX em uma passada)
+# ---------------------------------------------------------------------------
+
+INLINE_PIECES = [
+    "texto", "> citado", "$x$", "$x_{1}^2$", "$a*b*c$", "$`x`$", "$$\\sum_i w_i$$",
+    "$$\na+b\n$$", "$$ x $$ e $y$", "R$ 10", "$", "$$", "**negrito**", "**a\nb**",
+    "*italico*", "*a $x$ b*", "**[link](http://a.b)**", "*[link](http://c.d)*",
+    "[texto](http://x.y/$z$)", "[**b**](u)", "`codigo $x$`", "`a*b*`", "\\textcolor{red}{x}",
+    "<span>html</span>", "\\(ja\\)", "\\[ja\\]", "*", "**", "`", "[", "]", "(", ")",
+]
+
+
+@check("md_inline_to_html", "user-024")
+def check_md_inline_to_html(rng: random.Random, args) -> list:
+    texts = [fuzz_text(rng, INLINE_PIECES, 15, seps=(" ", "", "\n")) for _ in range(args.cases)]
+    return [(f"aleatorio {i}", lambda m, t=text: m.md_inline_to_html(t), False)
+            for i, text in enumerate(texts)]
+
+
+# ---------------------------------------------------------------------------
+# md_blocks_to_html e md_table_to_html  ([user-025] emissores de string)
+# ---------------------------------------------------------------------------
+
+BLOCK_PIECES = INLINE_PIECES + [
+    "# Titulo", "### Sub *it*", "- item", "* item **b**", "1. primeiro", "2) segundo",
+    "> citacao", "```python\nx = 1\n```", "```", "$$\nx\n$$", "$$ y $$", "$$",
+    "<figure>\n<img src=\"a.png\">\n</figure>", "<div>", "![alt](img/a.png){width=50%}",
+    "![b](b.png)", "| a | b |\n|---|---|\n| 1 | $x$ |", "| c |", "|---|", "", "   ",
+]
+
+TABLE_PIECES = [
+    "| a | b |", "|---|---|", "|:--|--:|", "| 1 | 2 |", "| $x$ | **b** |", "| só |",
+    "| a | b | c |", "a | b", "|", "||", "| | |", "|    |   x |", "", "  ", "texto",
+    "| `c|d` | e |", "|---:|:---|:---:|",
+]
+
+
+@check("md_blocks_to_html", "user-025")
+def check_md_blocks_to_html(rng: random.Random, args) -> list:
+    texts = [fuzz_text(rng, BLOCK_PIECES, 20, seps=("\n", "\n", "\n\n", " ")) for _ in range(args.cases)]
+    return [(f"aleatorio {i}", lambda m, t=text: m.md_blocks_to_html(t), False)
+            for i, text in enumerate(texts)]
+
+
+@check("md_table_to_html", "user-025")
+def check_md_table_to_html(rng: random.Random, args) -> list:
+    texts = ["\n".join(rng.choice(TABLE_PIECES) for _ in range(rng.randint(1, 12)))
+             for _ in range(args.cases)]
+    return [(f"aleatorio {i}", lambda m, t=text: m.md_table_to_html(t), False)
+            for i, text in enumerate(texts)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("chapters", nargs="*", help="notebooks reais (padrao: cap*/cap*.ipynb)")
+    parser.add_argument("--checks", nargs="+", choices=sorted(CHECKS), default=list(CHECKS))
+    parser.add_argument("--ref", help="commit de referencia (padrao: anterior ao pedido)")
+    parser.add_argument("--cases", type=int, default=5000, help="entradas aleatorias por verificacao")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--show", type=int, default=3, help="divergencias exibidas por verificacao")
+    args = parser.parse_args()
+    args.chapters = args.chapters or sorted(glob.glob(str(ROOT / "cap*" / "cap*.ipynb")))
+    bib_path = ROOT / "references.bib"
+    args.bib = conv.parse_bib(str(bib_path)) if bib_path.exists() else {}
+
+    failed = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in args.checks:
+            request, make_cases = CHECKS[name]
+            ref = args.ref or reference_of(request)
+            old = load_revision(ref, Path(tmp))
+            cases = make_cases(random.Random(args.seed), args)
+            bad = known = 0
+            for label, func, is_known in cases:
+                expected, got = outcome(old, func), outcome(conv, func)
+                if expected != got and is_known:
+                    known += 1
+                elif expected != got:
+                    bad += 1
+                    if bad <= args.show:
+                        print(f"  [{name}] {label}\n    ref:   {expected!r:.600}\n    atual: {got!r:.600}")
+            print(f"{name:<24} ref {git('rev-parse', '--short', ref).strip()}  "
+                  f"{len(cases)} casos  {bad} divergencias  ({known} conhecidas)")
+            failed += bad
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
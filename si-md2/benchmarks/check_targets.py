@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+check_targets.py
+----------------
+Confere que --targets nao muda os notebooks do aluno: converte o livro
+com --batch e com --batch --targets <alvos> e compara os capXX_aluno.ipynb
+byte a byte. Cada capitulo ganha, numa copia temporaria, uma celula que
+cita elementos do capitulo anterior (dentro e fora de callout), para
+exercitar os links entre capitulos do indice global; os links de cada
+alvo devem apontar para arquivos do proprio alvo.
+
+    python benchmarks/check_targets.py
+    python benchmarks/check_targets.py --targets html,md,aluno,epub
+"""
+
+import argparse
+import glob
+import json
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+import gerar_notebooks_alunos as conv  # noqa: E402
+
+LINK_RE = re.compile(r'\.\./(cap[^/"()\s]+/[^#"()\s]+)#')
+
+
+def add_crossref_cells(book: Path) -> int:
+    """Acrescenta a cada capitulo uma celula citando o capitulo anterior; retorna quantas."""
+    paths = sorted(book / p for p in glob.glob("cap*/cap*.ipynb", root_dir=book)
+                   if not any(s in Path(p).stem for s in ("_dist", "_executado", "_fixed")))
+    added, previous = 0, []
+    for path in paths:
+        notebook = json.loads(path.read_text(encoding="utf-8"))
+        if previous:
+            refs = " e ".join(f"@{elem_id}" for elem_id in previous)
+            text = (f"Veja {refs} no capitulo anterior.\n\n"
+                    f"::: {{.callout-note}}\n## Revisao\n\nCompare com {refs}.\n:::\n")
+            notebook["cells"].append({"cell_type": "markdown", "metadata": {},
+                                      "source": conv.str_to_source(text)})
+            path.write_text(json.dumps(notebook, ensure_ascii=False, indent=1), encoding="utf-8")
+            added += 1
+        elem_map = conv.build_element_map(notebook)
+        previous = [k for k, v in elem_map.items() if not v.get("is_subfig")][:2]
+    return added
+
+
+def convert(book: Path, out_dir: str, extra: list):
+    subprocess.run([sys.executable, str(ROOT / "gerar_notebooks_alunos.py"), "--batch",
+                    "references.bib", "--out-dir", out_dir, *extra],
+                   cwd=book, check=True, stdout=subprocess.DEVNULL)
+
+
+def broken_links(out_root: Path, targets: list) -> list:
+    """(arquivo, link) de links entre capitulos para fora do proprio alvo ou inexistentes."""
+    broken = []
+    for target in targets:
+        suffix = conv.TARGETS[target][0]
+        for path in sorted(out_root.glob(f"cap*/*{suffix}")):
+            for link in LINK_RE.findall(path.read_text(encoding="utf-8")):
+                if not link.endswith(suffix) or not (out_root / link).is_file():
+                    broken.append((path.relative_to(out_root), link))
+    return broken
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--targets", type=conv.parse_targets, default=("md", "aluno"),
+                        help="alvos comparados com o --batch (padrao: md,aluno)")
+    args = parser.parse_args()
+    targets = list(args.targets)
+    if "aluno" not in targets:
+        targets.append("aluno")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        book = Path(tmp)
+        for folder in glob.glob("cap*/", root_dir=ROOT) + ["images"]:
+            if (ROOT / folder).is_dir():
+                shutil.copytree(ROOT / folder, book / folder)
+        shutil.copy2(ROOT / "references.bib", book)
+        added = add_crossref_cells(book)
+
+        convert(book, "batch", [])
+        convert(book, "targets", ["--targets", ",".join(targets)])
+
+        differ = [p.relative_to(book / "batch")
+                  for p in sorted((book / "batch").glob("cap*/*_aluno.ipynb"))
+                  if p.read_bytes() != (book / "targets" / p.relative_to(book / "batch")).read_bytes()]
+        broken = broken_links(book / "targets", targets)
+
+    print(f"{added} celulas com links entre capitulos; alvos {','.join(targets)}")
+    for path in differ:
+        print(f"  [!] {path} difere do --batch")
+    for path, link in broken:
+        print(f"  [!] {path}: link para {link}")
+    print(f"{len(differ)} notebooks do aluno divergentes, {len(broken)} links fora do alvo")
+    sys.exit(1 if differ or broken else 0)
+
+
+if __name__ == "__main__":
+    main()
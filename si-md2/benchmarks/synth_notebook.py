@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+synth_notebook.py
+-----------------
+Gera capitulos Quarto sinteticos (capNN/capNN.ipynb + imagens) e um
+references.bib para os benchmarks de gerar_notebooks_alunos.py.
+
+A densidade de cada recurso e configuravel: figuras, tabelas e equacoes
+numeradas, profundidade de callouts aninhados, citacoes por paragrafo e
+tamanho do blob base64 dos outputs das celulas de codigo.
+
+    python benchmarks/synth_notebook.py /tmp/corpus --chapters 3 --cells 300
+"""
+
+import argparse
+import base64
+import json
+import random
+from pathlib import Path
+
+# PNG 1x1 valido: as imagens referenciadas existem e copy_images as encontra
+TINY_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+)
+
+WORDS = ("dados mineracao regra suporte confianca arvore decisao classe atributo "
+         "instancia modelo treino teste conjunto frequente algoritmo cluster "
+         "distancia media variancia rede neural peso ativacao erro").split()
+
+
+def synth_bib(n_entries: int) -> str:
+    """references.bib com n_entries obras (chaves ref0000, ref0001, ...)."""
+    rng, out = random.Random(1), []
+    for i in range(n_entries):
+        n_auth  = rng.choice((1, 2, 2, 3, 4))
+        authors = " and ".join(f"Sobrenome{rng.randrange(999)}, N. {chr(65 + k)}."
+                               for k in range(n_auth))
+        out.append(
+            f"@book{{ref{i:04d},\n"
+            f"  title={{Titulo {{Composto}} da Obra {i}}},\n"
+            f"  author={{{authors}}},\n"
+            f"  year={{{1990 + i % 35}}},\n"
+            f"  publisher={{Editora {i % 17}}}\n"
+            f"}}\n"
+        )
+    return "\n".join(out)
+
+
+class ChapterSynth:
+    """Monta as celulas de um capitulo com os parametros de densidade."""
+
+    def __init__(self, chap: int, args, rng: random.Random):
+        self.chap, self.args, self.rng = chap, args, rng
+        self.counts = {"fig": 0, "tbl": 0, "eq": 0}
+        self.images = set()
+
+    def _new_id(self, kind: str) -> str:
+        self.counts[kind] += 1
+        return f"{kind}-{self.chap}-{self.counts[kind]}"
+
+    def _ref(self) -> str:
+        """@fig/@tbl/@eq para um elemento ja definido (ou texto comum)."""
+        kinds = [k for k, n in self.counts.items() if n]
+        if not kinds:
+            return "o texto"
+        kind = self.rng.choice(kinds)
+        return f"@{kind}-{self.chap}-{self.rng.randint(1, self.counts[kind])}"
+
+    def _cite(self) -> str:
+        keys = [f"ref{self.rng.randrange(self.args.bib_entries):04d}"
+                for _ in range(self.rng.choice((1, 1, 2, 3)))]
+        if self.rng.random() < 0.5:
+            return f"@{keys[0]}"
+        return "[" + "; ".join(f"@{k}" for k in keys) + "]"
+
+    def paragraph(self) -> str:
+        rng, words = self.rng, []
+        for _ in range(rng.randint(30, 70)):
+            words.append(rng.choice(WORDS))
+            r = rng.random()
+            if r < self.args.cite_density / 40:
+                words.append(self._cite())
+            elif r < 0.03:
+                words.append(f"$x_{{{rng.randrange(9)}}}^2$")
+            elif r < 0.04:
+                words.append(f"**{rng.choice(WORDS)}**")
+            elif r < 0.05:
+                words.append(self._ref())
+            elif r < 0.055:
+                words.append(r"\textcolor{red}{" + rng.choice(WORDS) + "}")
+        return " ".join(words) + "."
+
+    def figure(self) -> str:
+        elem_id = self._new_id("fig")
+        path = f"images/{elem_id}.png"
+        self.images.add(path)
+        return f"![Legenda da {elem_id}]({path}){{#{elem_id} width=60%}}"
+
+    def table(self) -> str:
+        elem_id = self._new_id("tbl")
+        rows = ["| A | B | C |", "|:-:|:-:|:-:|"]
+        rows += [f"| {i} | {self.rng.random():.3f} | $x_{i}$ |" for i in range(8)]
+        return "\n".join(rows) + f"\n\n: Tabela sintetica com {self._cite()} {{#{elem_id}}}"
+
+    def equation(self) -> str:
+        elem_id = self._new_id("eq")
+        return ("$$\n\\textcolor{blue}{y} = \\sum_{i=1}^{n} w_i x_i + b\n$$ "
+                f"{{#{elem_id}}}")
+
+    def callout(self, depth: int) -> str:
+        kind  = self.rng.choice(("note", "tip", "warning", "important", "caution"))
+        fence = ":" * (3 + depth)
+        inner = f"### Titulo {depth}\n\n{self.paragraph()}"
+        if depth > 1:
+            inner += "\n\n" + self.callout(depth - 1)
+        return f"{fence} {{.callout-{kind}}}\n{inner}\n{fence}"
+
+    def markdown_cell(self) -> str:
+        a, rng = self.args, self.rng
+        parts = [self.paragraph()]
+        if rng.random() < a.fig_density:
+            parts.append(self.figure())
+        if rng.random() < a.tbl_density:
+            parts.append(self.table())
+        if rng.random() < a.eq_density:
+            parts.append(self.equation())
+        if a.callout_depth and rng.random() < a.callout_density:
+            parts.append(self.callout(a.callout_depth))
+        if rng.random() < 0.02:
+            n = rng.randrange(1, 9)
+            parts.append(f"Nota[^{n}].\n\n[^{n}]: Nota de rodape com {self._cite()}.")
+        return "\n\n".join(parts)
+
+    def code_cell(self) -> dict:
+        lines = ["import numpy as np", "x = np.arange(10)", "x.mean()"]
+        outputs = []
+        if self.args.blob_kb and self.rng.random() < 0.5:
+            elem_id = self._new_id("fig")
+            lines = [f"#| label: {elem_id}", f'#| fig-cap: "Grafico {elem_id}"',
+                     "#| echo: false"] + lines
+            blob = base64.b64encode(self.rng.randbytes(self.args.blob_kb * 768)).decode()
+            outputs.append({
+                "output_type": "display_data", "metadata": {},
+                "data": {"image/png": blob, "text/plain": ["<Figure>"]},
+            })
+        return {"cell_type": "code", "execution_count": 1, "metadata": {},
+                "outputs": outputs,
+                "source": [l + "\n" for l in lines[:-1]] + [lines[-1]]}
+
+    def notebook(self) -> dict:
+        cells = [{"cell_type": "raw", "metadata": {},
+                  "source": ["---\n", f"title: Capitulo {self.chap}\n", "---"]},
+                 {"cell_type": "markdown", "metadata": {},
+                  "source": [f"# Capitulo {self.chap} {{.unnumbered}}"]}]
+        for _ in range(self.args.cells):
+            if self.rng.random() < self.args.code_ratio:
+                cells.append(self.code_cell())
+            else:
+                src = self.markdown_cell()
+                cells.append({"cell_type": "markdown", "metadata": {},
+                              "source": src.splitlines(keepends=True)})
+        cells.append({"cell_type": "markdown", "metadata": {},
+                      "source": ["## Referências do Capítulo\n", "\n", "\\printbibliography"]})
+        return {"cells": cells, "metadata": {"quarto": {}}, "nbformat": 4,
+                "nbformat_minor": 5}
+
+
+def generate(out_dir: Path, args) -> list:
+    """Escreve o corpus em out_dir e retorna os caminhos dos notebooks."""
+    out_dir.mkdir(parents=True, exist_ok=True)
+    (out_dir / "references.bib").write_text(synth_bib(args.bib_entries), encoding="utf-8")
+    paths = []
+    for chap in range(1, args.chapters + 1):
+        synth = ChapterSynth(chap, args, random.Random(args.seed * 1000 + chap))
+        cap_dir = out_dir / f"cap{chap:02d}"
+        nb_path = cap_dir / f"cap{chap:02d}.ipynb"
+        nb = synth.notebook()
+        (cap_dir / "images").mkdir(parents=True, exist_ok=True)
+        for img in synth.images:
+            (cap_dir / img).write_bytes(TINY_PNG)
+        nb_path.write_text(json.dumps(nb, ensure_ascii=False, indent=1), encoding="utf-8")
+        paths.append(nb_path)
+    return paths
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Parametros do gerador (compartilhados com bench_converter.py)."""
+    g = parser.add_argument_group("corpus sintetico")
+    g.add_argument("--chapters", type=int, default=3)
+    g.add_argument("--cells", type=int, default=300, help="celulas por capitulo")
+    g.add_argument("--code-ratio", type=float, default=0.2)
+    g.add_argument("--fig-density", type=float, default=0.15, help="prob. por celula markdown")
+    g.add_argument("--tbl-density", type=float, default=0.1)
+    g.add_argument("--eq-density", type=float, default=0.15)
+    g.add_argument("--callout-depth", type=int, default=2, help="niveis de aninhamento")
+    g.add_argument("--callout-density", type=float, default=0.1)
+    g.add_argument("--cite-density", type=float, default=1.0,
+                   help="citacoes por paragrafo (media aproximada)")
+    g.add_argument("--blob-kb", type=int, default=64,
+                   help="KB base64 do image/png nas celulas de codigo (0 = sem outputs)")
+    g.add_argument("--bib-entries", type=int, default=200)
+    g.add_argument("--seed", type=int, default=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("out_dir", type=Path)
+    add_arguments(parser)
+    args = parser.parse_args()
+    for p in generate(args.out_dir, args):
+        print(f"{p}  ({p.stat().st_size / 1e6:.2f} MB)")
+
+
+if __name__ == "__main__":
+    main()
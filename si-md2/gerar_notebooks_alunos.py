@@ -11,7 +11,16 @@ Zero dependencias externas.
     python quarto_ipynb_refs.py <notebook.ipynb> <references.bib> [-o saida.ipynb]
 
 --- MODO BATCH ---
-    python quarto_ipynb_refs.py --batch <references.bib> [--out-dir notebooks_alunos]
+    python quarto_ipynb_refs.py --batch <references.bib> [--out-dir notebooks_alunos] [--jobs N] [--force]
+                                [--profile [--profile-json ARQ]]
+                                [--optimize-images [--max-width PX] [--webp]]   (requer Pillow)
+                                [--outputs MODO] [--outputs-cap capXX=MODO ...] [--html-limit KB]
+                                [--inline-images [--inline-as attachment|data-uri]]
+                                [--watch] [--targets aluno,epub,md,html] [--cell-cache-mb MB]
+
+--- VARIOS ALVOS (uma analise por capitulo) ---
+    python quarto_ipynb_refs.py --targets aluno,epub,md,html <references.bib>
+        -> capXX_aluno.ipynb, capXX_epub.ipynb, capXX.md e capXX.html
 
 Sintaxe Quarto suportada:
     Citacao direta:          @russell2004              -> Russell e Norvig (2004)
@@ -28,29 +37,188 @@ Sintaxe Quarto suportada:
     Div generico:            ::: {.qualquer} ... :::    -> conteudo sem marcas
 """
 
+import base64
+import contextlib
+import ctypes
+import ctypes.util
+import functools
+import io
 import json
+import mmap
+import os
+import pickle
 import re
+import select
 import shutil
+import stat
+import struct
+import sys
+import threading
+import time
 import argparse
 import glob
+import hashlib
+from html import escape
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
+try:                            # opcional: so para --optimize-images
+    from PIL import Image
+except ImportError:
+    Image = None
+
 
 # ---------------------------------------------------------------------------
 # 1. Parser BibTeX
 # ---------------------------------------------------------------------------
 
+# Varredura com chaves balanceadas: @string (macros), @comment/@preamble
+# (ignorados), valores {..}, ".." ou numero/macro e concatenacao com #.
+# O valor guarda as chaves internas como no .bib ({IEEE} continua {IEEE}).
+
+_BIB_AT_RE     = re.compile(r'@\s*(\w+)\s*([{(])')
+_BIB_KEY_RE    = re.compile(r'\s*([^\s,})]+)\s*')
+_BIB_SEP_RE    = re.compile(r'[\s,]*')
+_BIB_FIELD_RE  = re.compile(r'([^\s=,{}()"#]+)\s*=\s*')
+_BIB_BARE_RE   = re.compile(r'[^\s,{}()"#]+')
+_BIB_SPACE_RE  = re.compile(r'\s*')
+_BIB_BRACE_RE  = re.compile(r'[{}]')
+_BIB_FLAT_RE   = re.compile(r'\{([^{}]*)\}')     # caso comum: sem chaves internas
+_BIB_SIMPLE_RE = re.compile(r'([^\s=,{}()"#]+)\s*=\s*\{([^{}]*)\}\s*(?=[,})])')
+_BIB_QUOTED_RE = re.compile(r'[{}"]')
+
+
+def parse_bibtex(text: str, source: str = "bib") -> dict:
+    """Converte o texto BibTeX em {chave: {campo: valor}} (campos em minusculas)."""
+    entries, strings = {}, {}
+
+    def skip_space(pos):
+        return _BIB_SPACE_RE.match(text, pos).end()
+
+    def braced(pos):
+        """text[pos] == '{' -> (conteudo, posicao apos a '}' correspondente)."""
+        flat = _BIB_FLAT_RE.match(text, pos)
+        if flat:
+            return flat.group(1), flat.end()
+        depth = 0
+        for m in _BIB_BRACE_RE.finditer(text, pos):
+            depth += 1 if m.group() == "{" else -1
+            if depth == 0:
+                return text[pos + 1:m.start()], m.end()
+        raise ValueError("'{' sem fechamento")
+
+    def quoted(pos):
+        """text[pos] == '"' -> (conteudo, posicao apos o '"' final)."""
+        depth = 0
+        for m in _BIB_QUOTED_RE.finditer(text, pos + 1):
+            c = m.group()
+            if c == '"' and depth == 0:
+                return text[pos + 1:m.start()], m.end()
+            depth += 1 if c == "{" else -1 if c == "}" else 0
+        raise ValueError("'\"' sem fechamento")
+
+    def value(pos):
+        """Valor com concatenacao: parte # parte # ... -> (str, posicao)."""
+        parts = []
+        while True:
+            pos = skip_space(pos)
+            c = text[pos:pos + 1]
+            if c == "{":
+                part, pos = braced(pos)
+            elif c == '"':
+                part, pos = quoted(pos)
+            else:
+                m = _BIB_BARE_RE.match(text, pos)
+                if not m:
+                    raise ValueError("valor ausente")
+                name, pos = m.group(), m.end()
+                part = name if name.isdigit() else strings.get(name.lower(), name)
+            parts.append(part)
+            pos = skip_space(pos)
+            if text[pos:pos + 1] != "#":
+                return "".join(parts).strip(), pos
+            pos += 1
+
+    def fields(pos, close):
+        """Lista campo = valor ate o delimitador de fechamento."""
+        result = {}
+        while True:
+            pos = _BIB_SEP_RE.match(text, pos).end()
+            if text[pos:pos + 1] == close:
+                return result, pos + 1
+            m = _BIB_SIMPLE_RE.match(text, pos)      # campo = {valor simples}
+            if m:
+                result[m.group(1).lower()], pos = m.group(2).strip(), m.end()
+                continue
+            m = _BIB_FIELD_RE.match(text, pos)
+            if not m:
+                raise ValueError("campo malformado")
+            result[m.group(1).lower()], pos = value(m.end())
+
+    pos = 0
+    while True:
+        m = _BIB_AT_RE.search(text, pos)
+        if not m:
+            return entries
+        kind, close = m.group(1).lower(), "}" if m.group(2) == "{" else ")"
+        try:
+            if kind in ("comment", "preamble"):
+                if close == "}":
+                    _, pos = braced(m.end() - 1)
+                else:
+                    pos = text.index(")", m.end()) + 1
+            elif kind == "string":
+                macros, pos = fields(m.end(), close)
+                strings.update(macros)
+            else:
+                k = _BIB_KEY_RE.match(text, m.end())
+                if not k:
+                    raise ValueError("chave ausente")
+                key, pos = k.group(1), k.end()
+                if text[pos:pos + 1] == ",":
+                    pos += 1
+                entries[key], pos = fields(pos, close)
+        except ValueError as e:
+            line = text.count("\n", 0, m.start()) + 1
+            print(f"  [!] {source}:{line}: entrada @{kind} ignorada ({e})")
+            pos = m.end()
+
+
+# Indice binario ao lado do .bib (references.bib -> references.bib.pickle),
+# validado por mtime/tamanho e, se eles mudarem, pelo hash do conteudo.
+BIB_INDEX_VERSION = 1
+
+
 def parse_bib(bib_path: str) -> dict:
-    text = Path(bib_path).read_text(encoding="utf-8")
-    entries = {}
-    entry_re = re.compile(r'@\w+\s*\{\s*([^,]+),\s*(.*?)\n\}', re.DOTALL)
-    field_re = re.compile(r'(\w+)\s*=\s*\{([^{}]*(?:\{[^{}]*\}[^{}]*)*)\}', re.DOTALL)
-    for m in entry_re.finditer(text):
-        key  = m.group(1).strip()
-        body = m.group(2)
-        fields = {f.group(1).lower(): f.group(2).strip()
-                  for f in field_re.finditer(body)}
-        entries[key] = fields
+    path       = Path(bib_path)
+    index_path = path.with_name(path.name + ".pickle")
+    st    = path.stat()
+    stamp = (st.st_mtime_ns, st.st_size)
+    index = None
+    try:
+        with open(index_path, "rb") as f:
+            index = pickle.load(f)
+        if index.get("version") != BIB_INDEX_VERSION:
+            index = None
+        elif index.get("stamp") == stamp:
+            return index["entries"]
+    except (OSError, EOFError, ValueError, TypeError, AttributeError,
+            pickle.UnpicklingError):
+        index = None
+
+    raw    = path.read_bytes()
+    digest = hashlib.sha256(raw).hexdigest()
+    if index is not None and index.get("sha256") == digest:
+        entries = index["entries"]          # so o mtime mudou (checkout, touch)
+    else:
+        entries = parse_bibtex(raw.decode("utf-8"), path.name)
+    try:
+        with open(index_path, "wb") as f:
+            pickle.dump({"version": BIB_INDEX_VERSION, "stamp": stamp,
+                         "sha256": digest, "entries": entries},
+                        f, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        pass                                # pasta somente leitura: sem indice
     return entries
 
 
@@ -142,19 +310,13 @@ def cite_direct(fields: dict) -> str:
     return f"{name_part} ({year})"
 
 
-def cite_indirect(fields: dict) -> str:
-    """
-    Citacao INDIRETA: autor e ano entre parenteses, sobrenome em caixa alta.
-    ABNT NBR 10520:
-      1 autor:  (FOROUZAN, 2011)
-      2 autores: (FOROUZAN; MOSHARRAF, 2011)
-      3+ autores: (TAN et al., 2009)
-    """
+def _indirect_part(fields: dict) -> str:
+    """Trecho de uma obra na citacao indireta: 'FOROUZAN; MOSHARRAF, 2011'."""
     year = fields.get("year", "s.d.")
     surnames = _last_names(fields.get("author", ""))
 
     if not surnames:
-        return f"({year})"
+        return year
 
     upper = [s.upper() for s in surnames]
 
@@ -165,7 +327,73 @@ def cite_indirect(fields: dict) -> str:
     else:
         name_part = f"{upper[0]} et al."
 
-    return f"({name_part}, {year})"
+    return f"{name_part}, {year}"
+
+
+def cite_indirect(fields: dict) -> str:
+    """
+    Citacao INDIRETA: autor e ano entre parenteses, sobrenome em caixa alta.
+    ABNT NBR 10520:
+      1 autor:  (FOROUZAN, 2011)
+      2 autores: (FOROUZAN; MOSHARRAF, 2011)
+      3+ autores: (TAN et al., 2009)
+    """
+    return f"({_indirect_part(fields)})"
+
+
+CITE_KEY_SEP_RE = re.compile(r'[;,]')     # [@a; @b] ou [@a, @b]
+
+
+class CitationRenderer:
+    """
+    Tabela de citacoes de uma bibliografia. Para cada chave guarda a citacao
+    direta, o trecho da indireta e a referencia completa (format_entry),
+    calculados na primeira consulta e mantidos num LRU de 'maxsize' chaves;
+    grupos [@a; @b] ja montados tambem ficam num LRU.
+    """
+
+    def __init__(self, bib: dict, maxsize: int = 4096):
+        self.bib = bib
+        self._entry = functools.lru_cache(maxsize=maxsize)(self._build_entry)
+        self.indirect = functools.lru_cache(maxsize=maxsize)(self._indirect)
+
+    def _build_entry(self, key: str):
+        fields = self.bib.get(key)
+        if fields is None:
+            return None
+        return cite_direct(fields), _indirect_part(fields), format_entry(key, fields)
+
+    def direct(self, key: str) -> str:
+        """@key -> Autor (ano), ou ?key se a chave nao esta no .bib."""
+        entry = self._entry(key)
+        return entry[0] if entry else f"?{key}"
+
+    def _indirect(self, keys_text: str) -> str:
+        """'@key1; @key2' (conteudo de [...]) -> (AUTOR1, ano; AUTOR2, ano)."""
+        parts = []
+        for k in CITE_KEY_SEP_RE.split(keys_text):
+            k = k.strip().lstrip("@").strip()
+            if not k:
+                continue
+            entry = self._entry(k)
+            parts.append(entry[1] if entry else f"?{k}")
+        return "(" + "; ".join(parts) + ")"
+
+    def reference(self, key: str) -> str:
+        """Referencia completa (ABNT) de uma chave existente no .bib."""
+        return self._entry(key)[2]
+
+
+# Renderer da ultima bibliografia usada: reaproveitado entre celulas e
+# capitulos enquanto o mesmo dict de parse_bib for passado adiante.
+_citation_renderer = None
+
+
+def citation_renderer(bib: dict) -> CitationRenderer:
+    global _citation_renderer
+    if _citation_renderer is None or _citation_renderer.bib is not bib:
+        _citation_renderer = CitationRenderer(bib)
+    return _citation_renderer
 
 # ---------------------------------------------------------------------------
 # 3. Utilitarios de source Jupyter
@@ -183,6 +411,233 @@ def str_to_source(text: str) -> list:
     return text.splitlines(keepends=True)
 
 
+class Emitter:
+    """
+    Saida dos renderizadores HTML/Markdown: os trechos vao para uma lista e
+    sao juntados uma unica vez em text(). Crescer uma string com += copia
+    tudo o que ja foi emitido a cada trecho (quadratico numa tabela longa).
+    """
+    __slots__ = ("parts", "sep")
+
+    def __init__(self, sep: str = ""):
+        self.parts = []
+        self.sep = sep
+
+    def write(self, *parts: str):
+        self.parts += parts
+
+    def text(self) -> str:
+        """Junta os trechos; com separador, os vazios sao ignorados."""
+        if self.sep:
+            return self.sep.join(filter(None, self.parts))
+        return "".join(self.parts)
+
+    def __bool__(self):
+        return any(self.parts)
+
+
+# ---------------------------------------------------------------------------
+# 3b. Leitura/escrita de .ipynb com passagem direta dos blobs de saida
+# ---------------------------------------------------------------------------
+# Imagens (base64) e PDFs embutidos nos outputs sao a maior parte do .ipynb
+# e nunca sao alterados pela conversao. read_notebook mapeia o arquivo com
+# mmap e troca cada um desses valores JSON por um marcador curto antes do
+# json.loads; write_notebook copia os bytes originais de volta no lugar do
+# marcador. O blob nao vira str Python nem entra no parse.
+
+_JSON_STR = rb'"[^"\\]*(?:\\.[^"\\]*)*"'
+OUTPUT_BLOB_RE = re.compile(
+    rb'"(?:image/(?:png|jpeg|gif|webp|bmp|tiff)|application/pdf)"\s*:\s*('
+    + _JSON_STR + rb'|\[\s*' + _JSON_STR + rb'(?:\s*,\s*' + _JSON_STR + rb')*\s*\])'
+)
+BLOB_MARKER = "\x00ipynb-blob:{}"
+BLOB_MARKER_RE = re.compile(r'"\\u0000ipynb-blob:(\d+)"')
+
+
+class NotebookBlobs:
+    """Trechos (inicio, fim) do arquivo de origem guardados por read_notebook."""
+
+    def __init__(self, data, spans: list, path: Path = None):
+        self.data  = data           # mmap (ou bytes) do .ipynb de origem
+        self.spans = spans
+        self.path  = path
+
+    def load(self, value):
+        """Valor JSON original de um marcador (outros valores voltam como estao)."""
+        if isinstance(value, str) and value.startswith(BLOB_MARKER[:-2]):
+            start, end = self.spans[int(value[len(BLOB_MARKER) - 2:])]
+            return json.loads(bytes(self.data[start:end]).decode("utf-8"))
+        return value
+
+    def close(self):
+        if hasattr(self.data, "close"):
+            self.data.close()
+
+
+def read_notebook(nb_path: Path) -> tuple:
+    """Retorna (notebook, blobs) sem decodificar os blobs de saida."""
+    with open(nb_path, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:          # arquivo vazio nao pode ser mapeado
+            data = f.read()
+    parts, spans, pos = [], [], 0
+    for m in OUTPUT_BLOB_RE.finditer(data):
+        parts.append(data[pos:m.start(1)])
+        parts.append(json.dumps(BLOB_MARKER.format(len(spans))).encode("ascii"))
+        spans.append((m.start(1), m.end(1)))
+        pos = m.end(1)
+    parts.append(data[pos:])
+    notebook = json.loads(b"".join(parts).decode("utf-8"))
+    return notebook, NotebookBlobs(data, spans, nb_path)
+
+
+def write_notebook(notebook: dict, out_path: Path, blobs: NotebookBlobs = None):
+    """
+    Grava o notebook (indent=1, como o Jupyter) recolocando os blobs.
+    Escreve num arquivo temporario e renomeia: a saida pode ser a propria
+    origem ainda mapeada em memoria, que entao e fechada antes da troca.
+    """
+    text = json.dumps(notebook, ensure_ascii=False, indent=1)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = out_path.with_name(out_path.name + ".tmp")
+    with open(tmp_path, "wb") as out:
+        pos = 0
+        for m in BLOB_MARKER_RE.finditer(text) if blobs else ():
+            out.write(text[pos:m.start()].encode("utf-8"))
+            start, end = blobs.spans[int(m.group(1))]
+            with memoryview(blobs.data) as view:
+                out.write(view[start:end])
+            pos = m.end()
+        out.write(text[pos:].encode("utf-8"))
+    if blobs and blobs.path is not None and Path(blobs.path).resolve() == out_path.resolve():
+        blobs.close()
+    os.replace(tmp_path, out_path)
+
+
+# ---------------------------------------------------------------------------
+# 3c. Perfil por estagio (--profile)
+# ---------------------------------------------------------------------------
+# Com --profile, cada capitulo ganha um StageProfiler: os estagios de
+# process_notebook e as sub-passagens de process_cell (process_cell.*)
+# acumulam tempo nele; a copia das imagens, feita em threads, entra depois
+# no trace (add_copy_stage). Sem --profile, profile_stage devolve um
+# contexto vazio e nada e medido.
+
+PROFILE_TRACE_VERSION = 1
+
+
+class StageProfiler:
+    """Tempo acumulado por estagio e por celula de um capitulo."""
+
+    def __init__(self, notebook: str):
+        self.notebook = notebook
+        self.stages   = {}          # nome -> [segundos, chamadas] (ordem de 1o uso)
+        self.cells    = []          # [indice, segundos, caracteres] por process_cell
+        self.total    = 0.0
+
+    def add(self, name: str, seconds: float, calls: int = 1):
+        entry = self.stages.setdefault(name, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += calls
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t0)
+
+    def _ordered(self) -> list:
+        """Estagios em arvore: process_cell.tokens.img logo abaixo de process_cell."""
+        first = {name: i for i, name in enumerate(self.stages)}
+        def key(name):
+            parts = name.split(".")
+            return tuple(first.get(".".join(parts[:i + 1]), first[name])
+                         for i in range(len(parts)))
+        return sorted(self.stages, key=key)
+
+    def trace(self) -> dict:
+        return {
+            "notebook": self.notebook,
+            "total_ms": round(self.total * 1e3, 3),
+            "stages":   {name: {"ms": round(self.stages[name][0] * 1e3, 3),
+                                "calls": self.stages[name][1]}
+                         for name in self._ordered()},
+            "cells":    [{"index": i, "ms": round(s * 1e3, 3), "chars": n}
+                         for i, s, n in self.cells],
+        }
+
+
+def profile_table(trace: dict, slowest_cells: int = 3) -> str:
+    """Tabela do trace de um capitulo (estagios em arvore e celulas mais lentas)."""
+    total = trace["total_ms"]
+    lines = [f"  Perfil: {total:.1f} ms",
+             f"    {'estagio':<34} {'ms':>9} {'%':>6} {'chamadas':>9}"]
+    measured = 0.0
+    for name, stage in trace["stages"].items():
+        ms, depth = stage["ms"], name.count(".")
+        if not depth:
+            measured += ms
+        label = ("  " * depth + name.rsplit(".", 1)[-1])[:34]
+        pct = 100 * ms / total if total else 0.0
+        lines.append(f"    {label:<34} {ms:>9.2f} {pct:>5.1f}% {stage['calls']:>9}")
+    rest = max(total - measured, 0.0)
+    pct = 100 * rest / total if total else 0.0
+    lines.append(f"    {'(fora dos estagios)':<34} {rest:>9.2f} {pct:>5.1f}%")
+    for cell in sorted(trace["cells"], key=lambda c: -c["ms"])[:slowest_cells]:
+        lines.append(f"    celula #{cell['index']}: {cell['ms']:.2f} ms ({cell['chars']} caracteres)")
+    return "\n".join(lines)
+
+
+def add_copy_stage(trace: dict, seconds: float):
+    """Soma ao trace o tempo de copia das imagens do capitulo (feita em threads)."""
+    ms = round(seconds * 1e3, 3)
+    trace["stages"]["copy_images"] = {"ms": ms, "calls": 1}
+    trace["total_ms"] = round(trace["total_ms"] + ms, 3)
+
+
+_profiler = None        # StageProfiler do capitulo em conversao (ou None)
+
+
+def profile_stage(name: str):
+    """Contexto que mede 'name' no capitulo atual; vazio sem --profile."""
+    return _profiler.stage(name) if _profiler else contextlib.nullcontext()
+
+
+@contextlib.contextmanager
+def profiling(nb_path: Path, traces: list = None):
+    """
+    Mede a conversao de um capitulo e acrescenta o trace em 'traces' (a
+    tabela sai com o log do capitulo, depois da copia das imagens, ver
+    add_copy_stage). Com traces=None (sem --profile) nao faz nada.
+    """
+    global _profiler
+    if traces is None:
+        yield
+        return
+    _profiler = prof = StageProfiler(str(nb_path))
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        _profiler = None
+    prof.total = time.perf_counter() - t0
+    traces.append(prof.trace())
+
+
+def write_profile_trace(trace_path: Path, traces: list):
+    """Grava o trace JSON de todos os capitulos medidos."""
+    trace_path.parent.mkdir(parents=True, exist_ok=True)
+    trace_path.write_text(
+        json.dumps({"version": PROFILE_TRACE_VERSION, "chapters": traces},
+                   ensure_ascii=False, indent=1),
+        encoding="utf-8"
+    )
+    print(f"Perfil ({len(traces)} capitulos) gravado em '{trace_path}'")
+
+
 # ---------------------------------------------------------------------------
 # 4. Prefixos de cross-references Quarto (nao sao citacoes bibliograficas)
 # ---------------------------------------------------------------------------
@@ -243,6 +698,9 @@ EQ_DEF_RE = re.compile(
     r'\{#(eq-[\w-]+)[^}]*\}',    # {#eq-X-Y}
 )
 
+# Celula de codigo com figura/tabela:  #| label: fig-X-Y  (ou tbl-X-Y)
+CODE_LABEL_RE = re.compile(r'#\|\s*label:\s*((fig|tbl)-[\w-]+)')
+
 # ---------------------------------------------------------------------------
 # Callouts e divs Quarto:  ::: {.callout-*}  ...  :::
 # Suporta callout-note, callout-tip, callout-warning, callout-important,
@@ -259,10 +717,47 @@ CALLOUT_STYLE = {
 }
 
 # Regex para abertura de bloco div/callout: ::: {.classe ...} ou ::: {#id .classe}
-DIV_OPEN_RE = re.compile(
-    r'^:::+\s*\{([^}]*)\}\s*$',
+# Grupos: (1) cerca ':::'  (2) atributos
+DIV_OPEN_RE = re.compile(r'^(:::+)\s*\{([^}]*)\}\s*$')
+# Linhas dentro do bloco: qualquer abertura ::: {  /  fechamento :::
+DIV_FENCE_START_RE = re.compile(r'^(:::+)\s*\{')
+DIV_FENCE_CLOSE_RE = re.compile(r'^(:::+)\s*$')
+# Titulo do callout: primeira linha '## Titulo' dentro do bloco
+CALLOUT_TITLE_RE = re.compile(r'^#{1,4}\s+(.+)$')
+# Id de grupo nos atributos: {#fig-2-2 layout-ncol=2}
+GROUP_ID_RE = re.compile(r'#((?:fig|tbl)-[\w-]+)')
+LAYOUT_NCOL_RE = re.compile(r'layout-ncol\s*=\s*(\d+)')
+# Subfiguras ::: {#fig-2-2a} dentro de um grupo
+SUBFIG_FENCE_RE = re.compile(r':::+\s*\{#(?:fig|tbl)-[\w-]+\}')
+SUBFIG_IDS_RE = re.compile(r'^:::+\s*\{#((fig|tbl)-[\w-]+)', re.MULTILINE)
+# Imagens Markdown: so o caminho / alt e caminho / a imagem com {atributos}
+MD_IMG_SRC_RE = re.compile(r'!\[.*?\]\(([^)]+)\)')
+MD_IMG_RE = re.compile(r'!\[([^\]]*)\]\(([^)]+)\)')
+MD_IMG_ATTRS_RE = re.compile(r'!\[.*?\]\([^)]+\)(?:\{.*?\})?')
+# ::: {layout-ncol=N} com tabelas Markdown: cada tabela com legenda opcional
+LAYOUT_TBL_BLOCK_RE = re.compile(
+    r'((?:[ \t]*\|[^\n]+\n)+'           # linhas da tabela
+    r'(?:\n?[ \t]*: [^\n{]*\{#tbl-[\w-]+[^}]*\})?'  # legenda Quarto opcional
+    r'(?:\n?[ \t]*\{#tbl-[\w-]+[^}]*\})?)',          # legenda antiga opcional
     re.MULTILINE
 )
+LAYOUT_TBL_CAPTION_RE = re.compile(r'\n?[ \t]*: ([^\n{]*?)\s*\{#(tbl-[\w-]+)[^}]*\}')
+TBL_ID_ATTR_RE = re.compile(r'\{#(tbl-[\w-]+)[^}]*\}')
+
+# @fig-*, @tbl-*, @eq-* dentro de um trecho
+CROSSREF_AT_RE = re.compile(r'@((fig|tbl|eq)-[\w-]+)')
+
+# Markdown inline -> HTML (md_inline_to_html)
+MD_DISPLAY_MATH_RE = re.compile(r'\$\$[\s\S]*?\$\$')
+MD_INLINE_MATH_RE  = re.compile(r'\$[^\$\n]+?\$')
+MD_QUOTE_MARK_RE   = re.compile(r'^> ?', re.MULTILINE)
+MD_BOLD_LINK_RE    = re.compile(r'\*\*\[([^\]]+)\]\(([^)]+)\)\*\*')
+MD_ITALIC_LINK_RE  = re.compile(r'\*\[([^\]]+)\]\(([^)]+)\)\*')
+MD_LINK_RE         = re.compile(r'\[([^\]]+)\]\(([^)]+)\)')
+MD_BOLD_RE         = re.compile(r'\*\*(.+?)\*\*', re.DOTALL)
+MD_ITALIC_RE       = re.compile(r'\*(.+?)\*')
+MD_CODE_RE         = re.compile(r'`([^`]+)`')
+LATEX_PLACEHOLDER_RE = re.compile('\x00LATEX(\\d+)\x00')
 
 def md_inline_to_html(text: str) -> str:
     """
@@ -284,52 +779,47 @@ def md_inline_to_html(text: str) -> str:
     # ── 1. Proteger e converter delimitadores LaTeX ───────────────────────────
     # Dentro de <blockquote> HTML o Jupyter/MathJax nao processa $...$,
     # mas processa \(...\) e \[...\].
-    placeholders = {}
-    counter = [0]
+    # Trecho i fica como \x00LATEX<i>\x00 (ver LATEX_PLACEHOLDER_RE)
+    placeholders = []
 
     def _stash(m):
-        key = "\x00LATEX{}\x00".format(counter[0])
+        key = "\x00LATEX{}\x00".format(len(placeholders))
         latex = m.group(0)
         if latex.startswith('$$'):
             inner = latex[2:-2]
-            placeholders[key] = '\\[' + inner + '\\]'
+            placeholders.append('\\[' + inner + '\\]')
         else:
             inner = latex[1:-1]
-            placeholders[key] = '\\(' + inner + '\\)'
-        counter[0] += 1
+            placeholders.append('\\(' + inner + '\\)')
         return key
 
     # Display math $$...$$ (multiline, nao guloso) — deve vir antes do inline $
-    text = re.sub(r'\$\$[\s\S]*?\$\$', _stash, text)
+    text = MD_DISPLAY_MATH_RE.sub(_stash, text)
     # Inline math $...$ — nao cruza quebras de linha
-    text = re.sub(r'\$[^\$\n]+?\$', _stash, text)
+    text = MD_INLINE_MATH_RE.sub(_stash, text)
 
     # ── 2. Transformacoes Markdown ─────────────────────────────────────────────
     # Remove marcas de blockquote Markdown (> ) — ja estamos dentro de um <blockquote>
-    text = re.sub(r'^> ?', '', text, flags=re.MULTILINE)
+    text = MD_QUOTE_MARK_RE.sub('', text)
 
     # Negrito + link: **[texto](url)**
-    text = re.sub(
-        r'\*\*\[([^\]]+)\]\(([^)]+)\)\*\*',
-        r'<strong><a href="\2">\1</a></strong>', text)
+    text = MD_BOLD_LINK_RE.sub(r'<strong><a href="\2">\1</a></strong>', text)
     # Italico + link: *[texto](url)*
-    text = re.sub(
-        r'\*\[([^\]]+)\]\(([^)]+)\)\*',
-        r'<em><a href="\2">\1</a></em>', text)
+    text = MD_ITALIC_LINK_RE.sub(r'<em><a href="\2">\1</a></em>', text)
     # Link simples: [texto](url)
-    text = re.sub(
-        r'\[([^\]]+)\]\(([^)]+)\)',
-        r'<a href="\2">\1</a>', text)
+    text = MD_LINK_RE.sub(r'<a href="\2">\1</a>', text)
     # Negrito: **texto** — re.DOTALL para capturar frases que cruzam linhas
-    text = re.sub(r'\*\*(.+?)\*\*', r'<strong>\1</strong>', text, flags=re.DOTALL)
+    text = MD_BOLD_RE.sub(r'<strong>\1</strong>', text)
     # Italico: *texto* — apenas inline, sem cruzar linhas
-    text = re.sub(r'\*(.+?)\*', r'<em>\1</em>', text)
+    text = MD_ITALIC_RE.sub(r'<em>\1</em>', text)
     # Codigo inline: `texto`
-    text = re.sub(r'`([^`]+)`', r'<code>\1</code>', text)
+    text = MD_CODE_RE.sub(r'<code>\1</code>', text)
 
     # ── 3. Restaurar LaTeX ─────────────────────────────────────────────────────
-    for key, original in placeholders.items():
-        text = text.replace(key, original)
+    # Uma passada: cada marcador e trocado pelo seu trecho (um replace por
+    # marcador percorreria o texto inteiro a cada trecho)
+    if placeholders:
+        text = LATEX_PLACEHOLDER_RE.sub(lambda m: placeholders[int(m.group(1))], text)
 
     return text
 
@@ -356,24 +846,16 @@ def md_table_to_html(md: str) -> str:
     # Linha 1 é o separador (--- | ---), pula
     data_rows = rows[2:]
 
-    th_html = "".join(
-        f'<th style="border:1px solid #ccc; padding:4px 8px; background:#f0f0f0; text-align:left;">{c}</th>'
-        for c in header_cells
-    )
-    tr_rows = ""
+    th = '<th style="border:1px solid #ccc; padding:4px 8px; background:#f0f0f0; text-align:left;">'
+    td = '<td style="border:1px solid #ccc; padding:4px 8px;">'
+    out = Emitter()
+    out.write('<table style="border-collapse:collapse; width:100%;">\n<thead><tr>',
+              th, ('</th>' + th).join(header_cells), '</th></tr></thead>\n<tbody>\n')
+    # Uma escrita por linha: as celulas da linha sao juntadas de uma vez
     for row in data_rows:
-        tds = "".join(
-            f'<td style="border:1px solid #ccc; padding:4px 8px;">{c}</td>'
-            for c in row
-        )
-        tr_rows += f'<tr>{tds}</tr>\n'
-
-    return (
-        f'<table style="border-collapse:collapse; width:100%;">\n'
-        f'<thead><tr>{th_html}</tr></thead>\n'
-        f'<tbody>\n{tr_rows}</tbody>\n'
-        f'</table>'
-    )
+        out.write('<tr>', td, ('</td>' + td).join(row), '</td></tr>\n')
+    out.write('</tbody>\n</table>')
+    return out.text()
 
 def resolve_crossrefs_to_html(text: str, elem_map: dict) -> str:
     """Resolve @tbl-*, @fig-*, @eq-* para <a href> HTML (não Markdown)."""
@@ -385,298 +867,383 @@ def resolve_crossrefs_to_html(text: str, elem_map: dict) -> str:
         kind = info.get("kind", elem_id.split('-')[0])
         prefix = "Tabela" if kind == "tbl" else "Figura" if kind == "fig" else "Equação"
         num = info.get("num_str", "")
-        return f'<a href="#{elem_id}">{prefix} {num}</a>'
-    return re.sub(r'@((fig|tbl|eq)-[\w-]+)', _replace, text)
+        return f'<a href="{xref_href(elem_id, info)}">{prefix} {num}</a>'
+    return CROSSREF_AT_RE.sub(_replace, text)
+
+class FencedDiv:
+    """Bloco ::: {atributos} ... ::: : linha de abertura, de fechamento e filhos."""
+    __slots__ = ("start", "end", "fence", "attrs", "children")
+
+    def __init__(self, start: int, fence: int, attrs, end: int):
+        self.start    = start       # linha da abertura
+        self.end      = end         # linha do fechamento (ou o fim do trecho)
+        self.fence    = fence       # tamanho da cerca ':::'
+        self.attrs    = attrs       # None: abertura ':::+ {' incompleta
+        self.children = []
+
+
+def parse_fenced_divs(lines: list, lo: int = 0, hi: int = None) -> list:
+    """
+    Arvore dos blocos ::: das linhas [lo, hi), numa unica passagem com pilha.
+    No nivel de topo so '::: {atributos}' completo abre bloco; dentro de um
+    bloco qualquer ':::+ {' abre outro, e ':::' fecha o do topo da pilha se
+    a cerca for pelo menos do mesmo tamanho (senao e texto). Blocos sem
+    fechamento terminam em hi.
+    """
+    if hi is None:
+        hi = len(lines)
+    roots, stack = [], []
+    for i in range(lo, hi):
+        line = lines[i]
+        if not line.startswith(':::'):
+            continue
+        if not stack:
+            m = DIV_OPEN_RE.match(line)
+            if m:
+                node = FencedDiv(i, len(m.group(1)), m.group(2).strip(), hi)
+                roots.append(node)
+                stack.append(node)
+            continue
+        close_m = DIV_FENCE_CLOSE_RE.match(line)
+        if close_m:
+            if len(close_m.group(1)) >= stack[-1].fence:
+                stack.pop().end = i
+            continue
+        open_m = DIV_FENCE_START_RE.match(line)
+        if open_m:
+            m = DIV_OPEN_RE.match(line)
+            node = FencedDiv(i, len(open_m.group(1)),
+                             m.group(2).strip() if m else None, hi)
+            stack[-1].children.append(node)
+            stack.append(node)
+    return roots
+
 
 def convert_callouts(text: str, elem_map: dict) -> str:
     """
     Converte blocos ::: {.callout-*} ... ::: e blocos de figuras/tabelas agrupadas
     ::: {#fig-ID layout-ncol=2} ... ::: para HTML/Markdown compatível com Colab.
+
+    A arvore de blocos (parse_fenced_divs) e montada uma vez e cada bloco
+    alcancado e renderizado uma vez: o conteudo de divs genericos, grupos de
+    subfiguras e layouts e percorrido pelos nos filhos ja encontrados, sem
+    re-varrer o texto interno a cada nivel de aninhamento.
     """
+    if ':::' not in text:
+        return text
     lines = text.split('\n')
-    out   = []
-    i     = 0
-
-    while i < len(lines):
-        line = lines[i]
-        # Detecta abertura de ::: {atributos}
-        m = re.match(r'^(:::+)\s*\{([^}]*)\}\s*$', line)
-
-        if m:
-            fence_len = len(m.group(1))
-            attrs     = m.group(2).strip()
-
-            # 1. Verifica se é um Callout conhecido
-            callout_type = None
-            for ct in CALLOUT_STYLE:
-                if ct in attrs:
-                    callout_type = ct
-                    break
-
-            # 2. Verifica se é um grupo de figuras/tabelas com ID e Layout
-            # Ex: ::: {#fig-2-2 layout-ncol=2}
-            group_id_m = re.search(r'#((?:fig|tbl)-[\w-]+)', attrs)
-            has_layout = "layout-ncol" in attrs or "layout=" in attrs or "layout-nrow" in attrs
-
-            # Coleta o conteúdo interno do bloco ::: até o fechamento
-            # Usa pilha de fence_len para rastrear blocos aninhados corretamente
-            i += 1
-            fence_stack = [fence_len]
+    roots = parse_fenced_divs(lines)
+    if not roots:
+        return text
+    row_marks = None            # ver has_table_rows
+
+    def inner_range(node: FencedDiv, end: int) -> tuple:
+        """
+        Linhas [lo, hi) do conteudo aparado, como o .strip() do texto interno
+        (a 1a e a ultima linha sao aparadas no lugar), e os blocos filhos.
+        """
+        lo, hi = node.start + 1, end
+        while lo < hi and not lines[lo].strip():
+            lo += 1
+        while hi > lo and not lines[hi - 1].strip():
+            hi -= 1
+        children = node.children
+        if lo < hi:
+            first = lines[lo]
+            lines[lo] = first.lstrip()
+            lines[hi - 1] = lines[hi - 1].rstrip()
+            if lines[lo] != first and DIV_FENCE_START_RE.match(lines[lo]):
+                # Aparada, a 1a linha virou cerca: os filhos mudam
+                children = parse_fenced_divs(lines, lo, hi)
+        return lo, hi, children
+
+    def has_table_rows(lo: int, hi: int) -> bool:
+        """
+        LAYOUT_TBL_BLOCK_RE acha algo em '\\n'.join(lines[lo:hi])? Isto e: alguma
+        linha, exceto a ultima, tem '|' seguido de texto. Contagem acumulada,
+        para nao varrer o mesmo trecho a cada layout aninhado.
+        """
+        nonlocal row_marks
+        if row_marks is None:
+            row_marks = [0]
+            for l in lines:
+                row_marks.append(row_marks[-1] + ('|' in l[:-1]))
+        return row_marks[max(hi - 1, lo)] > row_marks[lo]
+
+    def walk(lo: int, hi: int, nodes: list, out: list):
+        """Linhas [lo, hi) no nivel de topo: blocos renderizados, o resto copiado."""
+        i = lo
+        for node in nodes:
+            if node.start >= hi:
+                break
+            out.extend(lines[i:node.start])
+            end = min(node.end, hi)
+            if node.attrs is None:
+                # Abertura incompleta: no nivel de topo e texto comum
+                out.append(lines[node.start])
+                walk(node.start + 1, end, node.children, out)
+                if node.end < hi:
+                    out.append(lines[node.end])
+            else:
+                block = render_block(node, end)
+                if block is not None:
+                    out.append(block)
+            i = min(node.end + 1, hi)
+        out.extend(lines[i:hi])
+
+    def rescan(lo: int, hi: int, nodes: list) -> str:
+        """convert_callouts das linhas [lo, hi) usando os nos ja encontrados."""
+        out = []
+        walk(lo, hi, nodes, out)
+        return '\n'.join(out)
+
+    def render_block(node: FencedDiv, end: int):
+        """HTML/Markdown do bloco (conteudo ate a linha 'end'); None se nada."""
+        attrs = node.attrs
+
+        # 1. Verifica se é um Callout conhecido
+        callout_type = None
+        for ct in CALLOUT_STYLE:
+            if ct in attrs:
+                callout_type = ct
+                break
+
+        # 2. Verifica se é um grupo de figuras/tabelas com ID e Layout
+        # Ex: ::: {#fig-2-2 layout-ncol=2}
+        group_id_m = GROUP_ID_RE.search(attrs)
+        has_layout = "layout-ncol" in attrs or "layout=" in attrs or "layout-nrow" in attrs
+
+        # Lógica de Renderização:
+        if callout_type:
+            # Primeira linha '## Titulo' do conteudo (fora das cercas) vira o titulo
             inner = []
             title_override = None
-
-            while i < len(lines) and fence_stack:
-                l = lines[i]
-                open_m = re.match(r'^(:::+)\s*\{', l)
-                close_m = re.match(r'^(:::+)\s*$', l)
-                if close_m:
-                    close_len = len(close_m.group(1))
-                    if fence_stack and close_len >= fence_stack[-1]:
-                        fence_stack.pop()
-                        if not fence_stack:
-                            i += 1
-                            break
-                        else:
-                            inner.append(l)
-                    else:
-                        inner.append(l)
-                elif open_m:
-                    fence_stack.append(len(open_m.group(1)))
-                    inner.append(l)
-                else:
-                    hm = re.match(r'^#{1,4}\s+(.+)$', l)
-                    if hm and title_override is None and callout_type:
+            for l in lines[node.start + 1:end]:
+                if title_override is None and not l.startswith(':::'):
+                    hm = CALLOUT_TITLE_RE.match(l)
+                    if hm:
                         title_override = hm.group(1).strip()
-                    else:
-                        inner.append(l)
-                i += 1
-
+                        continue
+                inner.append(l)
             inner_text = '\n'.join(inner).strip()
 
-            # Lógica de Renderização:
-            if callout_type:
-                # Renderiza como Blockquote (Callout)
-                emoji, default_title = CALLOUT_STYLE[callout_type]
-                title = title_override or default_title
-                inner_html = md_inline_to_html(inner_text)
-                # Nao inserir <br /> — as quebras de linha dentro do <blockquote>
-                # sao tratadas pelo browser; inserir <br /> quebraria negritos
-                # e LaTeX que cruzam linhas no fonte Markdown.
-                block = (
-                    f'<blockquote style="border-left: 4px solid #aaa; '
-                    f'padding: 0.5em 1em; margin: 1em 0; background: #f9f9f9;">\n'
-                    f'<strong>{emoji} {title}</strong><br />\n'
-                    f'{inner_html}\n'
-                    f'</blockquote>'
+            # Renderiza como Blockquote (Callout)
+            emoji, default_title = CALLOUT_STYLE[callout_type]
+            title = title_override or default_title
+            inner_html = md_inline_to_html(inner_text)
+            # Nao inserir <br /> — as quebras de linha dentro do <blockquote>
+            # sao tratadas pelo browser; inserir <br /> quebraria negritos
+            # e LaTeX que cruzam linhas no fonte Markdown.
+            return (
+                f'<blockquote style="border-left: 4px solid #aaa; '
+                f'padding: 0.5em 1em; margin: 1em 0; background: #f9f9f9;">\n'
+                f'<strong>{emoji} {title}</strong><br />\n'
+                f'{inner_html}\n'
+                f'</blockquote>'
+            )
+
+        if group_id_m and has_layout:
+            elem_id = group_id_m.group(1)
+            info = elem_map.get(elem_id)
+            inner_text = '\n'.join(lines[node.start + 1:end]).strip()
+
+            # 1. Quebra o conteúdo interno pelos blocos ::: das subfiguras
+            subblocks = SUBFIG_FENCE_RE.split(inner_text)
+            # Remove o primeiro elemento se estiver vazio (texto antes da primeira subfigura)
+            subblocks = [b for b in subblocks if b.strip()]
+
+            # 2. Identifica a legenda principal (última parte do texto fora dos blocos)
+            # Geralmente está após o último ::: das subfiguras
+            main_caption = ""
+            last_parts = subblocks[-1].split(':::')
+            if len(last_parts) > 1:
+                main_caption = last_parts[-1].strip()
+                # Remove a legenda principal do último bloco de subfigura
+                subblocks[-1] = last_parts[0]
+
+            cols_html = Emitter()
+            for idx, block in enumerate(subblocks):
+                # Extrai o caminho da imagem
+                img_m = MD_IMG_SRC_RE.search(block)
+                # Extrai o texto (sublegenda): remove a linha da imagem e as cercas :::
+                sub_text = MD_IMG_ATTRS_RE.sub('', block)
+                sub_text = sub_text.replace(':::', '').strip()
+
+                if img_m:
+                    path = img_m.group(1).strip()
+                    label_prefix = f'({chr(ord("a") + idx)})'
+                    cols_html.write(
+                        '<td style="text-align:center; border:none; padding:4px;">'
+                        f'<img src="{path}" style="width:100%;" />'
+                        f'<br/><small>{label_prefix} {sub_text}</small>'
+                        '</td>'
+                    )
+
+            if cols_html and info:
+                return (
+                    f'<figure id="{elem_id}" style="text-align:center; margin:1em 0;">\n'
+                    f'  <table style="width:100%; border:none;"><tr style="border:none;">{cols_html.text()}</tr></table>\n'
+                    f'  <figcaption><strong>{info["label_prefix"]}</strong> {main_caption}</figcaption>\n'
+                    f'</figure>'
                 )
-                out.append(block)
-
-            elif group_id_m and has_layout:
-                elem_id = group_id_m.group(1)
-                info = elem_map.get(elem_id)
-                
-                # 1. Quebra o conteúdo interno pelos blocos ::: das subfiguras
-                subblocks = re.split(r':::+\s*\{#(?:fig|tbl)-[\w-]+\}', inner_text)
-                # Remove o primeiro elemento se estiver vazio (texto antes da primeira subfigura)
-                subblocks = [b for b in subblocks if b.strip()]
-
-                # 2. Identifica a legenda principal (última parte do texto fora dos blocos)
-                # Geralmente está após o último ::: das subfiguras
-                main_caption = ""
-                last_parts = subblocks[-1].split(':::')
-                if len(last_parts) > 1:
-                    main_caption = last_parts[-1].strip()
-                    # Remove a legenda principal do último bloco de subfigura
-                    subblocks[-1] = last_parts[0]
-
-                cols_html = ""
-                for idx, block in enumerate(subblocks):
-                    # Extrai o caminho da imagem
-                    img_m = re.search(r'!\[.*?\]\(([^)]+)\)', block)
-                    # Extrai o texto (sublegenda): remove a linha da imagem e as cercas :::
-                    sub_text = re.sub(r'!\[.*?\]\([^)]+\)(?:\{.*?\})?', '', block)
-                    sub_text = sub_text.replace(':::', '').strip()
-                    
-                    if img_m:
-                        path = img_m.group(1).strip()
-                        label_prefix = f'({chr(ord("a") + idx)})'
-                        cols_html += (
-                            f'<td style="text-align:center; border:none; padding:4px;">'
-                            f'<img src="{path}" style="width:100%;" />'
-                            f'<br/><small>{label_prefix} {sub_text}</small>'
-                            f'</td>'
-                        )
-                
-                if cols_html and info:
-                    block = (
+            return inner_text
+
+        if group_id_m and not has_layout:
+            elem_id = group_id_m.group(1)
+            kind    = elem_id.split('-')[0]
+            info    = elem_map.get(elem_id)
+            lo, hi, children = inner_range(node, end)
+            inner_text = '\n'.join(lines[lo:hi])
+            subfig_ids = SUBFIG_IDS_RE.findall(inner_text)
+
+            if subfig_ids:
+                caption = ""
+                body_end = hi
+                for idx in range(hi - 1, lo - 1, -1):
+                    s = lines[idx].strip()
+                    if s and not s.startswith(':::') and not s.startswith('!'):
+                        caption = s
+                        body_end = idx
+                        break
+                for sub_idx, (sub_id, _) in enumerate(subfig_ids):
+                    if sub_id in elem_map and elem_map[sub_id].get("is_subfig"):
+                        elem_map[sub_id]["label_prefix"] = f'({chr(ord("a") + sub_idx)})'
+                processed_inner = rescan(lo, body_end, children)
+                if info:
+                    lp = info.get("label_prefix") or (info.get("label", "") + ":")
+                    if not lp.endswith(":"):
+                        lp += ":"
+                    return (
                         f'<figure id="{elem_id}" style="text-align:center; margin:1em 0;">\n'
-                        f'  <table style="width:100%; border:none;"><tr style="border:none;">{cols_html}</tr></table>\n'
-                        f'  <figcaption><strong>{info["label_prefix"]}</strong> {main_caption}</figcaption>\n'
+                        f'  {processed_inner}\n'
+                        f'  <figcaption><strong>{lp}</strong> {caption}</figcaption>\n'
                         f'</figure>'
                     )
-                    out.append(block)
+                return processed_inner
+
+            img_m = MD_IMG_RE.search(inner_text)
+            caption_lines = [
+                l.strip() for l in inner_text.split('\n')
+                if l.strip() and not l.strip().startswith('!')
+            ]
+            caption = caption_lines[-1] if caption_lines else ""
+            if img_m and info:
+                img_alt  = img_m.group(1)
+                img_path = img_m.group(2)
+                lp = info.get("label_prefix") or info.get("label", "")
+                is_subfig = info.get("is_subfig", False)
+                if not is_subfig and lp and not lp.endswith(":"):
+                    lp += ":"
+                img_tag = f'<img src="{img_path.strip()}" alt="{img_alt}" style="max-width:60%; display:block; margin:auto;" />'
+                figcap  = f'<figcaption><strong>{lp}</strong> {caption}</figcaption>'
+                body = img_tag + "\n  " + figcap if kind != "tbl" else figcap + "\n  " + img_tag
+                return f'<figure id="{elem_id}" style="text-align:center; margin:1em 0;">\n  {body}\n</figure>'
+            return inner_text or None
+
+        if ".text-center" in attrs:
+            # Suporte para centralização
+            inner_text = '\n'.join(lines[node.start + 1:end]).strip()
+            return f'<div style="text-align:center;">\n\n{inner_text}\n\n</div>'
+
+        lo, hi, children = inner_range(node, end)
+
+        if has_layout and not group_id_m and has_table_rows(lo, hi):
+            # layout-ncol=N sem ID de grupo: divide tabelas Markdown em colunas HTML
+            # Ex: ::: {layout-ncol=4} com 4 tabelas Markdown
+            ncol_m = LAYOUT_NCOL_RE.search(attrs)
+            ncols = int(ncol_m.group(1)) if ncol_m else 2
+
+            # Separa o inner_text em blocos de tabela individuais
+            # Cada tabela começa com uma linha que começa com '|'
+            # e pode ter legenda ': Título {#tbl-...}' após
+            tbl_blocks = LAYOUT_TBL_BLOCK_RE.findall('\n'.join(lines[lo:hi]))
+
+            # Monta uma linha de <td> para cada tabela
+            col_width = f"{100 // ncols}%"
+            cells_html = Emitter()
+            for tbl_src in tbl_blocks:
+                tbl_src = tbl_src.strip()
+                # Extrai legenda e id, se existirem
+                cap_m = LAYOUT_TBL_CAPTION_RE.search(tbl_src)
+                if cap_m:
+                    cap_text = cap_m.group(1).strip()
+                    tbl_id   = cap_m.group(2)
+                    tbl_src  = tbl_src[:cap_m.start()].strip()
                 else:
-                    out.append(inner_text)
-            
-            elif group_id_m and not has_layout:
-                elem_id = group_id_m.group(1)
-                kind    = elem_id.split('-')[0]
-                info    = elem_map.get(elem_id)
-                subfig_ids = re.findall(r'^:::+\s*\{#((fig|tbl)-[\w-]+)', inner_text, re.MULTILINE)
-
-                if subfig_ids:
-                    inner_lines = inner_text.split('\n')
-                    caption = ""
-                    body_end = len(inner_lines)
-                    for idx in range(len(inner_lines) - 1, -1, -1):
-                        s = inner_lines[idx].strip()
-                        if s and not s.startswith(':::') and not s.startswith('!'):
-                            caption = s
-                            body_end = idx
-                            break
-                    for sub_idx, (sub_id, _) in enumerate(subfig_ids):
-                        if sub_id in elem_map and elem_map[sub_id].get("is_subfig"):
-                            elem_map[sub_id]["label_prefix"] = f'({chr(ord("a") + sub_idx)})'
-                    inner_body = '\n'.join(inner_lines[:body_end])
-                    processed_inner = convert_callouts(inner_body, elem_map)
-                    if info:
-                        lp = info.get("label_prefix") or (info.get("label", "") + ":")
-                        if not lp.endswith(":"):
-                            lp += ":"
-                        block = (
-                            f'<figure id="{elem_id}" style="text-align:center; margin:1em 0;">\n'
-                            f'  {processed_inner}\n'
-                            f'  <figcaption><strong>{lp}</strong> {caption}</figcaption>\n'
-                            f'</figure>'
-                        )
-                        out.append(block)
-                    else:
-                        out.append(processed_inner)
+                    old_m = TBL_ID_ATTR_RE.search(tbl_src)
+                    tbl_id   = old_m.group(1) if old_m else None
+                    cap_text = ""
+                    if old_m:
+                        tbl_src = tbl_src[:old_m.start()].strip()
+
+                # Resolve @tbl-* @fig-* na legenda ANTES de montar o HTML
+                cap_text = resolve_crossrefs_to_html(cap_text, elem_map)
+
+                info = elem_map.get(tbl_id) if tbl_id else None
+                if info:
+                    cap_label = f'<strong>{info["label_prefix"]}</strong> {cap_text}' if cap_text else f'<strong>{info["label_prefix"]}</strong>'
+                    anchor    = f'<a id="{tbl_id}"></a>\n'
                 else:
-                    img_m = re.search(r'!\[([^\]]*)\]\(([^)]+)\)', inner_text)
-                    caption_lines = [
-                        l.strip() for l in inner_text.split('\n')
-                        if l.strip() and not l.strip().startswith('!')
-                    ]
-                    caption = caption_lines[-1] if caption_lines else ""
-                    if img_m and info:
-                        img_alt  = img_m.group(1)
-                        img_path = img_m.group(2)
-                        lp = info.get("label_prefix") or info.get("label", "")
-                        is_subfig = info.get("is_subfig", False)
-                        if not is_subfig and lp and not lp.endswith(":"):
-                            lp += ":"
-                        img_tag = f'<img src="{img_path.strip()}" alt="{img_alt}" style="max-width:60%; display:block; margin:auto;" />'
-                        figcap  = f'<figcaption><strong>{lp}</strong> {caption}</figcaption>'
-                        body = img_tag + "\n  " + figcap if kind != "tbl" else figcap + "\n  " + img_tag
-                        block = f'<figure id="{elem_id}" style="text-align:center; margin:1em 0;">\n  {body}\n</figure>'
-                        out.append(block)
-                    else:
-                        if inner_text:
-                            out.append(inner_text)
-
-                
-            elif ".text-center" in attrs:
-                # Suporte para centralização
-                block = f'<div style="text-align:center;">\n\n{inner_text}\n\n</div>'
-                out.append(block)
-
-            elif has_layout and not group_id_m:
-                # layout-ncol=N sem ID de grupo: divide tabelas Markdown em colunas HTML
-                # Ex: ::: {layout-ncol=4} com 4 tabelas Markdown
-                ncol_m = re.search(r'layout-ncol\s*=\s*(\d+)', attrs)
-                ncols = int(ncol_m.group(1)) if ncol_m else 2
-
-                # Separa o inner_text em blocos de tabela individuais
-                # Cada tabela começa com uma linha que começa com '|'
-                # e pode ter legenda ': Título {#tbl-...}' após
-                tbl_block_re = re.compile(
-                    r'((?:[ \t]*\|[^\n]+\n)+'           # linhas da tabela
-                    r'(?:\n?[ \t]*: [^\n{]*\{#tbl-[\w-]+[^}]*\})?'  # legenda Quarto opcional
-                    r'(?:\n?[ \t]*\{#tbl-[\w-]+[^}]*\})?)',          # legenda antiga opcional
-                    re.MULTILINE
+                    cap_label = f'<strong>{cap_text}</strong>' if cap_text else ""
+                    anchor    = f'<a id="{tbl_id}"></a>\n' if tbl_id else ""
+
+                cap_html = f'<div style="text-align:left; font-size:0.9em; margin-bottom:4px;">{cap_label}</div>' if cap_label else ""
+                cells_html.write(
+                    f'<td style="vertical-align:top; padding:4px; width:{col_width}; border:none;">',
+                    anchor, cap_html, '\n\n', tbl_src, '\n\n</td>\n'
                 )
-                tbl_blocks = tbl_block_re.findall(inner_text)
-
-                if tbl_blocks:
-                    # Monta uma linha de <td> para cada tabela
-                    col_width = f"{100 // ncols}%"
-                    cells_html = ""
-                    for tbl_src in tbl_blocks:
-                        tbl_src = tbl_src.strip()
-                        # Extrai legenda e id, se existirem
-                        cap_m = re.search(
-                            r'\n?[ \t]*: ([^\n{]*?)\s*\{#(tbl-[\w-]+)[^}]*\}', tbl_src)
-                        if cap_m:
-                            cap_text = cap_m.group(1).strip()
-                            tbl_id   = cap_m.group(2)
-                            tbl_src  = tbl_src[:cap_m.start()].strip()
-                        else:
-                            old_m = re.search(r'\{#(tbl-[\w-]+)[^}]*\}', tbl_src)
-                            tbl_id   = old_m.group(1) if old_m else None
-                            cap_text = ""
-                            if old_m:
-                                tbl_src = tbl_src[:old_m.start()].strip()
-
-                        # info = elem_map.get(tbl_id) if tbl_id else None
-                        # if info:
-                        #     cap_label = f'<strong>{info["label_prefix"]}</strong> {cap_text}' if cap_text else f'<strong>{info["label_prefix"]}</strong>'
-                        #     anchor    = f'<a id="{tbl_id}"></a>\n'
-                        # else:
-                        #     cap_label = f'<strong>{cap_text}</strong>' if cap_text else ""
-                        #     anchor    = f'<a id="{tbl_id}"></a>\n' if tbl_id else ""
-
-                        # Resolve @tbl-* @fig-* na legenda ANTES de montar o HTML
-                        cap_text = resolve_crossrefs_to_html(cap_text, elem_map)
-
-                        info = elem_map.get(tbl_id) if tbl_id else None
-                        if info:
-                            cap_label = f'<strong>{info["label_prefix"]}</strong> {cap_text}' if cap_text else f'<strong>{info["label_prefix"]}</strong>'
-                            anchor    = f'<a id="{tbl_id}"></a>\n'
-                        else:
-                            cap_label = f'<strong>{cap_text}</strong>' if cap_text else ""
-                            anchor    = f'<a id="{tbl_id}"></a>\n' if tbl_id else ""
-
-                        cap_html = f'<div style="text-align:left; font-size:0.9em; margin-bottom:4px;">{cap_label}</div>' if cap_label else ""
-                        cells_html += (
-                            f'<td style="vertical-align:top; padding:4px; width:{col_width}; border:none;">'
-                            f'{anchor}{cap_html}\n\n{tbl_src}\n\n'
-                            f'</td>\n'
-                        )
-
-                    block = (
-                        f'<table style="width:100%; border:none; border-collapse:collapse;">'
-                        f'<tr style="border:none;">\n{cells_html}</tr></table>'
-                    )
-                    out.append(block)
-                else:
-                    # Sem tabelas reconhecíveis: fallback ao conteúdo processado
-                    if inner_text:
-                        processed = convert_callouts(inner_text, elem_map)
-                        out.append(processed)
 
-            else:
-                # Div genérico (ex: layout="[[1,1]]"): processa sub-blocos ::: recursivamente
-                # O restante (tabelas, imagens) será processado pelas etapas seguintes do process_cell
-                if inner_text:
-                    processed = convert_callouts(inner_text, elem_map)
-                    out.append(processed)
-        else:
-            out.append(line)
-            i += 1
+            return (
+                f'<table style="width:100%; border:none; border-collapse:collapse;">'
+                f'<tr style="border:none;">\n{cells_html.text()}</tr></table>'
+            )
+
+        # Div genérico (ex: layout="[[1,1]]") ou layout sem tabelas reconhecíveis:
+        # processa os sub-blocos ::: pela arvore. O restante (tabelas, imagens)
+        # será processado pelas etapas seguintes do process_cell
+        if lo == hi:
+            return None
+        return rescan(lo, hi, children)
 
+    out = []
+    walk(0, len(lines), roots, out)
     return '\n'.join(out)
 
 # ---------------------------------------------------------------------------
 # 6. Extrai label -> numero de todos os elementos do notebook
 # ---------------------------------------------------------------------------
 
+# Numero do capitulo no id (fig-1-X -> 1)
+CHAPTER_ID_RE = re.compile(r'(?:fig|tbl|eq|sec|lst)-(\d+)')
+# Legenda de celula de codigo:  #| fig-cap: "..."  /  #| tbl-cap: "..."
+CODE_CAPTION_RE = re.compile(r'#\|\s*(?:tbl-cap|fig-cap):\s*["\']([^"\']+)["\']')
+# Grupo ou subfigura:  ::: {#fig-X-Y ...}
+DIV_ID_FENCE_RE = re.compile(r'^:::+\s*\{#((fig|tbl)-[\w-]+)[^}]*\}', re.MULTILINE)
+SUBFIG_SUFFIX_RE = re.compile(r'\d[a-z]$')           # fig-2-2a, fig-2-2b ...
+
+
 def _chapter_from_id(label_id: str) -> str:
     """Extrai o numero do capitulo do id: fig-1-X -> '1', eq-2-3 -> '2', tbl-X -> ''"""
-    m = re.match(r'(?:fig|tbl|eq|sec|lst)-(\d+)', label_id)
+    m = CHAPTER_ID_RE.match(label_id)
     return m.group(1) if m else ""
 
 
+def fenced_div_spans(text: str) -> list:
+    """
+    Intervalos [inicio, fim) em caracteres dos blocos ::: de nivel de topo
+    de 'text' (a mesma arvore de parse_fenced_divs usada por convert_callouts:
+    cercas aninhadas pareiam certo e bloco sem fechamento vai ate o fim).
+    """
+    lines = text.split('\n')
+    offsets, pos = [], 0
+    for line in lines:
+        offsets.append(pos)
+        pos += len(line) + 1
+    return [(offsets[node.start],
+             offsets[node.end] + len(lines[node.end]) if node.end < len(lines) else len(text))
+            for node in parse_fenced_divs(lines)]
+
+
 def build_element_map(notebook: dict) -> dict:
     """
     Varre o notebook e cria um mapa unificado de todos os elementos numerados.
@@ -687,53 +1254,62 @@ def build_element_map(notebook: dict) -> dict:
         eq-1-abc -> "1.1", "1.2" ...
     Isso garante numeracao correta independente do sufixo do id.
     """
-    counters = {"fig": 0, "tbl": 0, "eq": 0}
-    elem_map = {}
+    builder = ElementMapBuilder()
+    for cell in notebook.get("cells", []):
+        builder.add(cell.get("cell_type"), source_to_str(cell.get("source", [])))
+    return builder.map
 
-    prefixes = {
-        "fig": "Figura",
-        "tbl": "Tabela",
-        "eq":  "Equacao",
-    }
 
-    def make_num_str(kind: str, elem_id: str) -> str:
+class ElementMapBuilder:
+    """
+    build_element_map celula a celula: add() recebe as celulas em ordem e
+    'map' acumula os elementos (usado tambem pela varredura de scan_notebook).
+    """
+
+    PREFIXES = {"fig": "Figura", "tbl": "Tabela", "eq": "Equacao"}
+
+    def __init__(self):
+        self.counters = {"fig": 0, "tbl": 0, "eq": 0}
+        self.map      = {}
+
+    def _num_str(self, kind: str, elem_id: str) -> str:
         """Gera num_str incremental: '<capitulo>.<contador>' ou '<contador>'."""
-        counters[kind] += 1
+        self.counters[kind] += 1
         chap = _chapter_from_id(elem_id)
-        return f"{chap}.{counters[kind]}" if chap else str(counters[kind])
-
-    for cell in notebook.get("cells", []):
-        if cell.get("cell_type") != "markdown":
-            if cell.get("cell_type") == "code":
-                src = source_to_str(cell.get("source", []))
-                label_m   = re.search(r'#\|\s*label:\s*((fig|tbl)-[\w-]+)', src)
-                caption_m = re.search(r'#\|\s*(?:tbl-cap|fig-cap):\s*["\']([^"\']+)["\']', src)
-                if label_m:
-                    elem_id = label_m.group(1)
-                    kind    = label_m.group(2)   # "fig" ou "tbl"
-                    caption = caption_m.group(1) if caption_m else ""
-                    prefix  = "Figura" if kind == "fig" else "Tabela"
-                    if elem_id not in elem_map:
-                        num_str = make_num_str(kind, elem_id)
-                        elem_map[elem_id] = {
-                            "kind":    kind,
-                            "num_str": num_str,
-                            "label":   f"{prefix} {num_str}",
-                            "caption": caption,   # guardado para injetar legenda
-                            "from_code": True,    # sinaliza origem em célula de código
-                            "alt":     None,
-                            "path":    None,
-                            "content": None,
-                        }
-            continue
-        source = source_to_str(cell.get("source", []))
+        return f"{chap}.{self.counters[kind]}" if chap else str(self.counters[kind])
+
+    def add(self, cell_type: str, source: str):
+        elem_map, make_num_str, prefixes = self.map, self._num_str, self.PREFIXES
+        if cell_type == "code":
+            label_m   = CODE_LABEL_RE.search(source)
+            caption_m = CODE_CAPTION_RE.search(source)
+            if label_m:
+                elem_id = label_m.group(1)
+                kind    = label_m.group(2)   # "fig" ou "tbl"
+                caption = caption_m.group(1) if caption_m else ""
+                prefix  = "Figura" if kind == "fig" else "Tabela"
+                if elem_id not in elem_map:
+                    num_str = make_num_str(kind, elem_id)
+                    elem_map[elem_id] = {
+                        "kind":    kind,
+                        "num_str": num_str,
+                        "label":   f"{prefix} {num_str}",
+                        "caption": caption,   # guardado para injetar legenda
+                        "from_code": True,    # sinaliza origem em célula de código
+                        "alt":     None,
+                        "path":    None,
+                        "content": None,
+                    }
+            return
+        if cell_type != "markdown":
+            return
 
         # Detecção de blocos ::: {#fig-ID} PRIMEIRO para reservar o id antes do IMG_DEF_RE
-        for m in re.finditer(r'^:::+\s*\{#((fig|tbl)-[\w-]+)[^}]*\}', source, re.MULTILINE):
+        for m in DIV_ID_FENCE_RE.finditer(source):
             elem_id = m.group(1)
             kind = m.group(2)
             if elem_id not in elem_map:
-                is_subfig = bool(re.search(r'\d[a-z]$', elem_id))
+                is_subfig = bool(SUBFIG_SUFFIX_RE.search(elem_id))
                 if is_subfig:
                     parent_id = elem_id[:-1]
                     parent_info = elem_map.get(parent_id)
@@ -759,9 +1335,15 @@ def build_element_map(notebook: dict) -> dict:
                     }
 
         # Figuras e tabelas-imagem: ![alt](path){#fig-* ou #tbl-*}
-        # Ignora imagens dentro de blocos ::: (já contadas acima)
-        source_no_div = re.sub(r':::.*?:::', '', source, flags=re.DOTALL)
-        for m in IMG_DEF_RE.finditer(source_no_div):
+        # Ignora imagens dentro de blocos ::: (já contadas acima): os
+        # intervalos dos blocos sao percorridos junto com os matches
+        spans = fenced_div_spans(source) if ':::' in source else []
+        k = 0
+        for m in IMG_DEF_RE.finditer(source):
+            while k < len(spans) and spans[k][1] <= m.start():
+                k += 1
+            if k < len(spans) and spans[k][0] <= m.start():
+                continue
             alt      = m.group(1)
             path     = m.group(2)
             elem_id  = m.group(3)             # ex: fig-1-1 ou tbl-2-X
@@ -778,7 +1360,8 @@ def build_element_map(notebook: dict) -> dict:
                 }
 
         # Tabelas Markdown: | col | ... {#tbl-*}
-        for m in TBL_MD_RE.finditer(source):
+        # (sem '{#tbl-' na celula nao ha match: evita a varredura, cara em celulas longas)
+        for m in TBL_MD_RE.finditer(source) if '{#tbl-' in source else ():
             tbl_body    = m.group(1)
             tbl_caption = (m.group(2) or "").strip() 
             elem_id     = m.group(3) or m.group(4)
@@ -809,7 +1392,159 @@ def build_element_map(notebook: dict) -> dict:
                     "content": eq_body,
                 }
 
-    return elem_map
+
+# ---------------------------------------------------------------------------
+# 6b. Cache dos mapas de elementos e indice global (crossrefs entre capitulos)
+# ---------------------------------------------------------------------------
+# A numeracao de um capitulo so muda quando o notebook dele muda: o mapa de
+# build_element_map fica em <out_dir>/.element-maps/<sha256 do notebook>.pickle
+# e e reaproveitado por process_notebook, pelo indice global e pelo --watch.
+#
+# build_element_map numera por notebook: @fig-2-3 citado no cap04 precisa
+# do numero (e do notebook) definidos no cap02. O indice do batch junta os
+# elementos de todos os capitulos: id -> {kind, num_str, notebook}, com o
+# notebook de origem do capitulo dono. Fica em <out_dir>/.element-index.json;
+# so capitulos cujo notebook mudou (tamanho/mtime, depois hash) sao
+# consultados de novo. A analise e comum a todos os alvos, entao o link sai
+# como marcador (\x01capXX/capXX.ipynb\x01#id) e _target_notebook o troca
+# pela saida do alvo (target_path): capXX_aluno.ipynb, capXX.md, ...
+
+ELEMENT_MAPS_NAME = ".element-maps"
+ELEMENT_INDEX_NAME = ".element-index.json"
+XREF_TARGET_RE = re.compile(r"\x01([^\x01\s]+)\x01#")
+
+
+class ElementMaps:
+    """Mapas de elementos por hash do notebook, mais o indice global do batch."""
+
+    def __init__(self, root: Path):
+        self.root    = root
+        self.dir     = root / ELEMENT_MAPS_NAME
+        self.version = converter_version()
+        self.index   = {}           # preenchido por build_element_index
+
+    def get(self, sha: str, notebook: dict = None, nb_path: Path = None) -> dict:
+        """
+        Mapa de elementos do notebook de hash 'sha': do cache ou, na falta,
+        de build_element_map(notebook) (lido de nb_path se nao veio pronto).
+        """
+        elem_map = self.load(sha)
+        if elem_map is None:
+            if notebook is None:
+                notebook, blobs = read_notebook(nb_path)
+                blobs.close()
+            elem_map = build_element_map(notebook)
+            self.store(sha, elem_map)
+        return elem_map
+
+    def load(self, sha: str):
+        """Mapa em cache do notebook de hash 'sha' (None se ausente ou de outra versao)."""
+        try:
+            with open(self.dir / f"{sha}.pickle", "rb") as f:
+                saved = pickle.load(f)
+            if saved.get("converter") == self.version:
+                return saved["map"]
+        except (OSError, EOFError, ValueError, TypeError, AttributeError, KeyError,
+                pickle.UnpicklingError):
+            pass
+        return None
+
+    def store(self, sha: str, elem_map: dict):
+        data = pickle.dumps({"converter": self.version, "map": elem_map},
+                            protocol=pickle.HIGHEST_PROTOCOL)
+        try:
+            self.dir.mkdir(parents=True, exist_ok=True)
+            _replace_atomic(self.dir / f"{sha}.pickle", lambda tmp: tmp.write_bytes(data))
+        except OSError:
+            pass                    # pasta somente leitura: sem cache
+
+    def prune(self, keep: set):
+        """Apaga os mapas de notebooks que nao existem mais (hash fora de 'keep')."""
+        for path in self.dir.glob("*.pickle"):
+            if path.stem not in keep:
+                path.unlink(missing_ok=True)
+
+
+def chapter_elements(job: tuple) -> dict:
+    """id -> {kind, num_str} de um notebook; job = (maps, nb_path, sha)."""
+    maps, nb_path, sha = job
+    return {elem_id: {"kind": info["kind"], "num_str": info["num_str"]}
+            for elem_id, info in maps.get(sha, nb_path=nb_path).items()}
+
+
+def build_element_index(chapters: list, maps: ElementMaps, jobs: int = 1) -> dict:
+    """
+    Indice global dos capitulos [(nb_path, out_nb), ...], guardado em
+    maps.index: id -> {kind, num_str, notebook}. Mapas fora do cache sao
+    gerados em paralelo com jobs > 1; se dois capitulos definem o mesmo id,
+    vale o primeiro.
+    """
+    index_path = maps.root / ELEMENT_INDEX_NAME
+    try:
+        saved = json.loads(index_path.read_text(encoding="utf-8"))
+        old = saved["chapters"] if saved.get("converter") == maps.version else {}
+    except (OSError, ValueError, KeyError, AttributeError):
+        old = {}
+
+    entries, stale = {}, []
+    for nb_path, _ in chapters:
+        name  = nb_path.as_posix()
+        st    = nb_path.stat()
+        stamp = [st.st_size, st.st_mtime_ns]
+        entry = old.get(name)
+        if entry and entry["stamp"] == stamp:
+            entries[name] = entry
+            continue
+        sha = _sha256(nb_path.read_bytes())
+        if entry and entry["sha"] == sha:
+            entries[name] = {**entry, "stamp": stamp}
+        else:
+            stale.append((nb_path, stamp, sha))
+
+    jobs_list = [(maps, nb_path, sha) for nb_path, _, sha in stale]
+    if jobs > 1 and len(jobs_list) > 1:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(jobs_list))) as pool:
+            parsed = list(pool.map(chapter_elements, jobs_list))
+    else:
+        parsed = [chapter_elements(job) for job in jobs_list]
+    for (nb_path, stamp, sha), elements in zip(stale, parsed):
+        entries[nb_path.as_posix()] = {"stamp": stamp, "sha": sha, "elements": elements}
+
+    if entries != old:
+        maps.root.mkdir(parents=True, exist_ok=True)
+        text = json.dumps({"converter": maps.version, "chapters": entries},
+                          ensure_ascii=False, indent=1)
+        _replace_atomic(index_path, lambda tmp: tmp.write_text(text, encoding="utf-8"))
+        maps.prune({entry["sha"] for entry in entries.values()})
+
+    index = {}
+    for nb_path, _ in chapters:
+        name = nb_path.as_posix()
+        for elem_id, info in entries[name]["elements"].items():
+            index.setdefault(elem_id, {**info, "notebook": name})
+    maps.index = index
+    return index
+
+
+def xref_href(elem_id: str, info: dict) -> str:
+    """Ancora local ou, para um id do indice global, marcador do link (XREF_TARGET_RE)."""
+    if info and "notebook" in info:
+        return f"\x01{info['notebook']}\x01#{elem_id}"
+    return f"#{elem_id}"
+
+
+def rewrite_xref_targets(notebook: dict, target: str):
+    """Troca os marcadores de link entre capitulos pela saida do alvo (target_path)."""
+    def _href(m):
+        nb_path = Path(m.group(1))
+        return target_path(nb_path, Path("..", nb_path.parent.name), target).as_posix() + "#"
+
+    for cell in notebook.get("cells", []):
+        if cell.get("cell_type") != "markdown":
+            continue
+        source = source_to_str(cell.get("source", []))
+        if "\x01" in source:
+            cell["source"] = str_to_source(XREF_TARGET_RE.sub(_href, source))
 
 
 # ---------------------------------------------------------------------------
@@ -828,19 +1563,23 @@ def render_img_element(alt: str, path: str, elem_id: str, label: str, kind: str
         body = img + caption
     return f'<figure id="{elem_id}">\n' + body + '</figure>'
 
+# Imagem com largura:  ![alt](path){width=50%}
+MD_IMG_WIDTH_RE = re.compile(r'!\[.*?\]\((.*?)\)\{.*?width=(.*?)\%?\}')
+
+
 def render_figure_group(content: str, elem_id: str, label_prefix: str, caption: str) -> str:
     """
     Renderiza um grupo de imagens em colunas (layout-ncol=2) com uma única legenda.
     """
     # Tenta extrair as imagens do conteúdo original para colocá-las em uma tabela HTML
-    img_find = re.findall(r'!\[.*?\]\((.*?)\)\{.*?width=(.*?)\%?\}', content)
+    img_find = MD_IMG_WIDTH_RE.findall(content)
     
     if img_find:
-        cols_html = ""
+        cols_html = Emitter()
         for path, width in img_find:
-            cols_html += f'<td style="text-align:center;"><img src="{path}" style="width:{width}%" /></td>'
-        
-        table_html = f'<table style="width:100%; border:none;"><tr style="border:none;">{cols_html}</tr></table>'
+            cols_html.write(f'<td style="text-align:center;"><img src="{path}" style="width:{width}%" /></td>')
+
+        table_html = f'<table style="width:100%; border:none;"><tr style="border:none;">{cols_html.text()}</tr></table>'
         
         return (
             f'<figure id="{elem_id}" style="text-align:center;">\n'
@@ -865,6 +1604,10 @@ def render_tbl_markdown(tbl_body: str, elem_id: str, label_prefix: str, caption:
         f'{tbl_body}\n'
     )
 
+# \textcolor dentro de LaTeX -> \color (MathJax nao tem \textcolor)
+MATH_TEXTCOLOR_RE = re.compile(r'\\textcolor\{([^}]+)\}\{([^}]+)\}')
+
+
 def render_equation(eq_body: str, elem_id: str, num_str: str) -> str:
     """
     Equacao LaTeX -> Renderiza com numero (X.Y) alinhado a direita usando \tag.
@@ -876,7 +1619,7 @@ def render_equation(eq_body: str, elem_id: str, num_str: str) -> str:
         inner = inner[2:-2].strip()
 
     # Mantém a sua lógica de conversão de cores
-    inner = re.sub(r'\\textcolor\{([^}]+)\}\{([^}]+)\}', r'{\\color{\1}{\2}}', inner)
+    inner = MATH_TEXTCOLOR_RE.sub(r'{\\color{\1}{\2}}', inner)
 
     # Usa \tag para a numeração e \label para permitir links internos
     # O <a> invisível serve como âncora para referências cruzadas @eq-*
@@ -886,147 +1629,243 @@ def render_equation(eq_body: str, elem_id: str, num_str: str) -> str:
     )
 
 # ---------------------------------------------------------------------------
-# 8. Processa uma celula: substitui definicoes e referencias
+# 8. Lexer de celulas Markdown: uma varredura, tokens tipados
 # ---------------------------------------------------------------------------
+# Cada regra abaixo corresponde a uma das antigas passagens re.sub de
+# process_cell e recebe o ESTAGIO (posicao) dessa passagem no pipeline.
+# A celula e varrida uma unica vez por uma regex mestre (alternancia das
+# regras ativas): vence o token que comeca mais a esquerda e, na mesma
+# posicao, a regra listada primeiro. O conteudo de um token (corpo de tabela,
+# texto em negrito, legenda...) e renderizado recursivamente com os demais
+# estagios, o que reproduz a ordem do pipeline sequencial sem recopiar a
+# celula inteira a cada passagem.
+
+(ST_MATH, ST_BADGE_LINK, ST_BADGE, ST_TEXTCOLOR, ST_STYLE, ST_TEXTBF,
+ ST_HEADER, ST_EQ, ST_TBL, ST_IMG, ST_XREF_BRACKET, ST_XREF, ST_ESCAPED_AT,
+ ST_CITE_INDIRECT, ST_CITE_DIRECT, ST_FN_DEF, ST_FN_REF) = range(17)
+
+ALL_STAGES = frozenset(range(ST_FN_REF + 1))
+# Estagios de fix_textcolor_inline: o LaTeX ($...$) fica protegido deles
+FORMAT_STAGES = frozenset(range(ST_HEADER))
+# Estagios que ainda atuam dentro de $...$ depois de fix_textcolor_inline
+AFTER_FORMAT_STAGES = ALL_STAGES - FORMAT_STAGES
+
+# (tipo, estagio, padrao) na ordem de prioridade da regex mestre.
+# O slot '$$' e montado a parte em _cell_token_re (depende de ST_MATH/ST_EQ).
+CELL_TOKEN_RULES = (
+    ("math1",       ST_MATH,        r'\$[^\$\n]+\$'),
+    ("badge_link",  ST_BADGE_LINK,  r'\[\!\[\]\((?P<bl_img>[^)]+)\)\{width="(?P<bl_width>[^"]+)"\}\] '
+                                    r'\((?P<bl_url>[^)]+)\)'),
+    ("badge",       ST_BADGE,       r'\!\[\]\((?P<bd_img>[^)]+)\)\{width="(?P<bd_width>[^"]+)"\}'),
+    ("textcolor",   ST_TEXTCOLOR,   r'\\textcolor\{(?P<tc_color>[^}]+)\}'
+                                    r'\{(?P<tc_body>(?:[^{}]|\{[^{}]*\})*)\}'),
+    ("style",       ST_STYLE,       r'\[(?P<st_body>[^\]]+)\]\{style="color:\s*(?P<st_color>[^;}"]+);?"\}'),
+    ("textbf",      ST_TEXTBF,      r'\\textbf\{(?P<bf_body>(?:[^{}]|\{[^{}]*\})*)\}'),
+    ("header",      ST_HEADER,      r'(?P<hd_text>#{1,6}[^\n]+?)\s*\{[.#][^}]*\}'),
+    ("tbl",         ST_TBL,         r'(?s:(?P<tb_body>(?:[ \t]*\|[^\n]+\n)+)'
+                                    r'(?:\n[ \t]*: .*?\s*\{#(?P<tb_id>tbl-[\w-]+)[^}]*\})'
+                                    r'|(?P<tb_body2>(?:[ \t]*\|[^\n]+\n)+)'
+                                    r'(?:[ \t]*\{#(?P<tb_id2>tbl-[\w-]+)[^}]*\}))'),
+    ("img",         ST_IMG,         r'!\[(?P<im_alt>[^\]]*)\]\((?P<im_path>[^)\s"\']+)[^)]*\)'
+                                    r'\{#(?P<im_id>(?P<im_kind>fig|tbl)-[\w-]+)[^}]*\}'),
+    ("xref_bracket", ST_XREF_BRACKET, r'\[(?P<xb_inner>[^\[\]]*@(?:fig|tbl|eq)-[\w-]+[^\[\]]*)\]'),
+    ("xref",        ST_XREF,        r'(?<!\[)@(?P<xr_id>(?:fig|tbl|eq)-[\w-]+)'),
+    # \@fig-* nao e escape: a passagem de cross-refs o consumia antes
+    ("escaped_at",  ST_ESCAPED_AT,  r'\\@(?!(?:fig|tbl|eq)-[\w-])(?P<ea_word>[\w:-]+)'),
+    ("cite_indirect", ST_CITE_INDIRECT, r'\[@(?P<ci_keys>[\w:;@\s,-]+)\]'),
+    ("fn_def",      ST_FN_DEF,      r'(?ms:^\[\^(?P<fd_id>[^\]]+)\]:\s*(?P<fd_body>.*?)(?=\n\[\^|\n\n|\Z))'),
+    ("fn_ref",      ST_FN_REF,      r'\[\^(?P<fr_id>[^\]]+)\]'),
+    ("cite_direct", ST_CITE_DIRECT, r'(?<!\[)@(?P<cd_key>[\w:-]+)'),
+)
 
-def fix_textcolor_inline(text: str) -> str:
-    # 1. Protege blocos de equações para não misturar Markdown/HTML lá dentro
-    placeholders = {}
-    def hide_math(m):
-        key = f"\x00MATH{len(placeholders)}\x00"
-        body = m.group(0)
-        
-        # Dentro da equação, apenas corrigimos \textcolor para \color
-        # e garantimos que \textbf continue sendo LaTeX
-        body = re.sub(
-            r'\\textcolor\{([^}]+)\}\{([^}]+)\}',
-            r'{\\color{\1}{\2}}',
-            body
-        )
-        # Opcional: converter \textbf para \mathbf se quiser negrito matemático
-        # body = body.replace(r'\textbf', r'\mathbf')
-        
-        placeholders[key] = body
-        return key
-    
-    # Esconde equações $...$ e $$...$$
-    text = re.sub(r'\$\$[\s\S]*?\$\$', hide_math, text)
-    text = re.sub(r'\$[^\$\n]+\$', hide_math, text)
-
-    # NOVO: Tratar badges/botões com links e width (ex: Colab/GitHub)
-    # Transforma [![](img){width="16%"}] -> [<img src="img" width="16%">]
-    text = re.sub(
-        r'\[\!\[\]\(([^)]+)\)\{width="([^"]+)"\}\] \(([^)]+)\)',
-        r'<a href="\3"><img src="\1" style="width:\2; vertical-align:middle;"></a>',
-        text
-    )
-    
-    # Caso o badge não tenha link, apenas limpa a sintaxe de width para HTML
-    text = re.sub(
-        r'\!\[\]\(([^)]+)\)\{width="([^"]+)"\}',
-        r'<img src="\1" style="width:\2; vertical-align:middle;">',
-        text
-    )
-
-    # 2. Agora aplica as conversões APENAS no texto Markdown (fora das equações)
-    # \textcolor{cor}{texto} -> <font color="cor">texto</font>
-    text = re.sub(
-        r'\\textcolor\{([^}]+)\}\{((?:[^{}]|\{[^{}]*\})*)\}',
-        r'<font color="\1">\2</font>',
-        text
-    )
-
-    # [texto]{style="color: X;"} -> <font color="X">texto</font>
-    text = re.sub(
-        r'\[([^\]]+)\]\{style="color:\s*([^;}"]+);?"\}',
-        r'<font color="\2">\1</font>',
-        text
-    )
-
-    # \textbf{texto} para **texto** (APENAS fora de equações)
-    text = re.sub(r'\\textbf\{((?:[^{}]|\{[^{}]*\})*)\}', r'**\1**', text)
-
-    # 3. Restaura as equações intactas
-    for key, val in placeholders.items():
-        text = text.replace(key, val)
-        
-    return text
-
-def process_cell(source, key_to_num: dict, elem_map: dict, bib: dict) -> list:
+# Todo token comeca num destes caracteres (a tabela, no recuo antes do '|'):
+# a varredura salta direto entre eles em vez de testar a alternancia inteira
+# em cada posicao da celula.
+CELL_TRIGGER_RE = re.compile(r'[$!\[\\#@|]')
+# Bloco de linhas '|' de uma tabela (o corpo de tb_body/tb_body2)
+TABLE_ROWS_RE = re.compile(r'(?:[ \t]*\|[^\n]+\n)+')
+
+
+@functools.lru_cache(maxsize=None)
+def _cell_token_re(stages: frozenset):
+    """Regex mestre com as regras dos estagios informados."""
+    alts = []
+    # $$ ... $$ (opcionalmente seguido de {#eq-*}) antes do $ ... $ inline
+    if ST_MATH in stages and ST_EQ in stages:
+        alts.append(r'(?P<math2>(?P<eq_body>\$\$[\s\S]*?\$\$)'
+                    r'(?:[ \t]*\n?[ \t]*\{#(?P<eq_id>eq-[\w-]+)[^}]*\})?)')
+    elif ST_MATH in stages:
+        alts.append(r'(?P<math2>\$\$[\s\S]*?\$\$)')
+    elif ST_EQ in stages:
+        alts.append(r'(?P<eq>(?P<eq_body>\$\$[\s\S]*?\$\$)'
+                    r'[ \t]*\n?[ \t]*\{#(?P<eq_id>eq-[\w-]+)[^}]*\})')
+    for kind, stage, pattern in CELL_TOKEN_RULES:
+        if stage in stages:
+            alts.append(f'(?P<{kind}>{pattern})')
+    return re.compile("|".join(alts)) if alts else None
+
+
+def iter_cell_tokens(text: str, stages: frozenset = ALL_STAGES):
     """
-    Aplica em ordem:
-      1. Equacoes  $$ ... $$ {#eq-*}  -> HTML com numero
-      2. Tabelas Markdown {#tbl-*}    -> div com legenda
-      3. Imagens {#fig-*} e {#tbl-*} -> figure com legenda
-      4. Referencias cruzadas @fig-*, @tbl-*, @eq-*  -> links
-      5. Citacoes bibliograficas:
-         @key    -> direta:   Autor (ano)          ABNT NBR 10520
-         [@key]  -> indireta: (AUTOR, ano)
+    Divide o texto em tokens (tipo, valor) numa unica varredura.
+    Tipo 'text' traz a string literal; os demais trazem o re.Match.
+    Tipos: math1, math2, eq, badge_link, badge, textcolor, style, textbf,
+    header, tbl, img, xref_bracket, xref, escaped_at, cite_indirect,
+    cite_direct, fn_def, fn_ref.
     """
-    text = source_to_str(source)
-
-    text = re.sub(r'\{\{<\s*pagebreak\s*>\}\}\n?', '', text)
-
-    # 0. Converte callouts e divs Quarto (::: {.callout-*} ... :::)
-    text = convert_callouts(text, elem_map)
-
-    # 0b. Remove atributos Quarto de titulos: ### Titulo {.unnumbered} -> ### Titulo
-
-    # 0c. textcolor inline (fora de $$)
-    text = fix_textcolor_inline(text)
-
-    # 0b. Remove APENAS atributos Quarto ({.class} ou {#id}), ignorando comandos LaTeX como \mathbf{...}
-    text = re.sub(r'(#{1,6}[^\n]+?)\s*\{([.#][^}]*)\}', r'\1', text)
-
-    # 1b. Converte \textcolor em \color em TODO bloco $$, numerado ou não
-    def fix_textcolor(m):
-        body = m.group(0)
-        return re.sub(
-            r'\\textcolor\{([^}]+)\}\{([^}]+)\}',
-            r'{\\color{\1}{\2}}',
-            body
-        )
-    text = re.sub(r'\$\$[\s\S]*?\$\$', fix_textcolor, text)
-
-    # 1. Equacoes
-    def replace_eq(m):
-        eq_body = m.group(1)
-        elem_id = m.group(2)
+    token_re = _cell_token_re(stages)
+    pos = 0
+    if token_re is not None:
+        find_trigger = CELL_TRIGGER_RE.search
+        match_token = token_re.match
+        i = 0
+        # Se a tabela falhou num '|' (sem legenda {#tbl-*} depois do bloco),
+        # falha tambem nos '|' seguintes do mesmo bloco: testa-los de novo
+        # percorreria o resto do bloco a cada '|' (quadratico em tabelas longas)
+        failed_rows_end = -1
+        while True:
+            t = find_trigger(text, i)
+            if t is None:
+                break
+            start = t.start()
+            if text[start] == "|":
+                if start < failed_rows_end:
+                    i = start + 1
+                    continue
+                # tabela: o token comeca no recuo ([ \t]*) antes do '|'
+                while start > pos and text[start - 1] in " \t":
+                    start -= 1
+            m = match_token(text, start)
+            if m is None:
+                if text[t.start()] == "|":
+                    rows = TABLE_ROWS_RE.match(text, start)
+                    if rows:
+                        failed_rows_end = rows.end()
+                i = t.start() + 1
+                continue
+            if start > pos:
+                yield "text", text[pos:start]
+            kind = m.lastgroup
+            if kind == "math2" and ST_EQ in stages and m.group("eq_id"):
+                kind = "eq"
+            yield kind, m
+            pos = i = m.end()
+    if pos < len(text):
+        yield "text", text[pos:]
+
+
+def render_cell_tokens(text: str, elem_map: dict, bib: dict,
+                       footnotes: dict = None, stages: frozenset = ALL_STAGES) -> str:
+    """
+    Renderiza os tokens de iter_cell_tokens numa unica caminhada.
+    Definicoes de nota de rodape ([^id]: ...) sao removidas do texto e
+    guardadas em 'footnotes' (id -> HTML).
+    """
+    if footnotes is None:
+        footnotes = {}
+    # --profile: tempo de cada token de primeiro nivel (process_cell.tokens.<tipo>),
+    # incluindo a renderizacao dos tokens aninhados nele
+    prof, nesting = _profiler, 0
+
+    def render(s: str, st: frozenset) -> str:
+        nonlocal nesting
+        if not s or not st:
+            return s
+        out = []
+        for kind, tok in iter_cell_tokens(s, st):
+            if kind == "text":
+                out.append(tok)
+            elif prof is None or nesting:
+                out.append(RENDER[kind](tok, st))
+            else:
+                nesting += 1
+                t0 = time.perf_counter()
+                out.append(RENDER[kind](tok, st))
+                prof.add(f"process_cell.tokens.{kind}", time.perf_counter() - t0)
+                nesting -= 1
+        return "".join(out)
+
+    def _without(st: frozenset, stage: int) -> frozenset:
+        return st - {stage}
+
+    def _after(st: frozenset, stage: int) -> frozenset:
+        return frozenset(s for s in st if s > stage)
+
+    def _before(st: frozenset, stage: int) -> frozenset:
+        return frozenset(s for s in st if s < stage)
+
+    # ── LaTeX ─────────────────────────────────────────────────────────────
+    def tok_math2(m, st):
+        body = MATH_TEXTCOLOR_RE.sub(r'{\\color{\1}{\2}}', m.group(0))
+        # Segunda correcao: a antiga passagem "\textcolor em todo bloco $$"
+        body = MATH_TEXTCOLOR_RE.sub(r'{\\color{\1}{\2}}', body)
+        return render(body, st & AFTER_FORMAT_STAGES)
+
+    def tok_math1(m, st):
+        body = MATH_TEXTCOLOR_RE.sub(r'{\\color{\1}{\2}}', m.group(0))
+        return render(body, st & AFTER_FORMAT_STAGES)
+
+    def tok_eq(m, st):
+        eq_body = MATH_TEXTCOLOR_RE.sub(r'{\\color{\1}{\2}}', m.group("eq_body"))
+        eq_body = render(eq_body, _before(st & AFTER_FORMAT_STAGES, ST_EQ))
+        elem_id = m.group("eq_id")
         info = elem_map.get(elem_id)
         if info:
             num_str = info["num_str"]
         else:
             num_str = _chapter_from_id(elem_id) or elem_id
-        return render_equation(eq_body, elem_id, num_str)
-
-    text = EQ_DEF_RE.sub(replace_eq, text)
-
-    # 2. Tabelas Markdown 
-    def replace_tbl_md(m):
-        tbl_body = m.group(1).rstrip()
-        elem_id  = m.group(3) or m.group(4)
+        return render(render_equation(eq_body, elem_id, num_str), _after(st, ST_EQ))
+
+    # ── Formatacao (antiga fix_textcolor_inline) e titulos ────────────────
+    def tok_badge_link(m, st):
+        st = _without(st, ST_BADGE_LINK)
+        img, width, url = (render(m.group(g), st) for g in ("bl_img", "bl_width", "bl_url"))
+        return f'<a href="{url}"><img src="{img}" style="width:{width}; vertical-align:middle;"></a>'
+
+    def tok_badge(m, st):
+        st = _without(st, ST_BADGE)
+        img, width = (render(m.group(g), st) for g in ("bd_img", "bd_width"))
+        return f'<img src="{img}" style="width:{width}; vertical-align:middle;">'
+
+    def tok_textcolor(m, st):
+        st = _without(st, ST_TEXTCOLOR)
+        color = render(m.group("tc_color"), st)
+        return f'<font color="{color}">{render(m.group("tc_body"), st)}</font>'
+
+    def tok_style(m, st):
+        st = _without(st, ST_STYLE)
+        color = render(m.group("st_color"), st)
+        return f'<font color="{color}">{render(m.group("st_body"), st)}</font>'
+
+    def tok_textbf(m, st):
+        return f'**{render(m.group("bf_body"), _without(st, ST_TEXTBF))}**'
+
+    def tok_header(m, st):
+        # ### Titulo {.unnumbered} -> ### Titulo
+        return render(m.group("hd_text"), _without(st, ST_HEADER))
+
+    # ── Definicoes de tabela e figura ─────────────────────────────────────
+    def tok_tbl(m, st):
+        tbl_body = render(m.group("tb_body") or m.group("tb_body2"), _without(st, ST_TBL)).rstrip()
+        elem_id = m.group("tb_id") or m.group("tb_id2")
         info = elem_map.get(elem_id)
         if info:
-            return render_tbl_markdown(tbl_body, elem_id, info["label_prefix"], info["caption"])
-        else:
-            return render_tbl_markdown(tbl_body, elem_id, f"Tabela {_chapter_from_id(elem_id)}:", "")
-        
-    text = TBL_MD_RE.sub(replace_tbl_md, text)
-
-    # 3. Imagens (fig e tbl-imagem)
-    def replace_img(m):
-        alt     = m.group(1)
-        path    = m.group(2)
-        elem_id = m.group(3)
-        kind    = m.group(4)             # "fig" ou "tbl"
+            caption = render(info["caption"], _after(st, ST_TBL))
+            return render_tbl_markdown(tbl_body, elem_id, info["label_prefix"], caption)
+        return render_tbl_markdown(tbl_body, elem_id, f"Tabela {_chapter_from_id(elem_id)}:", "")
+
+    def tok_img(m, st):
+        st = _without(st, ST_IMG)
+        alt, path = render(m.group("im_alt"), st), render(m.group("im_path"), st)
+        elem_id = m.group("im_id")
+        kind = m.group("im_kind")             # "fig" ou "tbl"
         info = elem_map.get(elem_id)
         label = info["label"] if info else \
             ("Figura" if kind == "fig" else "Tabela") + \
             f" {_chapter_from_id(elem_id) or elem_id}"
         return render_img_element(alt, path, elem_id, label, kind)
 
-    text = IMG_DEF_RE.sub(replace_img, text)
-
+    # ── Referencias cruzadas ──────────────────────────────────────────────
     def _num_str_for(elem_id: str) -> str:
         """Retorna o num_str do elemento ou fallback."""
         info = elem_map.get(elem_id)
@@ -1034,6 +1873,10 @@ def process_cell(source, key_to_num: dict, elem_map: dict, bib: dict) -> list:
             return info.get("num_str") or elem_id
         return _chapter_from_id(elem_id) or elem_id
 
+    def _href_for(elem_id: str) -> str:
+        """Ancora local ou, vindo do indice global, link para o notebook do outro capitulo."""
+        return xref_href(elem_id, elem_map.get(elem_id))
+
     def _prefix_for(elem_id: str) -> str:
         """Retorna o prefixo textual (Figura/Tabela/Equação)."""
         info = elem_map.get(elem_id)
@@ -1041,13 +1884,12 @@ def process_cell(source, key_to_num: dict, elem_map: dict, bib: dict) -> list:
         return "Tabela" if kind_raw == "tbl" else \
             "Figura" if kind_raw == "fig" else "Equação"
 
-    def replace_crossref_bracket(m):
+    def tok_xref_bracket(m, st):
         """[-@id] -> numero so;  [Texto @id] -> Texto numero."""
-        inner   = m.group(1)           # conteudo dentro de [...]
-        # Extrai o id (fig|tbl|eq)-...
-        id_m = re.search(r'@((fig|tbl|eq)-[\w-]+)', inner)
+        inner = render(m.group("xb_inner"), _before(st, ST_XREF_BRACKET))
+        id_m = CROSSREF_AT_RE.search(inner)
         if not id_m:
-            return m.group(0)          # nao e cross-ref, nao mexe
+            return render(m.group(0), _after(st, ST_XREF_BRACKET))
         elem_id = id_m.group(1)
         num     = _num_str_for(elem_id)
         # Parte antes do @  (ex: "Graf. " ou "-" ou vazio)
@@ -1056,156 +1898,358 @@ def process_cell(source, key_to_num: dict, elem_map: dict, bib: dict) -> list:
             label_curto = f"{prefix_text} {num}"
         else:
             label_curto = num           # [-@id] -> apenas o numero
-        return f"[{label_curto}](#{elem_id})"
+        return render(f"[{label_curto}]({_href_for(elem_id)})", _after(st, ST_XREF_BRACKET))
 
-    def replace_crossref_bare(m):
+    def tok_xref(m, st):
         """@id isolado (fora de []) -> [Figura/Tabela/Equação X.Y](#id)."""
-        elem_id = m.group(1)
-        if CROSSREF_RE.match(elem_id):
-            # confirma que é cross-ref (fig|tbl|eq|sec...)
-            num = _num_str_for(elem_id)
-            prefix = _prefix_for(elem_id)
-            return f"[{prefix} {num}](#{elem_id})"
-        return m.group(0)
-
-    # Primeiro: colchetes com @  [texto @id]  ou  [-@id]
-    text = re.sub(r'\[([^\]]*@(?:fig|tbl|eq)-[\w-]+[^\]]*)\]',
-                replace_crossref_bracket, text)
-    # Depois: @id isolado, nao precedido de [
-    text = re.sub(r'(?<!\[)@((fig|tbl|eq)-[\w-]+)', replace_crossref_bare, text)
-
-
-    # 5. Citacoes bibliograficas
-
-    def _fmt_key(key: str, mode: str) -> str:
-        """Formata uma chave bib no modo 'direct' ou 'indirect'."""
-        key = key.strip().lstrip("@")
-        if key not in bib:
-            return f"?{key}"
-        if mode == "direct":
-            return cite_direct(bib[key])
-        else:
-            # Indireta sem parênteses externos (serão adicionados depois)
-            return cite_indirect(bib[key])
+        elem_id = m.group("xr_id")
+        return f"[{_prefix_for(elem_id)} {_num_str_for(elem_id)}]({_href_for(elem_id)})"
+
+    def tok_escaped_at(m, st):
+        # \@palavra: escape Quarto para @ literal (nao e citacao)
+        return "@" + m.group("ea_word")
 
-    def replace_indirect(m):
+    # ── Citacoes bibliograficas ───────────────────────────────────────────
+    def tok_cite_indirect(m, st):
         """[@key] ou [@key1; @key2] -> (AUTOR1, ano; AUTOR2, ano)"""
-        inner = m.group(1)
-        keys  = [k.strip() for k in re.split(r'[;,]', inner)]
-        parts = []
-        for k in keys:
-            k = k.lstrip("@").strip()
-            if not k:
-                continue
-            if k not in bib:
-                parts.append(f"?{k}")
-                continue
-            fields = bib[k]
-            year     = fields.get("year", "s.d.")
-            surnames = _last_names(fields.get("author", ""))
-            upper    = [s.upper() for s in surnames]
-            if not upper:
-                parts.append(f"({year})")
-            elif len(upper) == 1:
-                parts.append(f"{upper[0]}, {year}")
-            elif len(upper) == 2:
-                parts.append(f"{upper[0]}; {upper[1]}, {year}")
-            else:
-                parts.append(f"{upper[0]} et al., {year}")
-        return "(" + "; ".join(parts) + ")"
+        return citation_renderer(bib).indirect(m.group("ci_keys"))
 
-    def replace_direct(m):
+    def tok_cite_direct(m, st):
         """@key isolado (fora de colchetes) -> Autor (ano)"""
-        key = m.group(1)
+        key = m.group("cd_key")
         if CROSSREF_RE.match(key):
-            return m.group(0)   # deixa para o passo 4 tratar
-        return _fmt_key(key, "direct")
-    
-    # Protege \@palavra (escape Quarto para @ literal) com placeholder
-    ESCAPED_AT = "\x00ESCAPED_AT\x00"
-    text = re.sub(r'\\@([\w:-]+)', lambda m: f'{ESCAPED_AT}{m.group(1)}', text)
-
-    # Indireta primeiro (evita que @key dentro de [] seja consumido pelo direto)
-    text = re.sub(r'\[@([\w:;@\s,-]+)\]', replace_indirect, text)
-    # Direta: @key isolado, nao precedido de [
-    text = re.sub(r'(?<!\[)@([\w:-]+)', replace_direct, text)
+            return m.group(0)
+        return citation_renderer(bib).direct(key)
 
-    # --- Processamento de Footnotes ---
-    # 1. Captura as definições [^1]: Conteúdo
-    footnote_defs = {}
-    def extract_fn(m):
-        fn_id = m.group(1)
-        content = m.group(2).strip()
+    # ── Notas de rodape ───────────────────────────────────────────────────
+    def tok_fn_def(m, st):
+        content = render(m.group("fd_body"), _before(st, ST_FN_DEF)).strip()
         # Converte links markdown dentro da nota para HTML para não quebrar
-        content = md_inline_to_html(content)
-        footnote_defs[fn_id] = content
-        return "" # Remove a definição do corpo do texto
-
-    # Regex para capturar definições multilinhas (com indentação)
-    text = re.sub(r'^\[\^([^\]]+)\]:\s*(.*?)(?=\n\[\^|\n\n|\Z)', extract_fn, text, flags=re.MULTILINE | re.DOTALL)
+        footnotes[m.group("fd_id")] = md_inline_to_html(content)
+        return ""  # Remove a definição do corpo do texto
 
-    # 2. Substitui as menções [^1] por um <sup> linkado
-    def replace_fn_ref(m):
-        fn_id = m.group(1)
+    def tok_fn_ref(m, st):
+        fn_id = m.group("fr_id")
         return f'<sup title="{fn_id}">[{fn_id}]</sup>'
-    
-    text = re.sub(r'\[\^([^\]]+)\]', replace_fn_ref, text)
 
-    # 3. Se houver notas, anexa um bloco formatado ao final do texto
+    RENDER = {
+        "math2": tok_math2, "math1": tok_math1, "eq": tok_eq,
+        "badge_link": tok_badge_link, "badge": tok_badge,
+        "textcolor": tok_textcolor, "style": tok_style, "textbf": tok_textbf,
+        "header": tok_header, "tbl": tok_tbl, "img": tok_img,
+        "xref_bracket": tok_xref_bracket, "xref": tok_xref,
+        "escaped_at": tok_escaped_at, "cite_indirect": tok_cite_indirect,
+        "cite_direct": tok_cite_direct, "fn_def": tok_fn_def, "fn_ref": tok_fn_ref,
+    }
+
+    # Notas de rodape sao da celula inteira: o fim de uma definicao ([^id]: ...
+    # ate a linha em branco) so e conhecido depois que tabelas e equacoes foram
+    # expandidas, entao elas ganham uma segunda caminhada -- apenas se houver [^
+    fn_stages = stages & {ST_FN_DEF, ST_FN_REF}
+    if fn_stages and "[^" in text:
+        return render(render(text, stages - fn_stages), fn_stages)
+    return render(text, stages)
+
+
+# ---------------------------------------------------------------------------
+# 8b. Processa uma celula: substitui definicoes e referencias
+# ---------------------------------------------------------------------------
+
+PAGEBREAK_RE = re.compile(r'\{\{<\s*pagebreak\s*>\}\}\n?')
+
+
+def fix_textcolor_inline(text: str) -> str:
+    """
+    \\textcolor, \\textbf, [texto]{style="color: X"} e badges com width fora de
+    $...$ -> HTML/Markdown; dentro de $...$ apenas \\textcolor -> \\color.
+    """
+    return render_cell_tokens(text, {}, {}, stages=FORMAT_STAGES)
+
+
+def process_cell(source, key_to_num: dict, elem_map: dict, bib: dict) -> list:
+    """
+    Converte callouts (bloco a bloco) e depois renderiza os tokens da celula
+    numa unica varredura (ver iter_cell_tokens):
+      - LaTeX, \\textcolor/\\textbf, badges e atributos de titulos
+      - Equacoes  $$ ... $$ {#eq-*}  -> HTML com numero
+      - Tabelas Markdown {#tbl-*}    -> div com legenda
+      - Imagens {#fig-*} e {#tbl-*} -> figure com legenda
+      - Referencias cruzadas @fig-*, @tbl-*, @eq-*  -> links
+      - Citacoes bibliograficas:
+         @key    -> direta:   Autor (ano)          ABNT NBR 10520
+         [@key]  -> indireta: (AUTOR, ano)
+      - Notas de rodape [^id] -> <sup> + bloco de notas ao final
+    """
+    text = source_to_str(source)
+
+    with profile_stage("process_cell.pagebreak"):
+        text = PAGEBREAK_RE.sub('', text)
+
+    # Converte callouts e divs Quarto (::: {.callout-*} ... :::)
+    with profile_stage("process_cell.callouts"):
+        text = convert_callouts(text, elem_map)
+
+    footnote_defs = {}
+    with profile_stage("process_cell.tokens"):
+        text = render_cell_tokens(text, elem_map, bib, footnote_defs)
+
+    # Se houver notas, anexa um bloco formatado ao final do texto
     if footnote_defs:
-        notes_html = '<hr><div style="font-size: 0.85em; color: #555;"><strong>Notas:</strong><br>\n'
+        out = Emitter()
+        out.write(text, '\n\n<hr><div style="font-size: 0.85em; color: #555;">'
+                        '<strong>Notas:</strong><br>\n')
         for fn_id, content in footnote_defs.items():
             # Limpa quebras de linha extras e espaços
             content = content.replace('\n', ' ')
-            notes_html += f'[{fn_id}] {content}<br>\n'
-        notes_html += '</div>'
-        text += "\n\n" + notes_html
+            out.write(f'[{fn_id}] {content}<br>\n')
+        out.write('</div>')
+        text = out.text()
 
-    text = text.replace(ESCAPED_AT, '@')
     return str_to_source(text)
 
 
 # ---------------------------------------------------------------------------
-# 9. Extrai citacoes bibliograficas (exclui cross-refs)
+# 8c. Cache de celulas processadas (<out_dir>/.cell-cache)
 # ---------------------------------------------------------------------------
-def extract_citations(notebook: dict) -> list:
-    seen, ordered = set(), []
-    # Captura @key mas NÃO precedido de \ (ex: \@relation é escape Quarto, não citação)
-    cite_re = re.compile(r'(?<!\\)@([\w:-]+)')
-    escaped_re = re.compile(r'\\@[\w:-]+')    # \@palavra — escape Quarto, nao e citacao
+# Entre dois builds quase todas as celulas Markdown sao as mesmas. O
+# resultado de process_cell fica em <out_dir>/.cell-cache/ab/<chave>.pickle,
+# com a chave = hash do conversor + texto da celula + so as entradas do
+# mapa de elementos e do .bib que a celula cita (@id, #id): corrigir um
+# paragrafo reprocessa so aquela celula, e renumerar uma figura so as que
+# a citam. convert_callouts anota as subfiguras no mapa (label_prefix):
+# essas alteracoes vao junto e sao reaplicadas num acerto. Cada acerto
+# renova o mtime do arquivo; prune apaga os mais antigos acima do limite.
+
+CELL_CACHE_NAME = ".cell-cache"
+CELL_REF_RE = re.compile(r'[@#]([\w-]+)([\w:-]*)')     # ids ([\w-]) e chaves do .bib ([\w:-])
+
+
+class CellCache:
+    """process_cell com memoizacao em disco, contagem de acertos e limite de tamanho."""
+
+    def __init__(self, root: Path, max_bytes: int = 64 << 20, read: bool = True):
+        self.dir       = root / CELL_CACHE_NAME
+        self.version   = converter_version()
+        self.max_bytes = max_bytes
+        self.read      = read       # False (--force): so grava
+        self.hits      = 0
+        self.misses    = 0
+
+    def key(self, text: str, elem_map: dict, bib: dict) -> tuple:
+        """(chave, ids do mapa citados pela celula)."""
+        refs = set()
+        for m in CELL_REF_RE.finditer(text):
+            refs.add(m.group(1))
+            refs.add(m.group(1) + m.group(2))
+        ids  = sorted(refs & elem_map.keys())
+        deps = [[k, elem_map[k]] for k in ids] + [[k, bib[k]] for k in sorted(refs & bib.keys())]
+        digest = json.dumps(deps, ensure_ascii=False, sort_keys=True)
+        return _sha256(f"{self.version}\0{text}\0{digest}".encode("utf-8")), ids
+
+    def process(self, source, key_to_num: dict, elem_map: dict, bib: dict) -> list:
+        """Mesmo resultado de process_cell(source, ...), do cache quando possivel."""
+        key, ids = self.key(source_to_str(source), elem_map, bib)
+        path = self.dir / key[:2] / f"{key}.pickle"
+        if self.read:
+            try:
+                with open(path, "rb") as f:
+                    saved = pickle.load(f)
+                for elem_id, info in saved["effects"].items():
+                    elem_map[elem_id].update(info)
+                os.utime(path)
+                self.hits += 1
+                return saved["source"]
+            except (OSError, EOFError, ValueError, TypeError, AttributeError, KeyError,
+                    pickle.UnpicklingError):
+                pass
+        self.misses += 1
+        before = {k: dict(elem_map[k]) for k in ids}
+        result = process_cell(source, key_to_num, elem_map, bib)
+        effects = {k: elem_map[k] for k in ids if elem_map[k] != before[k]}
+        data = pickle.dumps({"source": result, "effects": effects},
+                            protocol=pickle.HIGHEST_PROTOCOL)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            _replace_atomic(path, lambda tmp: tmp.write_bytes(data))
+        except OSError:
+            pass                    # pasta somente leitura: sem cache
+        return result
+
+    def prune(self) -> tuple:
+        """Apaga as entradas menos usadas acima de max_bytes: (removidas, bytes restantes)."""
+        entries = []
+        for path in self.dir.glob("*/*.pickle"):
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, path))
+        total, removed = sum(size for _, size, _ in entries), 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            removed += 1
+        return removed, total
 
+
+def cell_cache_for(out_root: Path, max_mb: int, force: bool = False):
+    """CellCache em <out_root>/.cell-cache (None com --cell-cache-mb 0)."""
+    if max_mb <= 0:
+        return None
+    return CellCache(out_root, max_mb << 20, read=not force)
+
+
+def report_cell_cache(cell_cache: CellCache):
+    """
+    Aplica o limite de tamanho e resume o cache de celulas. Zera as
+    contagens: no --watch, cada rodada relata so as suas.
+    """
+    if cell_cache is None:
+        return
+    removed, total = cell_cache.prune()
+    line = f"Cache de celulas: {total / 1e6:.1f} MB"
+    if cell_cache.hits or cell_cache.misses:
+        looked = cell_cache.hits + cell_cache.misses
+        line += (f", {cell_cache.hits}/{looked} celulas reaproveitadas "
+                 f"({100 * cell_cache.hits / looked:.0f}%)")
+    if removed:
+        line += f", {removed} entradas antigas removidas"
+    print(line)
+    cell_cache.hits = cell_cache.misses = 0
+
+
+# ---------------------------------------------------------------------------
+# 9. Extrai citacoes bibliograficas (exclui cross-refs)
+# ---------------------------------------------------------------------------
+# Captura @key mas NÃO precedido de \ (ex: \@relation é escape Quarto, não citação)
+CITE_KEY_RE = re.compile(r'(?<!\\)@([\w:-]+)')
+ESCAPED_AT_RE = re.compile(r'\\@[\w:-]+')    # \@palavra — escape Quarto, nao e citacao
+
+
+def extract_citations(notebook: dict) -> list:
+    seen, ordered = set(), []
     for cell in notebook.get("cells", []):
-        if cell.get("cell_type") != "markdown":
-            continue
-        source = source_to_str(cell.get("source", []))
-        # Remove ocorrencias escapadas antes de buscar citacoes
-        source_clean = escaped_re.sub('', source)
-        
-        for m in cite_re.finditer(source_clean):
-            key = m.group(1)
-            if CROSSREF_RE.match(key):
-                continue
-            if key not in seen:
-                seen.add(key)
-                ordered.append(key)
+        if cell.get("cell_type") == "markdown":
+            collect_citations(source_to_str(cell.get("source", [])), seen, ordered)
     return ordered
 
+
+def collect_citations(source: str, seen: set, ordered: list):
+    """Acrescenta a 'ordered' as chaves citadas em 'source' ainda fora de 'seen'."""
+    # Remove ocorrencias escapadas antes de buscar citacoes
+    source_clean = ESCAPED_AT_RE.sub('', source)
+
+    for m in CITE_KEY_RE.finditer(source_clean):
+        key = m.group(1)
+        if CROSSREF_RE.match(key):
+            continue
+        if key not in seen:
+            seen.add(key)
+            ordered.append(key)
+
+MD_IMG_PATH_RE = re.compile(r'!\[.*?\]\(([^)\s"\']+)', re.DOTALL)
+HTML_IMG_SRC_RE = re.compile(r'<img[^>]+src=["\']([^"\']+)["\']')
+REMOTE_PATH_RE = re.compile(r'https?://|data:')     # nao sao copiadas
+
+
 def extract_image_paths(notebook: dict) -> list:
     found = set()
-    md_img_re = re.compile(r'!\[.*?\]\(([^)\s"\']+)', re.DOTALL)
+    for cell in notebook.get("cells", []):
+        if cell.get("cell_type") == "markdown":
+            collect_image_paths(source_to_str(cell.get("source", [])), found)
+    return local_image_paths(found)
+
+
+def collect_image_paths(source: str, found: set):
+    for m in MD_IMG_PATH_RE.finditer(source):
+        found.add(m.group(1))
+    for m in HTML_IMG_SRC_RE.finditer(source):
+        found.add(m.group(1))
+
 
-    html_img_re = re.compile(r'<img[^>]+src=["\']([^"\']+)["\']')
+def local_image_paths(found: set) -> list:
+    """Caminhos de 'found' a copiar: ordenados, sem URLs remotas e data URIs."""
+    return sorted(p for p in found if not REMOTE_PATH_RE.match(p))
+
+
+def sub_image_paths(text: str, new_path) -> str:
+    """
+    Troca os caminhos de imagem de 'text' (os mesmos padroes de
+    extract_image_paths: ![...](...) e <img src>, inclusive os gerados por
+    render_img_element, convert_callouts e os badges) por new_path(caminho);
+    None mantem o caminho.
+    """
+    def _swap(m):
+        new = new_path(m.group(1))
+        if new is None:
+            return m.group(0)
+        start, end = m.span(1)
+        return m.group(0)[:start - m.start()] + new + m.group(0)[end - m.start():]
+
+    return HTML_IMG_SRC_RE.sub(_swap, MD_IMG_PATH_RE.sub(_swap, text))
+
+
+def rewrite_image_paths(notebook: dict, renamed: dict):
+    """Aplica sub_image_paths com o mapa 'renamed' as celulas Markdown."""
     for cell in notebook.get("cells", []):
         if cell.get("cell_type") != "markdown":
             continue
         source = source_to_str(cell.get("source", []))
-        for m in md_img_re.finditer(source):
-            found.add(m.group(1))
-        for m in html_img_re.finditer(source):
-            found.add(m.group(1))
-    return sorted(p for p in found if not re.match(r'https?://|data:', p))
+        changed = sub_image_paths(source, renamed.get)
+        if changed != source:
+            cell["source"] = str_to_source(changed)
+
+
+def inline_images(notebook: dict, nb_dir: Path, inliner: "ImageInliner",
+                  inlined: set = None) -> int:
+    """
+    Embute no notebook as imagens locais das celulas Markdown: como anexos
+    da celula (attachment:<hash>.<ext>) ou data URIs, conforme inliner.mode.
+    Cada imagem e codificada uma vez por notebook (e por execucao, com o
+    cache do inliner). Retorna o numero de imagens distintas embutidas;
+    'inlined' recebe os caminhos delas (relativos a nb_dir).
+    """
+    encoded = {}                # img_rel -> (nome do anexo, mime, base64) ou None
+
+    def _encode(img_rel):
+        if img_rel not in encoded:
+            encoded[img_rel] = None
+            if inliner.handles(img_rel) and not REMOTE_PATH_RE.match(img_rel):
+                src = nb_dir / img_rel
+                if not src.exists():
+                    src = Path(img_rel)         # mesmo fallback de copy_images
+                if src.exists():
+                    encoded[img_rel] = inliner.encode(src)
+                    if inlined is not None:
+                        inlined.add(img_rel)
+                else:
+                    print(f"  [!] Imagem nao encontrada: {nb_dir / img_rel}")
+        return encoded[img_rel]
 
+    for cell in notebook.get("cells", []):
+        if cell.get("cell_type") != "markdown":
+            continue
+        attachments = {}
+
+        def _inline(img_rel):
+            enc = _encode(img_rel)
+            if enc is None:
+                return None
+            name, mime, b64 = enc
+            if inliner.mode == "data-uri":
+                return f"data:{mime};base64,{b64}"
+            attachments[name] = {mime: b64}
+            return f"attachment:{name}"
 
+        source = source_to_str(cell.get("source", []))
+        changed = sub_image_paths(source, _inline)
+        if changed != source:
+            cell["source"] = str_to_source(changed)
+        if attachments:
+            cell.setdefault("attachments", {}).update(attachments)
+    return len({enc[0] for enc in encoded.values() if enc})
 
 
 # ---------------------------------------------------------------------------
@@ -1229,95 +2273,265 @@ def clean_notebook(notebook: dict) -> dict:
       - Remove celulas de secao de referencias antiga (substituida pela injetada)
     Retorna o notebook modificado in-place.
     """
-    # Remove metadados quarto
+    strip_quarto_metadata(notebook)
+    cleaned, removed = [], new_cleanup_counts()
+    for cell in notebook.get("cells", []):
+        if cell.get("cell_type") == "markdown":
+            intro = ref_section_intro(source_to_str(cell.get("source", [])))
+            if intro is not None:
+                notebook["_ref_intro"] = intro
+        cell = clean_cell(cell, removed)
+        if cell is not None:
+            cleaned.append(cell)
+    notebook["cells"] = cleaned
+    report_cleanup(removed)
+    return notebook
+
+
+def strip_quarto_metadata(notebook: dict):
     meta = notebook.get("metadata", {})
     for key in ("quarto", "quarto-version"):
         meta.pop(key, None)
 
-    cleaned = []
-    removed = {
-        "yaml": 0, 
-        "empty_code": 0, 
-        "ref_section": 0, 
-        "quarto_params": 0  # <--- Esta linha resolve o KeyError
-    }
 
-    for cell in notebook.get("cells", []):
-        src = source_to_str(cell.get("source", []))
-        kind = cell.get("cell_type", "")
+def new_cleanup_counts() -> dict:
+    return {"yaml": 0, "empty_code": 0, "ref_section": 0, "quarto_params": 0}
 
-        # Limpa parâmetros Quarto e injeta tag de ocultar no Colab
-        if kind == "code":
-            lines = src.splitlines(keepends=True)
-            
-            # 1. Verifica se deve esconder (echo: false)
-            #should_hide = any("echo: false" in l for l in lines)
-            has_output = bool(cell.get("outputs"))
-            should_hide = any("echo: false" in l for l in lines) and has_output
-            
-            # 2. Filtra: remove linhas #| E remove qualquer # @title que já exista
-            # para evitar a duplicação que você observou
-            new_lines = [
-                l for l in lines 
-                if not l.strip().startswith("#|") and 
-                not l.strip().startswith("# @title")
-            ]
-            
-            # 3. Se houve limpeza de parâmetros Quarto
-            if len(new_lines) != len(lines):
-                removed["quarto_params"] += 1
-                
-                # Une as linhas e remove linhas em branco do topo
-                src = "".join(new_lines).lstrip('\n').lstrip('\r')
-                
-                # 4. Injeta a tag apenas UMA vez se for echo: false
-                if should_hide:
-                    src = "# @title { display-mode: \"form\" }\n" + src
-                
-                cell["source"] = str_to_source(src)
-                
-                # 5. Ajusta metadados para garantir que o Colab oculte
-                if should_hide:
-                    if "metadata" not in cell: cell["metadata"] = {}
-                    cell["metadata"]["cellView"] = "form"
-                    cell["metadata"]["jupyter"] = {"source_hidden": True}
-
-        # Celulas raw YAML (--- ... ---)
-        if kind == "raw" and src.strip().startswith("---"):
-            removed["yaml"] += 1
-            continue
 
-        # Celulas de codigo vazias
-        if kind == "code" and not src.strip():
-            removed["empty_code"] += 1
-            continue
+def ref_section_intro(src: str):
+    """
+    Paragrafo introdutorio de uma celula de secao de referencias antiga
+    (linhas que nao sao ## titulo nem \\printbibliography); None se 'src'
+    nao e essa secao.
+    """
+    if not REF_SECTION_RE.search(src):
+        return None
+    intro_lines = [
+        l for l in src.splitlines()
+        if l.strip()
+        and not REF_SECTION_RE.match(l.strip())
+        and not l.strip().startswith("\\printbibliography")
+        and not l.strip().startswith("\\")
+    ]
+    return "\n".join(intro_lines)
+
+
+def clean_cell(cell: dict, removed: dict):
+    """
+    Uma celula de clean_notebook: a celula (limpa in-place) ou None se ela
+    sai do notebook; 'removed' (new_cleanup_counts) soma as remocoes.
+    """
+    src = source_to_str(cell.get("source", []))
+    kind = cell.get("cell_type", "")
 
-        # Secao de referencias antiga (sera substituida pela injetada)
-        if kind == "markdown" and REF_SECTION_RE.search(src):
-            removed["ref_section"] += 1
-            # Guarda o parágrafo introdutório (linhas que não são ## título nem \printbibliography)
-            intro_lines = [
-                l for l in src.splitlines()
-                if l.strip()
-                and not REF_SECTION_RE.match(l.strip())
-                and not l.strip().startswith("\\printbibliography")
-                and not l.strip().startswith("\\")
-            ]
-            notebook["_ref_intro"] = "\n".join(intro_lines)
-            continue
+    # Limpa parâmetros Quarto e injeta tag de ocultar no Colab
+    if kind == "code":
+        lines = src.splitlines(keepends=True)
 
-        cleaned.append(cell)
+        # 1. Verifica se deve esconder (echo: false)
+        #should_hide = any("echo: false" in l for l in lines)
+        has_output = bool(cell.get("outputs"))
+        should_hide = any("echo: false" in l for l in lines) and has_output
 
-    notebook["cells"] = cleaned
+        # 2. Filtra: remove linhas #| E remove qualquer # @title que já exista
+        # para evitar a duplicação que você observou
+        new_lines = [
+            l for l in lines 
+            if not l.strip().startswith("#|") and 
+            not l.strip().startswith("# @title")
+        ]
+
+        # 3. Se houve limpeza de parâmetros Quarto
+        if len(new_lines) != len(lines):
+            removed["quarto_params"] += 1
+
+            # Une as linhas e remove linhas em branco do topo
+            src = "".join(new_lines).lstrip('\n').lstrip('\r')
+
+            # 4. Injeta a tag apenas UMA vez se for echo: false
+            if should_hide:
+                src = "# @title { display-mode: \"form\" }\n" + src
+
+            cell["source"] = str_to_source(src)
+
+            # 5. Ajusta metadados para garantir que o Colab oculte
+            if should_hide:
+                if "metadata" not in cell: cell["metadata"] = {}
+                cell["metadata"]["cellView"] = "form"
+                cell["metadata"]["jupyter"] = {"source_hidden": True}
+
+    # Celulas raw YAML (--- ... ---)
+    if kind == "raw" and src.strip().startswith("---"):
+        removed["yaml"] += 1
+        return None
 
+    # Celulas de codigo vazias
+    if kind == "code" and not src.strip():
+        removed["empty_code"] += 1
+        return None
+
+    # Secao de referencias antiga (sera substituida pela injetada)
+    if kind == "markdown" and REF_SECTION_RE.search(src):
+        removed["ref_section"] += 1
+        return None
+
+    return cell
+
+
+def report_cleanup(removed: dict):
     if any(removed.values()):
         parts = []
         if removed["yaml"]:        parts.append(f"{removed['yaml']} celulas YAML")
         if removed["empty_code"]:  parts.append(f"{removed['empty_code']} cod.vazias")
         if removed["ref_section"]: parts.append(f"{removed['ref_section']} secoes-ref antigas")
         print(f"  Limpeza: removidas {', '.join(parts)}")
-        
-    return notebook
+
+# ---------------------------------------------------------------------------
+# 10b. Politica de outputs das celulas de codigo (--outputs)
+# ---------------------------------------------------------------------------
+# Os outputs (PNG em base64, tabelas HTML do pandas) sao quase todo o peso
+# do capXX_aluno.ipynb. Modos, por capitulo:
+#   keep           mantem tudo (padrao)
+#   strip          apaga os outputs: o aluno executa as celulas
+#   externalize    grava as imagens em images/output-<hash>.png e troca o
+#                  blob por um <img src>
+#   truncate-html  corta as linhas de tabelas text/html acima do limite
+# Aplicada antes da injecao de legendas: as celulas #| label: fig-* mantem
+# a legenda (apos a imagem externalizada ou como unico output).
+
+OUTPUT_MODES = ("keep", "strip", "externalize", "truncate-html")
+EXTERNAL_IMAGE_MIME = {"image/png": ".png", "image/jpeg": ".jpg", "image/gif": ".gif"}
+TABLE_ROW_END_RE = re.compile(r'</tr>', re.IGNORECASE)
+TABLE_BODY_END_RE = re.compile(r'</tbody>|</table>', re.IGNORECASE)
+
+
+class OutputPolicy:
+    """Modo de outputs padrao, excecoes por capitulo (capXX) e limite do truncate-html."""
+
+    def __init__(self, mode: str = "keep", per_chapter: dict = None,
+                 html_limit: int = 50_000):
+        self.mode        = mode
+        self.per_chapter = dict(per_chapter or {})
+        self.html_limit  = html_limit
+
+    def mode_for(self, chapter: str) -> str:
+        return self.per_chapter.get(chapter, self.mode)
+
+    def key(self, chapter: str):
+        """Parte do chapter_build_key (None para 'keep', como nos caches antigos)."""
+        mode = self.mode_for(chapter)
+        if mode == "keep":
+            return None
+        return [mode, self.html_limit] if mode == "truncate-html" else [mode]
+
+
+def truncate_html_table(html: str, limit: int):
+    """
+    Corta as linhas da (primeira) tabela de 'html' ate caber em 'limit'
+    caracteres, fechando a tabela e avisando quantas linhas sairam.
+    None se nao ha tabela ou se nem o cabecalho cabe.
+    """
+    body_end = TABLE_BODY_END_RE.search(html)
+    if not body_end:
+        return None
+    row_ends = [m.end() for m in TABLE_ROW_END_RE.finditer(html, 0, body_end.start())]
+    tail = html[body_end.start():]
+    kept = [e for e in row_ends if e + len(tail) <= limit]
+    if len(kept) < 2:               # so o cabecalho (ou nada) caberia
+        return None
+    omitted = len(row_ends) - len(kept)
+    note = f"<p><em>({omitted} linhas omitidas na versao do aluno)</em></p>"
+    return html[:kept[-1]] + tail + note
+
+
+def externalize_output_image(data: dict, mime: str, blobs: NotebookBlobs,
+                             out_dir: Path, written: set = None) -> str:
+    """
+    Grava data[mime] em out_dir/images/output-<sha>.<ext>; retorna o caminho
+    relativo (acrescentado a 'written', se dado: o cache de build confere
+    se o arquivo ainda existe).
+    """
+    raw = blobs.load(data[mime]) if blobs else data[mime]
+    img = base64.b64decode("".join(raw) if isinstance(raw, list) else raw)
+    img_rel = f"images/output-{_sha256(img)[:16]}{EXTERNAL_IMAGE_MIME[mime]}"
+    dst = out_dir / img_rel
+    if not dst.exists():
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        _replace_atomic(dst, lambda tmp: tmp.write_bytes(img))
+    if written is not None:
+        written.add(img_rel)
+    return img_rel
+
+
+def apply_output_policy(notebook: dict, blobs: NotebookBlobs, mode: str,
+                        out_dir: Path, html_limit: int = 50_000) -> dict:
+    """
+    Aplica 'mode' (ver OUTPUT_MODES) aos outputs das celulas de codigo, in-place.
+    Imagens externalizadas vao para out_dir/images/. Retorna as contagens.
+    """
+    counts = new_output_counts()
+    if mode == "keep":
+        return counts
+    for cell in notebook.get("cells", []):
+        apply_cell_output_policy(cell, blobs, mode, out_dir, html_limit, counts)
+    report_output_policy(mode, counts)
+    return counts
+
+
+def new_output_counts() -> dict:
+    return {"removidos": 0, "externalizadas": 0, "truncados": 0}
+
+
+def apply_cell_output_policy(cell: dict, blobs: NotebookBlobs, mode: str, out_dir: Path,
+                             html_limit: int, counts: dict, written: set = None):
+    """
+    apply_output_policy numa celula; soma as alteracoes em 'counts' e
+    acrescenta as imagens externalizadas a 'written'.
+    """
+    if cell.get("cell_type") != "code" or not cell.get("outputs"):
+        return
+    if mode == "strip":
+        counts["removidos"] += len(cell["outputs"])
+        cell["outputs"] = []
+        cell["execution_count"] = None
+        return
+    for output in cell["outputs"]:
+        data = output.get("data", {})
+        if mode == "externalize":
+            mime = next((m for m in EXTERNAL_IMAGE_MIME if m in data), None)
+            if mime is None:
+                continue
+            img_rel = externalize_output_image(data, mime, blobs, out_dir, written)
+            width = output.get("metadata", {}).get(mime, {}).get("width")
+            size  = f' width="{width}"' if width else ""
+            output["data"] = {
+                "text/html":  [f'<img src="{img_rel}"{size}>'],
+                "text/plain": data.get("text/plain", [""]),
+            }
+            output["metadata"] = {}
+            # display_data: a injecao de legenda reconhece a posicao da figura
+            output["output_type"] = "display_data"
+            output.pop("execution_count", None)
+            counts["externalizadas"] += 1
+        elif mode == "truncate-html" and "text/html" in data:
+            html = source_to_str(data["text/html"])
+            if len(html) <= html_limit:
+                continue
+            short = truncate_html_table(html, html_limit)
+            if short is not None:
+                data["text/html"] = str_to_source(short)
+            elif "text/plain" in data:
+                del data["text/html"]   # o Jupyter mostra o text/plain
+            else:
+                data["text/html"] = ["<p><em>(saida HTML omitida na versao do aluno)</em></p>"]
+            counts["truncados"] += 1
+
+
+def report_output_policy(mode: str, counts: dict):
+    done = [f"{n} {name}" for name, n in counts.items() if n]
+    if done:
+        print(f"  Outputs ({mode}): {', '.join(done)}")
+
 
 # ---------------------------------------------------------------------------
 # 11. Lista de referencias bibliograficas
@@ -1354,9 +2568,10 @@ def build_reference_list(citations: list, bib: dict, intro_paragraph: str = "")
         lines.append(intro_paragraph.strip())
         
     # 4. Gera o texto das referências ordenadas
+    cites = citation_renderer(bib)
     for i, key in enumerate(sorted_keys, start=1):
         key_to_num[key] = i
-        ref_text = format_entry(key, bib[key])
+        ref_text = cites.reference(key)
         lines.append(ref_text)
     
     # Adiciona avisos para chaves não encontradas ao final (opcional)
@@ -1366,28 +2581,222 @@ def build_reference_list(citations: list, bib: dict, intro_paragraph: str = "")
     return "\n\n".join(lines), key_to_num
 
 # ---------------------------------------------------------------------------
-# 12b. Processa um unico notebook para EPUB
+# 11b. Pipeline de celulas (analise e transformacao em fluxo)
 # ---------------------------------------------------------------------------
+# scan_notebook percorre as celulas uma vez e junta os fatos do capitulo:
+# elementos numerados, citacoes, imagens, labels #| das celulas de codigo
+# e o paragrafo da secao de referencias antiga. A transformacao e uma
+# cadeia de geradores (limpeza -> <style scoped> -> --outputs ->
+# process_cell -> legendas): cada celula atravessa todos os estagios antes
+# da seguinte e a lista final so e montada no fim, numa segunda varredura.
+
+class NotebookFacts:
+    """Fatos de scan_notebook (elem_map e None se o mapa nao foi pedido)."""
+
+    def __init__(self):
+        self.elem_map    = None
+        self.citations   = []
+        self.image_paths = []
+        self.code_labels = {}       # id(celula de codigo) -> elem_id do #| label
+        self.ref_intro   = ""
 
-def process_notebook_epub(nb_path: Path, bib: dict, out_path: Path) -> list:
+
+def scan_notebook(notebook: dict, with_elements: bool = True) -> NotebookFacts:
     """
-    Gera versao do notebook para EPUB — identico ao modo --batch (alunos),
-    pois ambos resolvem citacoes e refs em texto simples por capitulo.
-    A unica diferenca e o nome do arquivo de saida (_epub.ipynb).
+    build_element_map, extract_citations, extract_image_paths, os labels
+    das celulas de codigo (lidos antes da limpeza apagar as linhas #|) e o
+    _ref_intro de clean_notebook, numa so passada pelas celulas.
+    """
+    facts   = NotebookFacts()
+    builder = ElementMapBuilder() if with_elements else None
+    seen, found = set(), set()
+    for cell in notebook.get("cells", []):
+        kind = cell.get("cell_type")
+        if kind != "markdown" and kind != "code":
+            continue
+        source = source_to_str(cell.get("source", []))
+        if builder:
+            builder.add(kind, source)
+        if kind == "code":
+            # A chave e a identidade da celula: a limpeza a altera in-place
+            m = CODE_LABEL_RE.search(source)
+            if m:
+                facts.code_labels[id(cell)] = m.group(1)
+            continue
+        collect_citations(source, seen, facts.citations)
+        collect_image_paths(source, found)
+        intro = ref_section_intro(source)
+        if intro is not None:
+            facts.ref_intro = intro
+    facts.elem_map    = builder.map if builder else None
+    facts.image_paths = local_image_paths(found)
+    return facts
+
+
+def clean_cells(cells, removed: dict):
+    """clean_cell em fluxo (as celulas removidas nao seguem adiante)."""
+    for cell in cells:
+        with profile_stage("clean_notebook"):
+            cell = clean_cell(cell, removed)
+        if cell is not None:
+            yield cell
+
+
+def fix_style_scoped(cells):
+    """Remove atributo 'scoped' inválido no EPUB gerado pelo pandas."""
+    for cell in cells:
+        with profile_stage("style_scoped"):
+            for output in cell.get("outputs", []):
+                if "text/html" in output.get("data", {}):
+                    html = output["data"]["text/html"]
+                    if isinstance(html, list):
+                        html = "".join(html)
+                    html = html.replace("<style scoped>", "<style>")
+                    output["data"]["text/html"] = str_to_source(html)
+        yield cell
+
+
+def apply_outputs(cells, blobs: NotebookBlobs, mode: str, out_dir: Path,
+                  html_limit: int, counts: dict, written: set = None):
+    """apply_cell_output_policy em fluxo."""
+    for cell in cells:
+        with profile_stage("output_policy"):
+            apply_cell_output_policy(cell, blobs, mode, out_dir, html_limit, counts, written)
+        yield cell
+
+
+def process_markdown_cells(cells, key_to_num: dict, elem_map: dict, bib: dict,
+                           cell_cache: CellCache = None):
+    """
+    process_cell nas celulas Markdown (o indice do --profile e o da saida
+    limpa); com 'cell_cache', as celulas inalteradas vem do cache.
+    """
+    render = cell_cache.process if cell_cache else process_cell
+    for index, cell in enumerate(cells):
+        if cell.get("cell_type") == "markdown":
+            source = cell.get("source", [])
+            with profile_stage("process_cell"):
+                t0 = time.perf_counter()
+                cell["source"] = render(source, key_to_num, elem_map, bib)
+                if _profiler:
+                    _profiler.cells.append([index, time.perf_counter() - t0,
+                                            len(source_to_str(source))])
+        yield cell
+
+
+def inject_legends(cells, code_labels: dict, elem_map: dict, ref_markdown: str,
+                   state: dict):
     """
-    return process_notebook(nb_path, bib, out_path)
+    Legendas das celulas de codigo fig-*/tbl-* e lista de referencias no
+    lugar do \\printbibliography; state["ref_injected"] diz se ela entrou.
+    """
+    for cell in cells:
+        with profile_stage("legend_injection"):
+            src = source_to_str(cell.get("source", []))
+
+            # Injeta legenda para células fig-*/tbl-* de código:
+            #   tbl (echo:false): legenda ANTES (código oculto, tabela aparece logo)
+            #   fig (echo:true):  legenda DEPOIS (código visível, figura aparece após)
+            legend_cell = None
+            if cell.get("cell_type") == "code":
+                elem_id = code_labels.get(id(cell))
+                if elem_id:
+                    info = elem_map.get(elem_id)
+                    if info and info.get("from_code"):
+                        caption = info.get("caption", "")
+                        legenda = f"**{info['label']}:** {caption}" if caption \
+                            else f"**{info['label']}**"
+                        if info.get("kind") == "tbl":
+                            legend_cell = {
+                                "cell_type": "markdown",
+                                "metadata":  {},
+                                "source":    str_to_source(legenda)
+                            }
+                        else:
+                            # fig: injeta legenda como output logo após o output de imagem
+                            cell_outputs = cell.get("outputs", [])
+                            img_idx = next(
+                                (i for i, o in enumerate(cell_outputs)
+                                 if "image/png" in o.get("data", {})
+                                 or o.get("output_type") == "display_data"),
+                                None
+                            )
+                            legend_output = {
+                                "output_type": "display_data",
+                                "metadata": {},
+                                "data": {
+                                    "text/markdown": [legenda + "\n"],
+                                    "text/plain":    [legenda]
+                                }
+                            }
+                            if img_idx is not None:
+                                cell_outputs.insert(img_idx + 1, legend_output)
+                            else:
+                                cell_outputs.append(legend_output)
+                            cell["outputs"] = cell_outputs
 
+            if "\\\\printbibliography" in src:
+                cell["source"] = str_to_source(ref_markdown)
+                state["ref_injected"] = True
+        if legend_cell is not None:
+            yield legend_cell       # tbl: antes da celula
+        yield cell
 
 
 # ---------------------------------------------------------------------------
-# 12. Processa um unico notebook
+# 12. Modelo de documento do capitulo (uma analise, varios alvos)
 # ---------------------------------------------------------------------------
+# analyze_notebook le, analisa e transforma o capitulo uma unica vez
+# (mapa de elementos, citacoes, limpeza, celulas resolvidas, legendas e
+# lista de referencias). Os renderizadores de 12b so serializam esse
+# ChapterDocument: gerar mais um alvo custa apenas a serializacao dele.
 
-def process_notebook(nb_path: Path, bib: dict, out_path: Path) -> list:
-    notebook    = json.loads(nb_path.read_text(encoding="utf-8"))
-    elem_map    = build_element_map(notebook)
-    citations   = extract_citations(notebook)
-    image_paths = extract_image_paths(notebook)
+class ChapterDocument:
+    """
+    Capitulo ja transformado: notebook, blobs de saida e metadados da analise.
+    output_images: imagens de output gravadas na pasta de saida (relativas a ela).
+    inlined: imagens embutidas pelos alvos (--inline-images), inclusive as que
+    so aparecem depois do convert_callouts (ex: ![]( images/x.png )).
+    """
+
+    def __init__(self, nb_path: Path, notebook: dict, blobs: NotebookBlobs,
+                 elem_map: dict, citations: list, image_paths: list,
+                 output_images: set = None):
+        self.nb_path       = nb_path
+        self.notebook      = notebook
+        self.blobs         = blobs
+        self.elem_map      = elem_map
+        self.citations     = citations
+        self.image_paths   = image_paths
+        self.output_images = output_images if output_images is not None else set()
+        self.inlined       = set()
+
+    def close(self):
+        self.blobs.close()
+
+
+def analyze_notebook(nb_path: Path, bib: dict, out_dir: Path,
+                     outputs: OutputPolicy = None,
+                     elements: ElementMaps = None,
+                     cell_cache: CellCache = None) -> ChapterDocument:
+    """
+    Parte comum a todos os alvos. 'out_dir' recebe as imagens
+    externalizadas por --outputs externalize.
+    """
+    with profile_stage("json_load"):
+        notebook, blobs = read_notebook(nb_path)
+    sha = elem_map = None
+    if elements:
+        sha = _sha256(blobs.data)
+        elem_map = elements.load(sha)
+    # Analise: uma varredura (o mapa de elementos so sem cache)
+    with profile_stage("scan_notebook"):
+        facts = scan_notebook(notebook, with_elements=elem_map is None)
+    if elem_map is None:
+        elem_map = facts.elem_map
+        if elements:
+            elements.store(sha, elem_map)
+    citations, image_paths = facts.citations, facts.image_paths
 
     # Log
     figs = {k: v for k, v in elem_map.items() if v["kind"] == "fig"}
@@ -1403,109 +2812,39 @@ def process_notebook(nb_path: Path, bib: dict, out_path: Path) -> list:
     if image_paths:
         print(f"  Imagens  ({len(image_paths)}): {image_paths}")
 
-    # Limpeza antes de processar (extrai _ref_intro da célula de referências)
-    notebook = clean_notebook(notebook)
+    # Indice global (batch): @fig/@tbl/@eq de outros capitulos
+    if elements and elements.index:
+        elem_map = {**elements.index, **elem_map}
 
-    intro_raw = notebook.pop("_ref_intro", "")
-    intro_resolved = source_to_str(
-        process_cell(str_to_source(intro_raw), {}, elem_map, bib)
-    )
-    ref_markdown, key_to_num = build_reference_list(citations, bib,
-                                                    intro_paragraph=intro_resolved)
-
-    # Remove atributo 'scoped' inválido no EPUB gerado pelo pandas
-    for cell in notebook.get("cells", []):
-        for output in cell.get("outputs", []):
-            if "text/html" in output.get("data", {}):
-                html = output["data"]["text/html"]
-                if isinstance(html, list):
-                    html = "".join(html)
-                html = html.replace("<style scoped>", "<style>")
-                output["data"]["text/html"] = str_to_source(html)
-
-    # Processa celulas
-    for cell in notebook.get("cells", []):
-        if cell.get("cell_type") == "markdown":
-            cell["source"] = process_cell(
-                cell.get("source", []), key_to_num, elem_map, bib
-            )
-
-    # Mapa fingerprint -> elem_id para células de código com #| label: fig-*/tbl-*
-    # Feito ANTES do clean_notebook apagar as linhas #|
-    # O fingerprint é o conteúdo sem linhas #| (que sobrevive ao clean_notebook)
-    notebook_orig = json.loads(nb_path.read_text(encoding="utf-8"))
-    fingerprint_to_label = {}
-    for cell in notebook_orig.get("cells", []):
-        if cell.get("cell_type") != "code":
-            continue
-        src_orig = source_to_str(cell.get("source", []))
-        m = re.search(r'#\|\s*label:\s*((fig|tbl)-[\w-]+)', src_orig)
-        if m:
-            # Fingerprint: linhas sem #| e sem # @title, stripped
-            fp_lines = [l for l in src_orig.splitlines()
-                        if not l.strip().startswith("#|")]
-            fp = "\n".join(fp_lines).strip()
-            fingerprint_to_label[fp] = m.group(1)
-
-    # Injeta legendas e lista de referencias
-    new_cells, ref_injected = [], False
-    for cell in notebook.get("cells", []):
-        src = source_to_str(cell.get("source", []))
-
-        # Injeta legenda para células fig-*/tbl-* de código:
-        #   tbl (echo:false): legenda ANTES (código oculto, tabela aparece logo)
-        #   fig (echo:true):  legenda DEPOIS (código visível, figura aparece após)
-        legend_cell = None
-        if cell.get("cell_type") == "code":
-            fp_lines = [l for l in src.splitlines()
-                        if not l.strip().startswith("# @title")]
-            fp = "\n".join(fp_lines).strip()
-            elem_id = fingerprint_to_label.get(fp)
-            if elem_id:
-                info = elem_map.get(elem_id)
-                if info and info.get("from_code"):
-                    caption = info.get("caption", "")
-                    legenda = f"**{info['label']}:** {caption}" if caption \
-                        else f"**{info['label']}**"
-                    legend_cell = {
-                        "cell_type": "markdown",
-                        "metadata":  {},
-                        "source":    str_to_source(legenda)
-                    }
-                    if info.get("kind") == "tbl":
-                        new_cells.append(legend_cell)
-                        legend_cell = None  # já inserida antes
-                    else:
-                        # fig: injeta legenda como output logo após o output de imagem
-                        outputs = cell.get("outputs", [])
-                        img_idx = next(
-                            (i for i, o in enumerate(outputs)
-                             if "image/png" in o.get("data", {})
-                             or o.get("output_type") == "display_data"),
-                            None
-                        )
-                        legend_output = {
-                            "output_type": "display_data",
-                            "metadata": {},
-                            "data": {
-                                "text/markdown": [legenda + "\n"],
-                                "text/plain":    [legenda]
-                            }
-                        }
-                        if img_idx is not None:
-                            outputs.insert(img_idx + 1, legend_output)
-                        else:
-                            outputs.append(legend_output)
-                        cell["outputs"] = outputs
-                        legend_cell = None  # já inserida nos outputs
-
-        if "\\\\printbibliography" in src:
-            cell["source"] = str_to_source(ref_markdown)
-            ref_injected = True
-        new_cells.append(cell)
-
-
-    if not ref_injected and citations:
+    strip_quarto_metadata(notebook)
+    with profile_stage("reference_list"):
+        intro_resolved = source_to_str(
+            process_cell(str_to_source(facts.ref_intro), {}, elem_map, bib)
+        )
+        ref_markdown, key_to_num = build_reference_list(citations, bib,
+                                                        intro_paragraph=intro_resolved)
+
+    # Transformacao: uma passada, cada celula atravessa todos os estagios
+    removed, counts, state = new_cleanup_counts(), new_output_counts(), {"ref_injected": False}
+    output_images = set()
+    mode  = outputs.mode_for(nb_path.parent.name) if outputs else "keep"
+    cells = clean_cells(notebook.get("cells", []), removed)
+    cells = fix_style_scoped(cells)
+    if mode != "keep":
+        cells = apply_outputs(cells, blobs, mode, out_dir, outputs.html_limit, counts,
+                              output_images)
+    if cell_cache:
+        hits, misses = cell_cache.hits, cell_cache.misses
+    cells = process_markdown_cells(cells, key_to_num, elem_map, bib, cell_cache)
+    cells = inject_legends(cells, facts.code_labels, elem_map, ref_markdown, state)
+    new_cells = list(cells)
+    report_cleanup(removed)
+    report_output_policy(mode, counts)
+    if cell_cache:
+        print(f"  Cache de celulas: {cell_cache.hits - hits} reaproveitadas, "
+              f"{cell_cache.misses - misses} processadas")
+
+    if not state["ref_injected"] and citations:
         new_cells.append({
             "cell_type": "markdown",
             "metadata":  {},
@@ -1513,35 +2852,1132 @@ def process_notebook(nb_path: Path, bib: dict, out_path: Path) -> list:
         })
 
     notebook["cells"] = new_cells
+    return ChapterDocument(nb_path, notebook, blobs, elem_map, citations, image_paths,
+                           output_images)
+
+
+def process_notebook(nb_path: Path, bib: dict, out_path: Path,
+                     optimizer: "ImageOptimizer" = None,
+                     outputs: OutputPolicy = None,
+                     inline: "ImageInliner" = None,
+                     elements: ElementMaps = None,
+                     cell_cache: CellCache = None) -> list:
+    """Gera o notebook de distribuicao (Jupyter/Colab); retorna as imagens."""
+    return process_targets(nb_path, bib, {"aluno": out_path}, optimizer, outputs,
+                           inline, elements, cell_cache)
+
+
+def process_notebook_epub(nb_path: Path, bib: dict, out_path: Path,
+                          optimizer: "ImageOptimizer" = None,
+                          outputs: OutputPolicy = None,
+                          inline: "ImageInliner" = None,
+                          elements: ElementMaps = None,
+                          cell_cache: CellCache = None) -> list:
+    """
+    Gera versao do notebook para EPUB — identico ao modo --batch (alunos),
+    pois ambos resolvem citacoes e refs em texto simples por capitulo.
+    A unica diferenca e o nome do arquivo de saida (_epub.ipynb).
+    """
+    return process_targets(nb_path, bib, {"epub": out_path}, optimizer, outputs,
+                           inline, elements, cell_cache)
+
+
+def process_targets(nb_path: Path, bib: dict, outs: dict,
+                    optimizer: "ImageOptimizer" = None,
+                    outputs: OutputPolicy = None,
+                    inline: "ImageInliner" = None,
+                    elements: ElementMaps = None,
+                    cell_cache: CellCache = None, written: set = None) -> list:
+    """
+    Analisa o capitulo uma vez e grava cada alvo de outs {alvo: caminho}
+    (ver TARGETS). Retorna os caminhos das imagens do capitulo, inclusive as
+    embutidas (que entram na assinatura do cache de build); 'written' recebe
+    as imagens de output gravadas na pasta de saida.
+    """
+    out_dir = next(iter(outs.values())).parent
+    doc = analyze_notebook(nb_path, bib, out_dir, outputs, elements, cell_cache)
+    # quem sobrescreve a origem (fecha o mmap dos blobs) e gravado por ultimo
+    order = sorted(outs.items(), key=lambda item: item[1].resolve() == nb_path.resolve())
+    try:
+        for target, out_path in order:
+            TARGETS[target][1](doc, out_path, optimizer, inline, target)
+            print(f"  -> Salvo: {out_path}")
+    finally:
+        doc.close()
+    if written is not None:
+        written.update(doc.output_images)
+    if doc.inlined - set(doc.image_paths):
+        return sorted(doc.inlined.union(doc.image_paths))
+    return doc.image_paths
+
+
+# ---------------------------------------------------------------------------
+# 12b. Renderizadores (alvos de --targets)
+# ---------------------------------------------------------------------------
+
+def _target_notebook(doc: ChapterDocument, optimizer: "ImageOptimizer" = None,
+                     inline: "ImageInliner" = None, target: str = "aluno") -> dict:
+    """
+    Notebook do alvo: o de doc ou, se as imagens mudam (--inline-images,
+    --webp) ou ha links para outros capitulos, uma copia com as celulas
+    Markdown reescritas. O documento compartilhado entre os alvos nunca e
+    alterado.
+    """
+    # --optimize-images --webp: as imagens de saida mudam de extensao
+    renamed = {p: optimizer.target(p) for p in doc.image_paths} if optimizer else {}
+    renamed = {old: new for old, new in renamed.items() if old != new}
+    xrefs = any(cell.get("cell_type") == "markdown"
+                and "\x01" in source_to_str(cell.get("source", []))
+                for cell in doc.notebook.get("cells", []))
+    if not inline and not renamed and not xrefs:
+        return doc.notebook
+
+    cells = []
+    for cell in doc.notebook.get("cells", []):
+        if cell.get("cell_type") == "markdown":
+            cell = dict(cell)
+            if "attachments" in cell:
+                cell["attachments"] = dict(cell["attachments"])
+        cells.append(cell)
+    notebook = {**doc.notebook, "cells": cells}
+
+    # --inline-images: imagens dentro do arquivo (anexos ou data URIs)
+    if inline:
+        with profile_stage("inline_images"):
+            n_inlined = inline_images(notebook, doc.nb_path.parent, inline, doc.inlined)
+        if n_inlined:
+            print(f"  Imagens embutidas ({inline.mode}): {n_inlined}")
+    if renamed:
+        with profile_stage("rewrite_image_paths"):
+            rewrite_image_paths(notebook, renamed)
+    if xrefs:
+        rewrite_xref_targets(notebook, target)
+    return notebook
+
+
+def render_ipynb(doc: ChapterDocument, out_path: Path,
+                 optimizer: "ImageOptimizer" = None, inline: "ImageInliner" = None,
+                 target: str = "aluno"):
+    """Alvos aluno/epub/dist: .ipynb para Jupyter/Colab (blobs copiados direto)."""
+    notebook = _target_notebook(doc, optimizer, inline, target)
+    with profile_stage("json_dump"):
+        write_notebook(notebook, out_path, doc.blobs)
+
+
+def _data_uri_inliner(inline: "ImageInliner"):
+    """Markdown e HTML nao tem anexos de celula: --inline-images vira data URI."""
+    if inline is None or inline.mode == "data-uri":
+        return inline
+    return ImageInliner("data-uri", inline.cache_dir, inline.optimizer)
+
+
+def _output_image_src(doc: ChapterDocument, data: dict, mime: str, out_dir: Path,
+                      inline: "ImageInliner" = None) -> str:
+    """src de uma imagem de output: data URI (--inline-images) ou arquivo em images/."""
+    if inline:
+        raw = doc.blobs.load(data[mime])
+        return f"data:{mime};base64," + ("".join(raw) if isinstance(raw, list) else raw)
+    return externalize_output_image(data, mime, doc.blobs, out_dir, doc.output_images)
+
+
+def _write_text(out_path: Path, text: str):
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    out_path.write_text(
-        json.dumps(notebook, ensure_ascii=False, indent=1),
-        encoding="utf-8"
-    )
-    print(f"  -> Salvo: {out_path}")
+    _replace_atomic(out_path, lambda tmp: tmp.write_text(text, encoding="utf-8"))
+
+
+def render_markdown(doc: ChapterDocument, out_path: Path,
+                    optimizer: "ImageOptimizer" = None, inline: "ImageInliner" = None,
+                    target: str = "md"):
+    """Alvo md: Markdown com o codigo em blocos ``` e os outputs logo abaixo."""
+    inline = _data_uri_inliner(inline)
+    notebook = _target_notebook(doc, optimizer, inline, target)
+    with profile_stage("render_md"):
+        out = Emitter("\n\n")
+        for cell in notebook.get("cells", []):
+            src  = source_to_str(cell.get("source", [])).strip("\n")
+            kind = cell.get("cell_type")
+            if kind == "markdown":
+                out.write(src)
+            elif kind == "code":
+                out.write(f"```python\n{src}\n```")
+                for output in cell.get("outputs", []):
+                    out.write(_output_markdown(doc, output, out_path.parent, inline))
+        _write_text(out_path, out.text() + "\n")
+
+
+def _output_markdown(doc: ChapterDocument, output: dict, out_dir: Path,
+                     inline: "ImageInliner" = None) -> str:
+    if output.get("output_type") == "stream":
+        return f"```\n{source_to_str(output.get('text', [])).rstrip()}\n```"
+    if output.get("output_type") == "error":
+        return f"```\n{output.get('ename', '')}: {output.get('evalue', '')}\n```"
+    data = output.get("data", {})
+    if "text/markdown" in data:                 # legendas injetadas
+        return source_to_str(data["text/markdown"]).strip()
+    mime = next((m for m in EXTERNAL_IMAGE_MIME if m in data), None)
+    if mime:
+        return f'<img src="{_output_image_src(doc, data, mime, out_dir, inline)}">'
+    if "text/html" in data:
+        return source_to_str(data["text/html"]).strip()
+    if "text/plain" in data:
+        return f"```\n{source_to_str(data['text/plain']).rstrip()}\n```"
+    return ""
+
+
+HTML_PAGE = """<!DOCTYPE html>
+<html lang="pt-BR">
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<script>
+window.MathJax = {{tex: {{inlineMath: [["$", "$"], ["\\\\(", "\\\\)"]],
+                        displayMath: [["$$", "$$"], ["\\\\[", "\\\\]"]]}}}};
+</script>
+<script async src="https://cdn.jsdelivr.net/npm/mathjax@3/es5/tex-mml-chtml.js"></script>
+<style>
+body {{ max-width: 52em; margin: 2em auto; padding: 0 1em; font-family: sans-serif; line-height: 1.5; }}
+pre {{ background: #f6f8fa; padding: .6em; overflow-x: auto; }}
+pre.output {{ background: #fff; border-left: 3px solid #ddd; }}
+img {{ max-width: 100%; }}
+</style>
+</head>
+<body>
+{body}
+</body>
+</html>
+"""
+MD_HEADER_RE = re.compile(r'^(#{1,6})\s+(.*?)\s*$')
+MD_LIST_ITEM_RE = re.compile(r'^\s*([-*+]|\d+[.)])\s+(.*)$')
+MD_IMAGE_RE = re.compile(r'!\[([^\]]*)\]\(([^)\s"\']+)[^)]*\)(?:\{[^}]*\})?')
+
+
+def md_blocks_to_html(text: str) -> str:
+    """
+    Markdown de celula (ja resolvida por process_cell) para HTML: titulos,
+    paragrafos, listas, citacoes, tabelas, blocos ``` e $$; linhas que
+    comecam com '<' (figuras, callouts, tabelas ja em HTML) passam direto.
+    O inline fica com md_inline_to_html.
+    """
+    def inline(t):
+        t = MD_IMAGE_RE.sub(lambda m: f'<img src="{m.group(2)}" alt="{escape(m.group(1))}">', t)
+        return md_inline_to_html(t)
+
+    out, para, lines, i = Emitter("\n"), [], text.split("\n"), 0
+
+    def flush():
+        if para:
+            out.write("<p>" + inline("\n".join(para)) + "</p>")
+            para.clear()
+
+    while i < len(lines):
+        line, stripped = lines[i], lines[i].strip()
+        if not stripped:
+            flush()
+        elif stripped.startswith("```"):
+            flush()
+            j = i + 1
+            while j < len(lines) and not lines[j].strip().startswith("```"):
+                j += 1
+            out.write("<pre><code>" + escape("\n".join(lines[i + 1:j])) + "</code></pre>")
+            i = j
+        elif stripped.startswith("$$"):
+            flush()
+            j = i
+            while j < len(lines) and not (lines[j].rstrip().endswith("$$")
+                                          and (j > i or len(stripped) > 2)):
+                j += 1
+            out.write("\n".join(lines[i:j + 1]))      # o MathJax trata $$ ... $$
+            i = j
+        elif stripped.startswith("<"):
+            flush()
+            j = i
+            while j < len(lines) and lines[j].strip():
+                j += 1
+            out.write("\n".join(lines[i:j]))
+            i = j - 1
+        elif MD_HEADER_RE.match(stripped):
+            flush()
+            m = MD_HEADER_RE.match(stripped)
+            level = len(m.group(1))
+            out.write(f"<h{level}>{inline(m.group(2))}</h{level}>")
+        elif stripped.startswith("|"):
+            flush()
+            j = i
+            while j < len(lines) and lines[j].strip().startswith("|"):
+                j += 1
+            out.write(inline(md_table_to_html("\n".join(lines[i:j]))))
+            i = j - 1
+        elif stripped.startswith(">"):
+            flush()
+            j = i
+            while j < len(lines) and lines[j].strip().startswith(">"):
+                j += 1
+            out.write("<blockquote>" + inline("\n".join(lines[i:j])) + "</blockquote>")
+            i = j - 1
+        elif MD_LIST_ITEM_RE.match(line):
+            flush()
+            ordered = MD_LIST_ITEM_RE.match(line).group(1)[0].isdigit()
+            items = []
+            while i < len(lines) and MD_LIST_ITEM_RE.match(lines[i]):
+                items.append(f"<li>{inline(MD_LIST_ITEM_RE.match(lines[i]).group(2))}</li>")
+                i += 1
+            tag = "ol" if ordered else "ul"
+            out.write(f"<{tag}>\n" + "\n".join(items) + f"\n</{tag}>")
+            continue
+        else:
+            para.append(line)
+        i += 1
+    flush()
+    return out.text()
+
+
+def render_html(doc: ChapterDocument, out_path: Path,
+                optimizer: "ImageOptimizer" = None, inline: "ImageInliner" = None,
+                target: str = "html"):
+    """Alvo html: pagina unica, com MathJax; codigo oculto (echo: false) em <details>."""
+    inline = _data_uri_inliner(inline)
+    notebook = _target_notebook(doc, optimizer, inline, target)
+    with profile_stage("render_html"):
+        out = Emitter("\n")
+        for cell in notebook.get("cells", []):
+            src  = source_to_str(cell.get("source", []))
+            kind = cell.get("cell_type")
+            if kind == "markdown":
+                out.write(md_blocks_to_html(src))
+            elif kind == "code":
+                code = f'<pre class="code"><code>{escape(src)}</code></pre>'
+                if cell.get("metadata", {}).get("jupyter", {}).get("source_hidden"):
+                    code = f"<details><summary>Codigo</summary>\n{code}\n</details>"
+                out.write(code)
+                for output in cell.get("outputs", []):
+                    out.write(_output_html(doc, output, out_path.parent, inline))
+        title = escape(doc.nb_path.stem)
+        _write_text(out_path, HTML_PAGE.format(title=title, body=out.text()))
+
+
+def _output_html(doc: ChapterDocument, output: dict, out_dir: Path,
+                 inline: "ImageInliner" = None) -> str:
+    if output.get("output_type") == "stream":
+        return f'<pre class="output">{escape(source_to_str(output.get("text", [])))}</pre>'
+    if output.get("output_type") == "error":
+        return (f'<pre class="output">{escape(output.get("ename", ""))}: '
+                f'{escape(output.get("evalue", ""))}</pre>')
+    data = output.get("data", {})
+    if "text/markdown" in data:
+        return md_blocks_to_html(source_to_str(data["text/markdown"]))
+    mime = next((m for m in EXTERNAL_IMAGE_MIME if m in data), None)
+    if mime:
+        return f'<img src="{_output_image_src(doc, data, mime, out_dir, inline)}">'
+    if "text/html" in data:
+        return source_to_str(data["text/html"])
+    if "text/plain" in data:
+        return f'<pre class="output">{escape(source_to_str(data["text/plain"]))}</pre>'
+    return ""
+
+
+# Alvo -> (sufixo do arquivo de saida, renderizador)
+TARGETS = {
+    "aluno": ("_aluno.ipynb", render_ipynb),
+    "epub":  ("_epub.ipynb",  render_ipynb),
+    "dist":  ("_dist.ipynb",  render_ipynb),
+    "md":    (".md",          render_markdown),
+    "html":  (".html",        render_html),
+}
+
+
+def parse_targets(value: str) -> tuple:
+    """'aluno,epub,md' -> ("aluno", "epub", "md") (para o argparse)."""
+    targets = tuple(dict.fromkeys(t.strip() for t in value.split(",") if t.strip()))
+    unknown = [t for t in targets if t not in TARGETS]
+    if unknown or not targets:
+        raise argparse.ArgumentTypeError(
+            f"alvo(s) invalido(s): {', '.join(unknown) or value} "
+            f"(use {', '.join(TARGETS)})")
+    return targets
+
+
+def target_path(nb_path: Path, out_dir: Path, target: str) -> Path:
+    """Saida de um alvo: <out_dir>/capXX_aluno.ipynb, capXX.md, ..."""
+    return out_dir / (nb_path.stem + TARGETS[target][0])
+
+
+# ---------------------------------------------------------------------------
+# 13. Copia imagens (armazenamento por conteudo)
+# ---------------------------------------------------------------------------
+# Cada imagem de saida e um hardlink para <out_root>/.images/<sha256><ext>:
+# a mesma imagem usada em varios capitulos (ou vinda de images/ da raiz)
+# ocupa o disco uma unica vez. Destino com o tamanho e o mtime da origem
+# (copystat preserva o mtime) esta em dia e nem e lido. Onde nao ha
+# hardlink (FAT, alguns compartilhamentos de rede), cai para copia simples.
+# Destinos nunca sao escritos no lugar: podem ser o mesmo inode do store.
+# Com --optimize-images o objeto guardado e a versao otimizada (reduzida,
+# recomprimida, opcionalmente WebP), com chave no hash da origem mais os
+# parametros: cada imagem e otimizada uma unica vez.
+# O manifesto (.images/sources.json) guarda origem -> (tamanho, mtime, hash):
+# uma origem ja vista nao e relida nem quando o mtime do destino diverge.
+# Ao fim de um batch, prune_image_store apaga os objetos que nenhuma saida
+# usa (st_nlink == 1) e cujo hash nao e de nenhuma origem atual.
+# O modo unico (-o qualquer/pasta) nao cria store: copia direto para images/.
+
+IMAGE_STORE_NAME = ".images"
+IMAGE_MANIFEST_NAME = "sources.json"
+
+
+def _file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _fast_copy(src: Path, dst: Path):
+    """Copia via copy_file_range (reflink em btrfs/XFS) se possivel; preserva o mtime."""
+    try:
+        with open(src, "rb") as fin, open(dst, "wb") as fout:
+            remaining = os.fstat(fin.fileno()).st_size
+            while remaining > 0:
+                n = os.copy_file_range(fin.fileno(), fout.fileno(), remaining)
+                if n == 0:
+                    break
+                remaining -= n
+    except (AttributeError, OSError):        # sem copy_file_range / entre FS
+        shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+
+
+def _replace_atomic(dst: Path, make):
+    """make(tmp) cria o arquivo temporario, que entao substitui dst."""
+    tmp = dst.with_name(f".{dst.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        make(tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+class ImageOptimizer:
+    """
+    Reduz PNG/JPEG a no maximo max_width px de largura e recomprime (PNG sem
+    perda, JPEG qualidade 90 progressivo); com webp=True grava WebP (sem
+    perda para PNG). Requer Pillow. Os parametros sao picklaveis (pool).
+    """
+
+    VERSION = 1                 # muda quando a receita de otimizacao muda
+    FORMATS = {".png": "PNG", ".jpg": "JPEG", ".jpeg": "JPEG"}
+    QUALITY = 90
+
+    def __init__(self, max_width: int = 1200, webp: bool = False):
+        self.max_width = max_width
+        self.webp      = webp
+        self.tag       = f"-opt{self.VERSION}-w{max_width}"
+
+    def handles(self, name: str) -> bool:
+        return os.path.splitext(name)[1].lower() in self.FORMATS
+
+    def target(self, img_rel: str) -> str:
+        """Caminho de saida da imagem (muda so a extensao, com --webp)."""
+        if not (self.webp and self.handles(img_rel)):
+            return img_rel
+        return os.path.splitext(img_rel)[0] + ".webp"
+
+    def optimize(self, src: Path, out: Path):
+        """Grava em 'out' a versao otimizada de src (ou a propria src, se nao ganhar nada)."""
+        src_format = self.FORMATS[src.suffix.lower()]
+        with Image.open(src) as img:
+            img.load()
+            resized = img.width > self.max_width
+            if resized:
+                height = max(1, round(img.height * self.max_width / img.width))
+                img = img.resize((self.max_width, height), Image.LANCZOS)
+            params = {"icc_profile": img.info["icc_profile"]} if "icc_profile" in img.info else {}
+            if self.webp:
+                if src_format == "PNG":
+                    img.save(out, "WEBP", lossless=True, method=6, **params)
+                else:
+                    img.save(out, "WEBP", quality=self.QUALITY, method=6, **params)
+                return
+            if src_format == "JPEG":
+                if img.mode not in ("RGB", "L", "CMYK"):
+                    img = img.convert("RGB")
+                img.save(out, "JPEG", quality=self.QUALITY, optimize=True,
+                         progressive=True, **params)
+            else:
+                img.save(out, "PNG", optimize=True, **params)
+        if not resized and out.stat().st_size >= src.stat().st_size:
+            _fast_copy(src, out)        # recompressao nao ganhou nada
+
+
+INLINE_MODES = ("attachment", "data-uri")
+INLINE_CACHE_NAME = "inline"    # <out_root>/.images/inline/
+IMAGE_MIME = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg",
+              ".gif": "image/gif", ".webp": "image/webp", ".svg": "image/svg+xml"}
+
+
+class ImageInliner:
+    """
+    Codificacao base64 das imagens de --inline-images. Cada imagem vira
+    <cache_dir>/<id>.b64 ("hash\nmime\nbase64"), com id derivado do caminho,
+    tamanho e mtime da origem (e da otimizacao): builds seguintes so leem o
+    texto pronto, sem reler nem recodificar a imagem.
+    """
+
+    def __init__(self, mode: str, cache_dir: Path, optimizer: ImageOptimizer = None):
+        self.mode      = mode
+        self.cache_dir = cache_dir
+        self.optimizer = optimizer
+
+    def key(self) -> list:
+        """Parte do chapter_build_key."""
+        opt = self.optimizer
+        return [self.mode, opt and opt.tag, opt and opt.webp]
+
+    def handles(self, img_rel: str) -> bool:
+        return os.path.splitext(img_rel)[1].lower() in IMAGE_MIME
+
+    def _entry(self, src: Path) -> tuple:
+        """(id da entrada no cache, otimizador aplicavel, nome de saida) de src."""
+        opt = self.optimizer if self.optimizer and self.optimizer.handles(src.name) else None
+        out_name = opt.target(src.name) if opt else src.name
+        st = src.stat()
+        ident = _sha256(f"{src.resolve()}|{st.st_size}|{st.st_mtime_ns}|"
+                        f"{opt and opt.tag}|{out_name}".encode("utf-8"))
+        return ident, opt, out_name
+
+    def prune(self, sources: set) -> int:
+        """Apaga as entradas que nao sao de nenhuma imagem de 'sources'; retorna quantas."""
+        keep = set()
+        for src in sources:
+            try:
+                keep.add(self._entry(src)[0])
+            except OSError:
+                pass                # origem ausente: nada a guardar
+        removed = 0
+        for path in self.cache_dir.glob("*.b64"):
+            if path.stem not in keep:
+                path.unlink(missing_ok=True)
+                removed += 1
+        return removed
+
+    def encode(self, src: Path) -> tuple:
+        """(nome do anexo '<hash16><ext>', mime, base64) da imagem src."""
+        ident, opt, out_name = self._entry(src)
+        entry = self.cache_dir / f"{ident}.b64"
+        ext = os.path.splitext(out_name)[1].lower()
+        try:
+            sha, mime, b64 = entry.read_text(encoding="ascii").split("\n", 2)
+            return sha[:16] + ext, mime, b64
+        except (OSError, ValueError):
+            pass
+        if opt:
+            tmp = entry.with_name(f".{ident}.{os.getpid()}.{threading.get_ident()}{ext}")
+            try:
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                opt.optimize(src, tmp)
+                data = tmp.read_bytes()
+            finally:
+                tmp.unlink(missing_ok=True)
+        else:
+            data = src.read_bytes()
+        sha, mime = _sha256(data), IMAGE_MIME[ext]
+        b64 = base64.b64encode(data).decode("ascii")
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        _replace_atomic(entry, lambda tmp: tmp.write_text(f"{sha}\n{mime}\n{b64}",
+                                                          encoding="ascii"))
+        return sha[:16] + ext, mime, b64
+
+
+def image_inliner(mode: str, out_root: Path, optimizer: ImageOptimizer = None):
+    """ImageInliner com cache em <out_root>/.images/inline (None sem --inline-images)."""
+    if not mode:
+        return None
+    return ImageInliner(mode, out_root / IMAGE_STORE_NAME / INLINE_CACHE_NAME, optimizer)
+
+
+class ImageStore:
+    """
+    Objetos por conteudo em <root>/.images, ligados por hardlink aos destinos.
+    Com root=None (modo unico), copia simples, sem store.
+    """
+
+    def __init__(self, root: Path = None, optimizer: ImageOptimizer = None):
+        self.dir       = root / IMAGE_STORE_NAME if root is not None else None
+        self.optimizer = optimizer
+        self.can_link  = True
+        self._lock    = threading.Lock()
+        self._objects = {}          # nome do objeto -> Lock (criacao por uma thread so)
+        self._sources = None        # manifesto: origem -> [tamanho, mtime_ns, sha256]
+        self._dirty   = False
+
+    def _object_lock(self, name: str) -> threading.Lock:
+        with self._lock:
+            return self._objects.setdefault(name, threading.Lock())
+
+    def _load_manifest(self) -> dict:
+        try:
+            sources = json.loads((self.dir / IMAGE_MANIFEST_NAME).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return {}
+        return sources if isinstance(sources, dict) else {}
+
+    def digest(self, src: Path, st: os.stat_result) -> str:
+        """sha256 de src; reaproveita o do manifesto se tamanho e mtime nao mudaram."""
+        key = os.path.abspath(src)
+        with self._lock:
+            if self._sources is None:
+                self._sources = self._load_manifest()
+            entry = self._sources.get(key)
+        if entry and entry[:2] == [st.st_size, st.st_mtime_ns]:
+            return entry[2]
+        sha = _file_sha256(src)
+        with self._lock:
+            self._sources[key] = [st.st_size, st.st_mtime_ns, sha]
+            self._dirty = True
+        return sha
+
+    def save(self):
+        """Grava o manifesto, se alguma origem foi (re)calculada."""
+        with self._lock:
+            if not self._dirty:
+                return
+            text = json.dumps(self._sources, separators=(",", ":"))
+            self._dirty = False
+        self.dir.mkdir(parents=True, exist_ok=True)
+        _replace_atomic(self.dir / IMAGE_MANIFEST_NAME,
+                        lambda tmp: tmp.write_text(text, encoding="utf-8"))
+
+    def prune(self, sources: set) -> int:
+        """
+        Esquece no manifesto as origens fora de 'sources' (caminhos das imagens
+        do build atual) e apaga os objetos sem nenhum destino (st_nlink == 1)
+        cujo hash nao e mais de nenhuma origem. Retorna quantos apagou.
+        """
+        if self.dir is None or not self.dir.is_dir():
+            return 0
+        keys = {os.path.abspath(src) for src in sources}
+        with self._lock:
+            if self._sources is None:
+                self._sources = self._load_manifest()
+            stale = self._sources.keys() - keys
+            for key in stale:
+                del self._sources[key]
+            self._dirty |= bool(stale)
+            digests = {entry[2] for entry in self._sources.values()}
+        self.save()
+        removed = 0
+        for path in self.dir.iterdir():
+            # objeto: <sha256>[tag do otimizador].<ext>; o resto (manifesto,
+            # inline/, temporarios) nao e objeto
+            if path.name[:64] in digests or path.name.startswith(".") or \
+                    path.name == IMAGE_MANIFEST_NAME:
+                continue
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode) and st.st_nlink == 1:
+                path.unlink(missing_ok=True)
+                removed += 1
+        return removed
+
+    def target(self, img_rel: str) -> str:
+        """Caminho relativo de saida de uma imagem (ver ImageOptimizer.target)."""
+        return self.optimizer.target(img_rel) if self.optimizer else img_rel
+
+    def place(self, src: Path, dst: Path, st: os.stat_result = None) -> str:
+        """
+        Poe src em dst (pasta ja existente). Retorna 'em dia', 'link'
+        (conteudo ja no store), 'copia' ou 'otimizada'.
+        """
+        st = st or src.stat()
+        try:
+            dt = dst.stat()
+        except OSError:
+            dt = None
+        if self.optimizer and self.optimizer.handles(src.name):
+            if self.dir is None:
+                _replace_atomic(dst, lambda tmp: self.optimizer.optimize(src, tmp))
+                return "otimizada"
+            return self._place_optimized(src, dst, st, dt)
+        if dt and (dt.st_size, dt.st_mtime_ns) == (st.st_size, st.st_mtime_ns):
+            return "em dia"
+        if not self.can_link or self.dir is None:
+            _replace_atomic(dst, lambda tmp: _fast_copy(src, tmp))
+            return "copia"
+
+        obj = self.dir / (self.digest(src, st) + src.suffix.lower())
+        if dt and obj.exists() and os.path.samefile(dst, obj):
+            return "em dia"             # mesmo conteudo, so o mtime da origem mudou
+        action = "link"
+        with self._object_lock(obj.name):
+            if not obj.exists():
+                self.dir.mkdir(parents=True, exist_ok=True)
+                _replace_atomic(obj, lambda tmp: _fast_copy(src, tmp))
+                action = "copia"
+        try:
+            _replace_atomic(dst, lambda tmp: os.link(obj, tmp))
+        except OSError:
+            # Sistema de arquivos sem hardlink: o store so duplicaria as imagens
+            self.can_link = False
+            _replace_atomic(dst, lambda tmp: _fast_copy(src, tmp))
+            if action == "copia":
+                obj.unlink(missing_ok=True)
+            return "copia"
+        return action
+
+    def _place_optimized(self, src: Path, dst: Path, st: os.stat_result,
+                         dt: os.stat_result) -> str:
+        """
+        Como place(), mas o objeto e a versao otimizada de src. O objeto fica
+        no store mesmo sem hardlink: e ele que evita reotimizar a imagem.
+        """
+        obj = self.dir / (self.digest(src, st) + self.optimizer.tag + dst.suffix.lower())
+        action = "link"
+        with self._object_lock(obj.name):
+            if not obj.exists():
+                self.dir.mkdir(parents=True, exist_ok=True)
+                _replace_atomic(obj, lambda tmp: self.optimizer.optimize(src, tmp))
+                action = "otimizada"
+        ot = obj.stat()
+        if dt and (os.path.samestat(dt, ot) or (not self.can_link and
+                   (dt.st_size, dt.st_mtime_ns) == (ot.st_size, ot.st_mtime_ns))):
+            return "em dia"
+        if self.can_link:
+            try:
+                _replace_atomic(dst, lambda tmp: os.link(obj, tmp))
+                return action
+            except OSError:
+                self.can_link = False
+        _replace_atomic(dst, lambda tmp: _fast_copy(obj, tmp))
+        return action if action == "otimizada" else "copia"
+
+
+IMAGE_COPY_THREADS = 8
+
+
+class ImageTransfer:
+    """
+    Copia as imagens dos capitulos num pool limitado de threads, enquanto o
+    capitulo seguinte e convertido. submit() enfileira as imagens de um
+    capitulo; wait() espera por elas e retorna (log, segundos de copia).
+    """
+
+    def __init__(self, store: ImageStore, workers: int = IMAGE_COPY_THREADS):
+        self.store  = store
+        self.pool   = ThreadPoolExecutor(max_workers=workers)
+        self.lock   = threading.Lock()
+        self.dirs   = set()         # pastas de destino ja criadas
+        self.placed = {}            # dst -> future (destino pedido por dois capitulos)
+        self.counts = {"copia": 0, "otimizada": 0, "link": 0, "em dia": 0}
+        self.bytes  = 0             # bytes copiados (links e 'em dia' nao contam)
+        self.busy   = 0.0           # soma do tempo das copias nas threads
+        self.waited = 0.0           # tempo bloqueado em wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.pool.shutdown(wait=True)
+        if self.store.dir is not None:
+            self.store.save()
+
+    def _ensure_dir(self, folder: Path):
+        if folder not in self.dirs:
+            folder.mkdir(parents=True, exist_ok=True)
+            self.dirs.add(folder)
+
+    def _place(self, img_rel: str, src: Path, alt: Path, dst: Path,
+               same_dir: bool, earlier=None) -> tuple:
+        """(linha de log ou None, segundos) de uma imagem; alt: fallback na raiz."""
+        if earlier is not None:
+            earlier.result()        # mesmo destino ja em copia por outro capitulo
+        t0 = time.perf_counter()
+        label = "Imagem"
+        try:
+            st = os.stat(src)
+        except OSError:
+            st = None
+        if st is not None and same_dir:
+            return None, 0.0        # origem e destino sao o mesmo arquivo
+        if st is None:
+            try:
+                st = os.stat(alt) if alt is not None else None
+            except OSError:
+                st = None
+            if st is None:
+                return f"  [!] Imagem nao encontrada: {src}", time.perf_counter() - t0
+            src, label = alt, "Imagem (raiz)"
+        self._ensure_dir(dst.parent)
+        action = self.store.place(src, dst, st)
+        seconds = time.perf_counter() - t0
+        with self.lock:
+            self.counts[action] += 1
+            self.busy += seconds
+            if action == "copia":
+                self.bytes += st.st_size
+        note = "" if action == "copia" else f" ({action})"
+        return f"  -> {label}: {img_rel}{note}", seconds
+
+    def submit(self, nb_source_dir: Path, out_dir: Path, image_paths: list) -> list:
+        # Uma resolucao de caminhos por capitulo, e nao duas por imagem
+        out_real = out_dir.resolve()
+        same_dir = nb_source_dir.resolve() == out_real
+        root_alt = Path.cwd().resolve() != out_real
+        job = []
+        for img_rel in image_paths:
+            out_rel = self.store.target(img_rel)
+            dst = out_dir / out_rel
+            future = self.pool.submit(
+                self._place, img_rel, nb_source_dir / img_rel,
+                Path(img_rel) if root_alt else None, dst,
+                same_dir and out_rel == img_rel, self.placed.get(dst)
+            )
+            self.placed[dst] = future
+            job.append(future)
+        return job
+
+    @staticmethod
+    def done(job: list) -> bool:
+        return all(f.done() for f in job)
+
+    def wait(self, job: list) -> tuple:
+        t0 = time.perf_counter()
+        results = [f.result() for f in job]
+        self.waited += time.perf_counter() - t0
+        log = "".join(line + "\n" for line, _ in results if line)
+        return log, sum(seconds for _, seconds in results)
+
+    def report(self) -> str:
+        c = self.counts
+        optimized = f"{c['otimizada']} otimizadas, " if self.store.optimizer else ""
+        return (f"Imagens: {c['copia']} copiadas ({self.bytes / 1e6:.1f} MB), {optimized}"
+                f"{c['link']} hardlinks, {c['em dia']} em dia; "
+                f"{self.busy:.2f} s de copia, {self.waited:.2f} s de espera")
+
+
+def copy_images(nb_source_dir: Path, out_dir: Path, image_paths: list,
+                store: ImageStore = None, optimizer: ImageOptimizer = None) -> float:
+    """
+    Copia as imagens de um notebook; retorna o tempo gasto nas copias (s).
+    Sem 'store' (modo unico), copia direto para out_dir, sem criar .images/.
+    """
+    with ImageTransfer(store or ImageStore(None, optimizer)) as transfer:
+        log, seconds = transfer.wait(transfer.submit(nb_source_dir, out_dir, image_paths))
+    print(log, end="")
+    return seconds
+
+
+# ---------------------------------------------------------------------------
+# 13b. Conversao dos capitulos (sequencial ou em pool de processos)
+# ---------------------------------------------------------------------------
+
+# Bibliografia de cada processo do pool: recebida uma unica vez pelo
+# inicializador, e nao re-parseada (nem re-enviada) a cada capitulo.
+_worker_bib = None
+_worker_optimizer = None
+_worker_outputs = None
+_worker_inline = None
+_worker_elements = None
+_worker_cell_cache = None
+
+
+def _init_chapter_worker(bib: dict, optimizer: ImageOptimizer = None,
+                         outputs: OutputPolicy = None, inline: ImageInliner = None,
+                         elements: ElementMaps = None, cell_cache: CellCache = None):
+    global _worker_bib, _worker_optimizer, _worker_outputs, _worker_inline, _worker_elements
+    global _worker_cell_cache
+    _worker_bib, _worker_optimizer = bib, optimizer
+    _worker_outputs, _worker_inline, _worker_elements = outputs, inline, elements
+    _worker_cell_cache = cell_cache
+
+
+def convert_chapter(nb_path: Path, out_nb: Path, bib: dict, epub: bool = False,
+                    traces: list = None, optimizer: ImageOptimizer = None,
+                    outputs: OutputPolicy = None, inline: ImageInliner = None,
+                    elements: ElementMaps = None, targets: tuple = None,
+                    cell_cache: CellCache = None, written: set = None) -> list:
+    """
+    Converte um capitulo e retorna os caminhos das imagens, copiadas depois
+    por ImageTransfer. Com 'traces' (--profile), mede os estagios e
+    acrescenta o trace do capitulo. Com 'targets' (--targets), uma analise
+    grava todos os alvos ao lado de out_nb. 'written' recebe as imagens de
+    output gravadas ao lado de out_nb (--outputs externalize, alvos md/html).
+    """
+    print(f"[{nb_path.parent.name}] {nb_path}")
+    if targets:
+        outs = {t: target_path(nb_path, out_nb.parent, t) for t in targets}
+    else:
+        outs = {"epub" if epub else "aluno": out_nb}
+    with profiling(nb_path, traces):
+        image_paths = process_targets(nb_path, bib, outs, optimizer, outputs,
+                                      inline, elements, cell_cache, written)
     return image_paths
 
 
+def _convert_chapter_logged(nb_path: Path, out_nb: Path, bib: dict, epub: bool,
+                            profile: bool, optimizer: ImageOptimizer = None,
+                            outputs: OutputPolicy = None,
+                            inline: ImageInliner = None,
+                            elements: ElementMaps = None,
+                            targets: tuple = None,
+                            cell_cache: CellCache = None) -> tuple:
+    """
+    convert_chapter com a saida capturada: (log, imagens, traces, imagens de
+    output gravadas, (acertos, falhas) do cache de celulas neste capitulo).
+    """
+    log, traces, written = io.StringIO(), [] if profile else None, set()
+    hits, misses = (cell_cache.hits, cell_cache.misses) if cell_cache else (0, 0)
+    with contextlib.redirect_stdout(log):
+        image_paths = convert_chapter(nb_path, out_nb, bib, epub, traces, optimizer,
+                                      outputs, inline, elements, targets, cell_cache,
+                                      written)
+    if cell_cache:
+        hits, misses = cell_cache.hits - hits, cell_cache.misses - misses
+    return log.getvalue(), image_paths, traces, sorted(written), (hits, misses)
+
+
+def _convert_chapter_in_worker(job: tuple) -> tuple:
+    """
+    Executa convert_chapter num processo do pool: o log de cada capitulo
+    volta inteiro e e impresso em bloco pelo pai.
+    """
+    nb_path, out_nb, epub, profile, targets = job
+    return _convert_chapter_logged(nb_path, out_nb, _worker_bib, epub, profile,
+                                   _worker_optimizer, _worker_outputs, _worker_inline,
+                                   _worker_elements, targets, _worker_cell_cache)
+
+
+def convert_chapters(chapters: list, bib: dict, jobs: int = 1, epub: bool = False,
+                     cache: dict = None, traces: list = None,
+                     store: ImageStore = None, outputs: OutputPolicy = None,
+                     inline: ImageInliner = None, elements: ElementMaps = None,
+                     targets: tuple = None, cell_cache: CellCache = None) -> int:
+    """
+    Converte os capitulos [(nb_path, out_nb), ...] e retorna o total de imagens.
+    Com jobs > 1 os capitulos (independentes entre si) vao para um pool de
+    processos; os logs sao impressos na ordem dos capitulos, sem intercalar.
+    As imagens de cada capitulo sao copiadas em threads (ImageTransfer)
+    enquanto o capitulo seguinte e convertido; o log do capitulo sai quando
+    as copias dele terminam.
+    Com 'cache' (ver load_build_cache), capitulos com saida em dia sao pulados
+    e as entradas dos capitulos reconvertidos sao atualizadas.
+    Com 'traces' (--profile), recebe o trace de cada capitulo convertido.
+    O ImageOptimizer do store (--optimize-images) vale tambem para os
+    caminhos das imagens nos notebooks; 'outputs' e a politica --outputs.
+    Com 'inline' (--inline-images), as imagens embutidas nao sao copiadas.
+    'elements' traz o cache de mapas de elementos e o indice global
+    (build_element_index). 'targets' (--targets) sao os alvos de cada
+    capitulo; out_nb e entao a saida do primeiro alvo. 'cell_cache' e o
+    cache de celulas processadas (CellCache).
+    """
+    if not chapters:
+        return 0
+    # out_nb = <out_root>/capXX/...: um store para todos os capitulos
+    store = store or ImageStore(chapters[0][1].parent.parent)
+    optimizer = store.optimizer
+    total_imgs = 0
+    pending = []
+    for nb_path, out_nb in chapters:
+        key = None
+        if cache is not None:
+            key   = chapter_build_key(nb_path, bib, optimizer, outputs, inline,
+                                      elements and elements.index, targets)
+            entry = cache.get(_cache_name(out_nb))
+            if is_chapter_current(entry, key, nb_path, out_nb, optimizer, inline, targets):
+                print(f"[{nb_path.parent.name}] {nb_path} (em dia, cache)\n")
+                total_imgs += len(entry["images"])
+                continue
+        pending.append((nb_path, out_nb, key))
+    if not pending:
+        return total_imgs
+
+    def record(item, image_paths, output_images):
+        nonlocal total_imgs
+        nb_path, out_nb, key = item
+        total_imgs += len(image_paths)
+        if cache is not None:
+            cache[_cache_name(out_nb)] = {
+                **key, "images": _image_signature(nb_path.parent, image_paths),
+                "output_images": output_images,
+            }
+
+    queue = []      # capitulos convertidos esperando as imagens: (log, job, traces)
+
+    def finish(transfer: ImageTransfer, block: bool):
+        """Imprime, em ordem, os capitulos cujas imagens ja foram copiadas."""
+        while queue and (block or transfer.done(queue[0][1])):
+            log, job, chapter_traces = queue.pop(0)
+            image_log, seconds = transfer.wait(job)
+            print(log + image_log, end="")
+            for trace in chapter_traces or ():
+                add_copy_stage(trace, seconds)
+                print(profile_table(trace))
+                traces.append(trace)
+            print()
+
+    profile = traces is not None
+    pooled = jobs > 1 and len(pending) > 1
+    with contextlib.ExitStack() as stack:
+        if not pooled:
+            # Gerador: cada capitulo so e convertido quando o anterior ja
+            # entregou as imagens ao ImageTransfer
+            results = (_convert_chapter_logged(nb_path, out_nb, bib, epub, profile,
+                                               optimizer, outputs, inline, elements, targets,
+                                               cell_cache)
+                       for nb_path, out_nb, _ in pending)
+        else:
+            pool = stack.enter_context(ProcessPoolExecutor(
+                max_workers=min(jobs, len(pending)),
+                initializer=_init_chapter_worker,
+                initargs=(bib, optimizer, outputs, inline, elements, cell_cache)))
+            results = pool.map(_convert_chapter_in_worker,
+                               [(nb_path, out_nb, epub, profile, targets)
+                                for nb_path, out_nb, _ in pending])
+        transfer = stack.enter_context(ImageTransfer(store))
+        for item, (log, image_paths, chapter_traces, output_images,
+                   (hits, misses)) in zip(pending, results):
+            record(item, image_paths, output_images)
+            if pooled and cell_cache:
+                # o cache de cada processo e uma copia: as contagens voltam ao pai
+                cell_cache.hits   += hits
+                cell_cache.misses += misses
+            copied = [p for p in image_paths if not (inline and inline.handles(p))]
+            queue.append((log, transfer.submit(item[0].parent, item[1].parent, copied),
+                          chapter_traces))
+            finish(transfer, block=False)
+        finish(transfer, block=True)
+        print(transfer.report())
+    return total_imgs
+
+
 # ---------------------------------------------------------------------------
-# 13. Copia imagens
+# 13c. Cache incremental de build (<out_dir>/.build-cache.json)
 # ---------------------------------------------------------------------------
+# Uma entrada por notebook gerado, com o hash do notebook de origem, o hash
+# das entradas do references.bib que ele pode citar e o hash do proprio
+# conversor, alem de tamanho/mtime das imagens copiadas e da lista das
+# imagens de output gravadas (--outputs externalize, alvos md/html). O
+# capitulo so e reconvertido se algo disso mudou ou se alguma saida sumiu.
+
+BUILD_CACHE_NAME = ".build-cache.json"
+AT_KEY_RE = re.compile(r'@([\w:-]+)')
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def converter_version() -> str:
+    """Hash deste script: qualquer mudanca no conversor invalida o cache."""
+    return _sha256(Path(__file__).read_bytes())
+
+
+def _cache_name(out_nb: Path) -> str:
+    """Chave da entrada: capXX/capXX_aluno.ipynb (relativa a out_dir)."""
+    return f"{out_nb.parent.name}/{out_nb.name}"
+
+
+def load_build_cache(out_root: Path) -> dict:
+    try:
+        cache = json.loads((out_root / BUILD_CACHE_NAME).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def save_build_cache(out_root: Path, cache: dict):
+    out_root.mkdir(parents=True, exist_ok=True)
+    (out_root / BUILD_CACHE_NAME).write_text(
+        json.dumps(cache, ensure_ascii=False, indent=1, sort_keys=True),
+        encoding="utf-8"
+    )
+
+
+def chapter_build_key(nb_path: Path, bib: dict, optimizer: ImageOptimizer = None,
+                      outputs: OutputPolicy = None, inline: ImageInliner = None,
+                      index: dict = None, targets: tuple = None) -> dict:
+    """
+    Hashes que determinam a saida do capitulo. As chaves do .bib sao as que
+    aparecem como @chave no JSON cru (superconjunto das citacoes reais), o
+    que evita parsear o notebook so para saber se ele esta em dia.
+    'optimize', 'outputs' e 'inline' sao None sem --optimize-images, com
+    --outputs keep e sem --inline-images (casam com caches antigos).
+    'xrefs' cobre as entradas do indice global que o notebook pode citar;
+    'targets' e None fora de --targets.
+    """
+    raw   = nb_path.read_bytes()
+    cited = set(AT_KEY_RE.findall(raw.decode("utf-8", errors="replace")))
+    bib_subset = {k: bib[k] for k in sorted(cited & bib.keys())}
+    xrefs = {k: index[k] for k in sorted(cited & index.keys())} if index else {}
+    return {
+        "notebook":  _sha256(raw),
+        "bib":       _sha256(json.dumps(bib_subset, ensure_ascii=False,
+                                        sort_keys=True).encode("utf-8")),
+        "converter": converter_version(),
+        "optimize":  optimizer and [optimizer.tag, optimizer.webp],
+        "outputs":   outputs and outputs.key(nb_path.parent.name),
+        "inline":    inline and inline.key(),
+        "xrefs":     _sha256(json.dumps(xrefs, sort_keys=True).encode("utf-8")) if xrefs else None,
+        "targets":   list(targets) if targets else None,
+    }
 
-def copy_images(nb_source_dir: Path, out_dir: Path, image_paths: list):
+
+def _image_signature(nb_dir: Path, image_paths) -> dict:
+    """img_rel -> [tamanho, mtime_ns] da imagem de origem (None se ausente)."""
+    signature = {}
     for img_rel in image_paths:
-        src = nb_source_dir / img_rel
-        dst = out_dir / img_rel
-        if src.exists() and src.resolve() != dst.resolve():
-            dst.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copy2(src, dst)
-            print(f"  -> Imagem: {img_rel}")
-        elif not src.exists():
-            alt_src = Path(img_rel)
-            if alt_src.exists() and alt_src.resolve() != dst.resolve():
-                dst.parent.mkdir(parents=True, exist_ok=True)
-                shutil.copy2(alt_src, dst)
-                print(f"  -> Imagem (raiz): {img_rel}")
-            else:
-                print(f"  [!] Imagem nao encontrada: {src}")
+        src = nb_dir / img_rel
+        if not src.exists():
+            src = Path(img_rel)         # mesmo fallback de copy_images
+        try:
+            st = src.stat()
+            signature[img_rel] = [st.st_size, st.st_mtime_ns]
+        except OSError:
+            signature[img_rel] = None
+    return signature
+
+
+def prune_image_store(store: ImageStore, inline: ImageInliner, chapters: list,
+                      cache: dict):
+    """
+    Limpeza apos um batch: objetos do store que nenhuma saida usa e cuja
+    origem sumiu ou mudou (ImageStore.prune), e entradas de --inline-images
+    de imagens fora dos capitulos (ImageInliner.prune). As origens vem do
+    'cache' de build ja atualizado, que cobre todos os 'chapters'.
+    """
+    sources = set()
+    for nb_path, out_nb in chapters:
+        for img_rel in (cache.get(_cache_name(out_nb)) or {}).get("images", ()):
+            src = nb_path.parent / img_rel
+            sources.add(src if src.exists() else Path(img_rel))   # fallback de copy_images
+    removed = store.prune(sources)
+    inline_removed = inline.prune(sources) if inline else 0
+    if removed or inline_removed:
+        print(f"Store de imagens: {removed} objetos e {inline_removed} "
+              f"entradas inline sem uso removidos")
+
+
+def is_chapter_current(entry: dict, key: dict, nb_path: Path, out_nb: Path,
+                       optimizer: ImageOptimizer = None,
+                       inline: ImageInliner = None, targets: tuple = None) -> bool:
+    """True se a entrada do cache corresponde a key e as saidas existem."""
+    if not entry or any(entry.get(k) != v for k, v in key.items()):
+        return False
+    outs = [target_path(nb_path, out_nb.parent, t) for t in targets] if targets else [out_nb]
+    if not all(out.exists() for out in outs):
+        return False
+    if not all((out_nb.parent / img_rel).exists()
+               for img_rel in entry.get("output_images", ())):
+        return False
+    images = entry.get("images", {})
+    if _image_signature(nb_path.parent, images) != images:
+        return False
+    target = optimizer.target if optimizer else str
+    return all((out_nb.parent / target(img_rel)).exists()
+               for img_rel, sig in images.items()
+               if sig is not None and not (inline and inline.handles(img_rel)))
 
 
 # ---------------------------------------------------------------------------
@@ -1575,43 +4011,30 @@ format:
     #css: styles.css 
 """
 
-def run_batch_epub(bib_path: str, out_dir: str):
+def find_chapters(out_root: Path, epub: bool = False, targets: tuple = None) -> list:
     """
-    Gera notebooks pre-processados para EPUB em <out_dir>/capXX/capXX_epub.ipynb
-    e cria _quarto_epub.yml apontando para eles.
-    As refs ja estao resolvidas como texto simples por capitulo.
-
-    Uso posterior:
-        quarto render --config _quarto_epub.yml --to epub
+    [(nb_path, out_nb), ...] dos cap*/cap*.ipynb: saida em
+    <out_root>/capXX/capXX_aluno.ipynb (ou capXX_epub.ipynb com epub; com
+    targets, a saida do primeiro alvo).
     """
-    bib      = parse_bib(bib_path)
-    out_root = Path(out_dir)
-    EXCLUDE  = ("_dist", "_executado", "_fixed", "_aluno", "_epub")
+    if epub or targets:
+        exclude, suffix = ("_dist", "_executado", "_fixed", "_aluno", "_epub"), "_epub.ipynb"
+    else:
+        exclude, suffix = ("_dist", "_executado", "_fixed"), "_aluno.ipynb"
+    if targets:
+        suffix = TARGETS[targets[0]][0]
     notebooks = sorted([
         Path(p) for p in glob.glob("cap*/cap*.ipynb")
-        if not any(s in Path(p).stem for s in EXCLUDE)
+        if not any(s in Path(p).stem for s in exclude)
     ])
-    if not notebooks:
-        print("Nenhum notebook encontrado com o padrao: cap*/cap*.ipynb")
-        return
+    return [(nb_path, out_root / nb_path.parent.name / (nb_path.stem + suffix))
+            for nb_path in notebooks]
 
-    print(f"[EPUB] Encontrados {len(notebooks)} notebooks:\n")
-    chapter_lines = []
-    total_imgs = 0
 
-    for nb_path in notebooks:
-        cap_name   = nb_path.parent.name
-        out_cap    = out_root / cap_name
-        epub_name  = nb_path.stem + "_epub.ipynb"
-        out_nb     = out_cap / epub_name
-        print(f"[{cap_name}] {nb_path}")
-        image_paths = process_notebook_epub(nb_path, bib, out_nb)
-        if image_paths:
-            copy_images(nb_path.parent, out_cap, image_paths)
-            total_imgs += len(image_paths)
-        # Caminho relativo para o _quarto_epub.yml
-        chapter_lines.append(f"    - {out_nb.as_posix()}")
-        print()
+def write_epub_project(epub_notebooks: list):
+    """Grava _quarto_epub.yml (capitulos = epub_notebooks) e render_epub.sh."""
+    # Caminhos relativos para o _quarto_epub.yml
+    chapter_lines = [f"    - {out_nb.as_posix()}" for out_nb in epub_notebooks]
 
     # Gera _quarto_epub.yml
     yml_path = Path("_quarto_epub.yml")
@@ -1658,41 +4081,60 @@ def run_batch_epub(bib_path: str, out_dir: str):
     print(f"render_epub.sh gerado.")
     print(f"\nPara gerar o EPUB, execute:")
     print(f"  ./render_epub.sh")
-    print(f"\nConcluido! {len(notebooks)} notebooks e {total_imgs} imagens em '{out_root}/'")
 
 
-# ---------------------------------------------------------------------------
-# 14. Modo batch (alunos)
-# ---------------------------------------------------------------------------
+def run_batch_epub(bib_path: str, out_dir: str, jobs: int = 1, force: bool = False,
+                   profile: Path = None, optimizer: ImageOptimizer = None,
+                   outputs: OutputPolicy = None, inline: str = None,
+                   cell_cache_mb: int = 64):
+    """
+    Gera notebooks pre-processados para EPUB em <out_dir>/capXX/capXX_epub.ipynb
+    e cria _quarto_epub.yml apontando para eles.
+    As refs ja estao resolvidas como texto simples por capitulo.
+    Com 'profile', grava nesse caminho o trace JSON de --profile; com
+    'optimizer' (--optimize-images), as imagens saem otimizadas; 'outputs'
+    e a politica de outputs das celulas de codigo (--outputs); 'inline' e o
+    modo de --inline-images (attachment ou data-uri); 'cell_cache_mb' e o
+    limite do cache de celulas (0 desliga).
 
-def run_batch(bib_path: str, out_dir: str):
+    Uso posterior:
+        quarto render --config _quarto_epub.yml --to epub
+    """
     bib      = parse_bib(bib_path)
     out_root = Path(out_dir)
-    EXCLUDE  = ("_dist", "_executado", "_fixed")
-    notebooks = sorted([
-        Path(p) for p in glob.glob("cap*/cap*.ipynb")
-        if not any(s in Path(p).stem for s in EXCLUDE)
-    ])
+    chapters = find_chapters(out_root, epub=True)
+    notebooks = [nb_path for nb_path, _ in chapters]
     if not notebooks:
         print("Nenhum notebook encontrado com o padrao: cap*/cap*.ipynb")
         return
 
-    print(f"Encontrados {len(notebooks)} notebooks:\n")
-    total_imgs = 0
-    for nb_path in notebooks:
-        cap_name = nb_path.parent.name
-        out_cap  = out_root / cap_name
-        # Nome de saida: cap01_aluno.ipynb
-        aluno_name = nb_path.stem + "_aluno.ipynb"
-        out_nb   = out_cap  / aluno_name
-        print(f"[{cap_name}] {nb_path}")
-        image_paths = process_notebook(nb_path, bib, out_nb)
-        if image_paths:
-            copy_images(nb_path.parent, out_cap, image_paths)
-            total_imgs += len(image_paths)
-        print()
-
-    # Gera README.md
+    print(f"[EPUB] Encontrados {len(notebooks)} notebooks:\n")
+    elements = ElementMaps(out_root)
+    build_element_index(chapters, elements, jobs)
+    cache  = {} if force else load_build_cache(out_root)
+    traces = [] if profile else None
+    cell_cache = cell_cache_for(out_root, cell_cache_mb, force)
+    store   = ImageStore(out_root, optimizer)
+    inliner = image_inliner(inline, out_root, optimizer)
+    total_imgs = convert_chapters(chapters, bib, jobs, epub=True, cache=cache,
+                                  traces=traces, store=store, outputs=outputs,
+                                  inline=inliner, elements=elements, cell_cache=cell_cache)
+    save_build_cache(out_root, cache)
+    prune_image_store(store, inliner, chapters, cache)
+    report_cell_cache(cell_cache)
+    if profile:
+        write_profile_trace(profile, traces)
+
+    write_epub_project([out_nb for _, out_nb in chapters])
+    print(f"\nConcluido! {len(notebooks)} notebooks e {total_imgs} imagens em '{out_root}/'")
+
+
+# ---------------------------------------------------------------------------
+# 14. Modo batch (alunos)
+# ---------------------------------------------------------------------------
+
+def write_readme(out_root: Path):
+    """Gera <out_root>/README.md do pacote de notebooks dos alunos."""
     readme = out_root / "README.md"
     readme.write_text(
         "# Notebooks para Alunos\n\n"
@@ -1715,12 +4157,343 @@ def run_batch(bib_path: str, out_dir: str):
     )
     print(f"README.md gerado em '{readme}'")
 
+
+def run_batch(bib_path: str, out_dir: str, jobs: int = 1, force: bool = False,
+              profile: Path = None, optimizer: ImageOptimizer = None,
+              outputs: OutputPolicy = None, inline: str = None,
+              targets: tuple = None, cell_cache_mb: int = 64):
+    """
+    Gera <out_dir>/capXX/capXX_aluno.ipynb. Com 'targets' (--targets), cada
+    capitulo e analisado uma vez e gravado em todos os alvos (ver TARGETS);
+    com o alvo epub, gera tambem _quarto_epub.yml e render_epub.sh.
+    'cell_cache_mb' e o limite do cache de celulas (0 desliga).
+    """
+    bib      = parse_bib(bib_path)
+    out_root = Path(out_dir)
+    chapters = find_chapters(out_root, targets=targets)
+    notebooks = [nb_path for nb_path, _ in chapters]
+    if not notebooks:
+        print("Nenhum notebook encontrado com o padrao: cap*/cap*.ipynb")
+        return
+
+    print(f"Encontrados {len(notebooks)} notebooks:\n")
+    elements = ElementMaps(out_root)
+    build_element_index(chapters, elements, jobs)
+    cache  = {} if force else load_build_cache(out_root)
+    traces = [] if profile else None
+    cell_cache = cell_cache_for(out_root, cell_cache_mb, force)
+    store   = ImageStore(out_root, optimizer)
+    inliner = image_inliner(inline, out_root, optimizer)
+    total_imgs = convert_chapters(chapters, bib, jobs, cache=cache, traces=traces,
+                                  store=store, outputs=outputs, inline=inliner,
+                                  elements=elements, targets=targets, cell_cache=cell_cache)
+    save_build_cache(out_root, cache)
+    prune_image_store(store, inliner, chapters, cache)
+    report_cell_cache(cell_cache)
+    if profile:
+        write_profile_trace(profile, traces)
+
+    if not targets or "aluno" in targets:
+        write_readme(out_root)
+    if targets and "epub" in targets:
+        write_epub_project([target_path(nb_path, out_nb.parent, "epub")
+                            for nb_path, out_nb in chapters])
+
     print(
         f"Concluido! {len(notebooks)} notebooks e {total_imgs} imagens "
         f"exportados para '{out_root}/'"
     )
 
 
+# ---------------------------------------------------------------------------
+# 14c. Modo watch (--watch): regenera so os capitulos afetados
+# ---------------------------------------------------------------------------
+# Apos o build inicial, a bibliografia fica parseada em memoria e cada
+# capitulo tem suas dependencias: o proprio notebook, as imagens de origem
+# (do cache de build) e as chaves @ que aparecem nele. Um notebook ou
+# imagem salvos reconvertem o capitulo dono; uma edicao do .bib, so os
+# capitulos que citam as entradas alteradas. Mudancas chegam por inotify
+# (Linux, via ctypes) ou, sem ele, por polling de mtime. A raiz do livro e
+# as pastas cap* sao vigiadas tambem por arquivos novos: um capNN/capNN.ipynb
+# criado (ou renomeado para la) durante a sessao entra no grafo e e convertido.
+
+WATCH_DEBOUNCE = 0.05           # s de silencio que fecham um lote de eventos
+WATCH_POLL_INTERVAL = 0.25
+
+
+def _stamp(path: Path):
+    try:
+        st = path.stat()
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return None
+
+
+def _listing(folder: Path) -> set:
+    try:
+        return set(os.listdir(folder))
+    except OSError:
+        return set()
+
+
+class PollingWatcher:
+    """
+    Compara tamanho/mtime dos arquivos vigiados (e a listagem das pastas de
+    watch_new) a cada WATCH_POLL_INTERVAL.
+    """
+
+    def __init__(self):
+        self.stamps  = {}
+        self.folders = {}           # pasta -> nomes ja vistos
+
+    def watch(self, paths):
+        for path in paths:
+            if path not in self.stamps:
+                self.stamps[path] = _stamp(path)
+
+    def watch_new(self, folders):
+        """Relata tambem as entradas criadas nessas pastas."""
+        for folder in folders:
+            folder = Path(os.path.abspath(folder))
+            if folder not in self.folders:
+                self.folders[folder] = _listing(folder)
+
+    def wait(self, timeout: float) -> set:
+        """Arquivos vigiados que mudaram (conjunto vazio apos 'timeout' s)."""
+        deadline = time.monotonic() + timeout
+        while True:
+            changed = set()
+            for path, old in self.stamps.items():
+                new = _stamp(path)
+                if new != old:
+                    self.stamps[path] = new
+                    changed.add(path)
+            for folder, old in self.folders.items():
+                names = _listing(folder)
+                changed |= {folder / name for name in names - old}
+                self.folders[folder] = names
+            if changed or time.monotonic() >= deadline:
+                return changed
+            time.sleep(min(WATCH_POLL_INTERVAL, max(0.0, deadline - time.monotonic())))
+
+
+class InotifyWatcher:
+    """
+    inotify nas pastas dos arquivos vigiados (editores costumam salvar
+    gravando outro arquivo e renomeando, o que troca o inode).
+    """
+
+    # IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    MASK  = 0x002 | 0x004 | 0x008 | 0x080 | 0x100 | 0x200
+    NEW   = 0x080 | 0x100       # IN_MOVED_TO | IN_CREATE: entrada nova (watch_new)
+    EVENT = struct.Struct("iIII")   # wd, mask, cookie, len (+ nome)
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        self.dirs  = {}             # wd -> pasta
+        self.wds   = {}             # pasta -> wd
+        self.paths = set()
+        self.roots = set()          # pastas de watch_new
+
+    def _add_watch(self, folder: Path):
+        if folder in self.wds or not folder.is_dir():
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch {folder}")
+        self.dirs[wd], self.wds[folder] = folder, wd
+
+    def watch(self, paths):
+        for path in paths:
+            path = Path(os.path.abspath(path))
+            self.paths.add(path)
+            self._add_watch(path.parent)
+
+    def watch_new(self, folders):
+        """Relata tambem as entradas criadas (ou movidas para) essas pastas."""
+        for folder in folders:
+            folder = Path(os.path.abspath(folder))
+            self.roots.add(folder)
+            self._add_watch(folder)
+
+    def wait(self, timeout: float) -> set:
+        changed = set()
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return changed
+        data, pos = os.read(self.fd, 1 << 16), 0
+        while pos < len(data):
+            wd, mask, _, size = self.EVENT.unpack_from(data, pos)
+            pos += self.EVENT.size
+            name = data[pos:pos + size].rstrip(b"\0")
+            pos += size
+            folder = self.dirs.get(wd)
+            if folder is not None and name:
+                path = folder / os.fsdecode(name)
+                if path in self.paths or (folder in self.roots and mask & self.NEW):
+                    changed.add(path)
+        return changed
+
+
+def make_watcher():
+    """InotifyWatcher no Linux; PollingWatcher se inotify nao estiver disponivel."""
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError, TypeError):
+            pass
+    return PollingWatcher()
+
+
+class ChapterGraph:
+    """Dependencias de cada capitulo: notebook, imagens de origem e chaves citaveis."""
+
+    def __init__(self, chapters: list, cache: dict):
+        self.chapters = chapters
+        self.cache    = cache
+        self.cited    = {}          # nb_path -> chaves @ no JSON cru
+        self.owners   = {}          # arquivo (absoluto) -> {nb_path}
+        for nb_path, out_nb in chapters:
+            self.update(nb_path, out_nb)
+
+    def update(self, nb_path: Path, out_nb: Path):
+        """Rele as dependencias de um capitulo (apos reconverte-lo)."""
+        try:
+            raw = nb_path.read_text(encoding="utf-8", errors="replace")
+        except OSError:
+            raw = ""
+        self.cited[nb_path] = set(AT_KEY_RE.findall(raw))
+        files = {nb_path}
+        for img_rel in self.cache.get(_cache_name(out_nb), {}).get("images", {}):
+            files |= {nb_path.parent / img_rel, Path(img_rel)}   # fallback na raiz
+        for owners in self.owners.values():
+            owners.discard(nb_path)
+        for path in files:
+            self.owners.setdefault(Path(os.path.abspath(path)), set()).add(nb_path)
+
+    def add(self, found: list) -> list:
+        """
+        Acrescenta os capitulos de 'found' (find_chapters) ainda fora do grafo
+        e retorna-os. Um notebook que ainda nao e JSON valido (sendo gravado)
+        fica para o proximo evento.
+        """
+        new = []
+        for nb_path, out_nb in found:
+            if nb_path in self.cited:
+                continue
+            try:
+                json.loads(nb_path.read_bytes())
+            except (OSError, ValueError):
+                continue
+            new.append((nb_path, out_nb))
+        for nb_path, out_nb in new:
+            self.update(nb_path, out_nb)
+        self.chapters = sorted(self.chapters + new)
+        return new
+
+    def files(self) -> set:
+        return set(self.owners)
+
+    def affected(self, changed: set, changed_keys: set = frozenset()) -> list:
+        """Capitulos (na ordem original) que dependem de 'changed' ou citam 'changed_keys'."""
+        hit = {nb for path in changed for nb in self.owners.get(path, ())}
+        hit |= {nb for nb, keys in self.cited.items() if keys & changed_keys}
+        return [(nb_path, out_nb) for nb_path, out_nb in self.chapters if nb_path in hit]
+
+
+def _book_dirs() -> set:
+    """Raiz do livro e pastas cap*: onde um capitulo novo pode aparecer."""
+    return {Path(os.path.abspath(".")), *(Path(os.path.abspath(p)) for p in glob.glob("cap*/"))}
+
+
+def watch_chapters(bib_path: str, out_dir: str, jobs: int = 1, epub: bool = False,
+                   optimizer: ImageOptimizer = None, outputs: OutputPolicy = None,
+                   inline: str = None, targets: tuple = None,
+                   cell_cache_mb: int = 64):
+    """
+    Loop do --watch (apos run_batch/run_batch_epub): espera mudancas nos
+    notebooks, imagens e no .bib e reconverte so os capitulos afetados,
+    usando o cache de build em memoria. Capitulos criados durante a sessao
+    entram no grafo e sao convertidos. Termina com Ctrl+C.
+    """
+    out_root = Path(out_dir)
+    bib_file = Path(os.path.abspath(bib_path))
+    bib      = parse_bib(bib_path)
+    chapters = find_chapters(out_root, epub, targets)
+    elements = ElementMaps(out_root)
+    index    = build_element_index(chapters, elements, jobs)
+    cache    = load_build_cache(out_root)
+    graph    = ChapterGraph(chapters, cache)
+    store    = ImageStore(out_root, optimizer)
+    inliner  = image_inliner(inline, out_root, optimizer)
+    cells    = cell_cache_for(out_root, cell_cache_mb)
+    watcher  = make_watcher()
+    watcher.watch(graph.files() | {bib_file})
+    book_dirs = _book_dirs()
+    watcher.watch_new(book_dirs)
+    print(f"\n[watch] Vigiando {len(chapters)} capitulos, imagens e {bib_path} "
+          f"({type(watcher).__name__}). Ctrl+C para sair.")
+
+    try:
+        while True:
+            changed = watcher.wait(3600)
+            while changed:          # junta as gravacoes de um mesmo salvamento
+                more = watcher.wait(WATCH_DEBOUNCE)
+                if not more:
+                    break
+                changed |= more
+            if not changed:
+                continue
+            t0 = time.perf_counter()
+            new = []
+            if any(path.parent in book_dirs for path in changed):
+                # Entrada nova no livro: pasta capNN (vigiada daqui em diante)
+                # ou notebook. Os incompletos ficam vigiados e voltam ao terminar.
+                book_dirs |= _book_dirs()
+                watcher.watch_new(book_dirs)
+                found = find_chapters(out_root, epub, targets)
+                watcher.watch(Path(os.path.abspath(nb_path)) for nb_path, _ in found)
+                new = graph.add(found)
+                chapters = graph.chapters
+                for nb_path, _ in new:
+                    print(f"[watch] Capitulo novo: {nb_path}")
+            changed |= {Path(os.path.abspath(nb_path)) for nb_path, _ in new}
+            changed_keys = set()
+            if bib_file in changed:
+                new_bib = parse_bib(bib_path)
+                changed_keys = {k for k in bib.keys() | new_bib.keys()
+                                if bib.get(k) != new_bib.get(k)}
+                bib = new_bib
+                print(f"[watch] {bib_path}: {len(changed_keys)} entradas alteradas")
+            if any(Path(os.path.abspath(nb_path)) in changed for nb_path, _ in graph.chapters):
+                # Numeracao alterada num capitulo: reconverte quem cita os ids
+                new_index = build_element_index(chapters, elements, jobs)
+                changed_keys |= {k for k in index.keys() | new_index.keys()
+                                 if index.get(k) != new_index.get(k)}
+                index = new_index
+            todo = graph.affected(changed, changed_keys)
+            if not todo:
+                continue
+            with contextlib.redirect_stdout(io.StringIO()) as log:
+                convert_chapters(todo, bib, jobs, epub=epub, cache=cache, store=store,
+                                 outputs=outputs, inline=inliner, elements=elements,
+                                 targets=targets, cell_cache=cells)
+            save_build_cache(out_root, cache)
+            for nb_path, out_nb in todo:
+                graph.update(nb_path, out_nb)
+            watcher.watch(graph.files())
+            warnings = [l for l in log.getvalue().splitlines() if "[!]" in l]
+            print("\n".join(warnings + [
+                f"[watch] {', '.join(nb.parent.name for nb, _ in todo)} "
+                f"atualizado(s) em {time.perf_counter() - t0:.2f} s"]))
+            report_cell_cache(cells)    # --cell-cache-mb vale tambem numa sessao longa
+    except KeyboardInterrupt:
+        print("\n[watch] Encerrado.")
+
+
 # ---------------------------------------------------------------------------
 # 15. CLI
 # ---------------------------------------------------------------------------
@@ -1737,16 +4510,86 @@ def main():
                         help="Processa todos cap*/cap*.ipynb para EPUB (refs por capitulo em texto)")
     parser.add_argument("--out-dir", default="notebooks_alunos",
                         help="Pasta de saida no modo batch/epub (padrao: notebooks_alunos)")
+    parser.add_argument("--jobs", "-j", type=int, default=1, metavar="N",
+                        help="Capitulos convertidos em paralelo no modo batch/epub (padrao: 1)")
+    parser.add_argument("--force", action="store_true",
+                        help="Reconverte todos os capitulos, ignorando o cache de build")
+    parser.add_argument("--profile", action="store_true",
+                        help="Mede cada estagio da conversao: tabela por capitulo e trace JSON")
+    parser.add_argument("--profile-json", metavar="ARQ",
+                        help="Trace JSON do --profile (padrao: <out-dir>/profile.json, "
+                             "ou <saida>.profile.json no modo unico)")
+    parser.add_argument("--optimize-images", action="store_true",
+                        help="Reduz e recomprime as imagens PNG/JPEG copiadas (requer Pillow)")
+    parser.add_argument("--max-width", type=int, default=1200, metavar="PX",
+                        help="Largura maxima das imagens com --optimize-images (padrao: 1200)")
+    parser.add_argument("--webp", action="store_true",
+                        help="Com --optimize-images, grava as imagens em WebP e ajusta os <img src>")
+    parser.add_argument("--outputs", choices=OUTPUT_MODES, default="keep",
+                        help="Outputs das celulas de codigo: keep (padrao), strip, "
+                             "externalize (imagens em images/) ou truncate-html")
+    parser.add_argument("--outputs-cap", action="append", default=[], metavar="capXX=MODO",
+                        help="--outputs so para um capitulo (pode repetir)")
+    parser.add_argument("--html-limit", type=int, default=50, metavar="KB",
+                        help="Tamanho maximo de um output text/html com truncate-html (padrao: 50)")
+    parser.add_argument("--inline-images", action="store_true",
+                        help="Embute as imagens no .ipynb (para quem baixa so o notebook); "
+                             "nao se combina com --outputs externalize")
+    parser.add_argument("--inline-as", choices=INLINE_MODES, default="attachment",
+                        help="Com --inline-images: anexos da celula (padrao) ou data URIs")
+    parser.add_argument("--cell-cache-mb", type=int, default=64, metavar="MB",
+                        help="Limite do cache de celulas processadas em <out-dir>/.cell-cache "
+                             "(padrao: 64; 0 desliga)")
+    parser.add_argument("--watch", action="store_true",
+                        help="Com --batch/--epub: continua rodando e reconverte os capitulos "
+                             "afetados a cada notebook, imagem ou .bib salvo")
+    parser.add_argument("--targets", type=parse_targets, metavar="ALVO,...",
+                        help="Alvos gerados de uma so analise por capitulo: "
+                             f"{','.join(TARGETS)} (ex.: aluno,epub,md); sem notebook, "
+                             "vale como --batch")
     parser.add_argument("notebook", nargs="?",
                         help="Caminho para o .ipynb (modo unico)")
     parser.add_argument("bib", help="Caminho para o references.bib")
     parser.add_argument("--output", "-o", help="Saida do .ipynb no modo unico")
     args = parser.parse_args()
 
+    profile = None
+    if args.profile or args.profile_json:
+        profile = Path(args.profile_json or Path(args.out_dir) / "profile.json")
+    optimizer = None
+    if args.optimize_images:
+        if Image is None:
+            parser.error("--optimize-images requer Pillow (pip install Pillow)")
+        if args.max_width < 1:
+            parser.error("--max-width deve ser positivo")
+        optimizer = ImageOptimizer(args.max_width, args.webp)
+    elif args.webp:
+        parser.error("--webp so vale com --optimize-images")
+    per_chapter = {}
+    for item in args.outputs_cap:
+        cap, _, mode = item.partition("=")
+        if mode not in OUTPUT_MODES:
+            parser.error(f"--outputs-cap {item}: use capXX=MODO, MODO em {', '.join(OUTPUT_MODES)}")
+        per_chapter[cap] = mode
+    outputs = OutputPolicy(args.outputs, per_chapter, args.html_limit * 1000) \
+        if args.outputs != "keep" or per_chapter else None
+    inline = args.inline_as if args.inline_images else None
+    if inline and outputs and "externalize" in {outputs.mode, *per_chapter.values()}:
+        # externalize tira as imagens de output do notebook; --inline-images
+        # promete um arquivo que nao depende de images/
+        parser.error("--outputs externalize nao se combina com --inline-images")
+    if args.targets and args.epub:
+        parser.error("--epub e --targets nao se combinam: use --targets ...,epub")
+    batch = args.batch or bool(args.targets and not args.notebook)
+    if args.watch and not (batch or args.epub):
+        parser.error("--watch so vale com --batch, --epub ou --targets")
+
     if args.epub:
-        run_batch_epub(args.bib, args.out_dir)
-    elif args.batch:
-        run_batch(args.bib, args.out_dir)
+        run_batch_epub(args.bib, args.out_dir, args.jobs, args.force, profile, optimizer,
+                       outputs, inline, args.cell_cache_mb)
+    elif batch:
+        run_batch(args.bib, args.out_dir, args.jobs, args.force, profile, optimizer, outputs,
+                  inline, args.targets, args.cell_cache_mb)
     else:
         if not args.notebook:
             parser.error("Informe o notebook ou use --batch ou --epub")
@@ -1755,9 +4598,26 @@ def main():
                    nb_path.parent / (nb_path.stem + "_dist.ipynb")
         bib = parse_bib(args.bib)
         print(f"Processando: {nb_path}")
-        image_paths = process_notebook(nb_path, bib, out_path)
-        if image_paths:
-            copy_images(nb_path.parent, out_path.parent, image_paths)
+        traces = [] if profile else None
+        inline = image_inliner(inline, out_path.parent, optimizer)
+        outs = {t: out_path if t == "dist" else target_path(nb_path, out_path.parent, t)
+                for t in args.targets or ("dist",)}
+        with profiling(nb_path, traces):
+            image_paths = process_targets(nb_path, bib, outs, optimizer, outputs, inline)
+        if inline:
+            image_paths = [p for p in image_paths if not inline.handles(p)]
+        seconds = copy_images(nb_path.parent, out_path.parent, image_paths,
+                              optimizer=optimizer) if image_paths else 0.0
+        if profile:
+            add_copy_stage(traces[0], seconds)
+            print(profile_table(traces[0]))
+            if not args.profile_json:
+                profile = out_path.with_suffix(".profile.json")
+            write_profile_trace(profile, traces)
+
+    if args.watch:
+        watch_chapters(args.bib, args.out_dir, args.jobs, args.epub, optimizer, outputs, inline,
+                       args.targets, args.cell_cache_mb)
 
 
 if __name__ == "__main__":
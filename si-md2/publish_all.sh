@@ -11,6 +11,7 @@ BIB="references.bib"
 ALUNOS_DIR="notebooks_alunos"
 BOOK_PDF="_book_pdf"
 BOOK_HTML="_book"
+JOBS="${JOBS:-$(getconf _NPROCESSORS_ONLN 2>/dev/null || echo 1)}"
 
 # Cores
 GREEN='\033[0;32m'
@@ -41,7 +42,7 @@ log "=== Workflow A: HTML ==="
 # ---------------------------------------------------------------------------
 log "=== Workflow C: Notebooks Alunos ==="
 {
-    python3 gerar_notebooks_alunos.py --batch "$BIB"
+    python3 gerar_notebooks_alunos.py --batch "$BIB" --jobs "$JOBS"
     ok "Notebooks de alunos gerados."
 } || {
     log "${RED}Falha no Workflow C (Alunos).${NC}"